@@ -0,0 +1,157 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import storage
+
+# Storage calls are routed to the backend chosen in settings (see storage.py). Blocking calls never run on the event
+# loop: writes (and their commits) go to a dedicated writer thread, which also serializes them as SQLite does anyway,
+# while reads run on a few reader threads so that they are not queued behind a slow commit (WAL mode lets readers and
+# the writer work at the same time).
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+_readers = ThreadPoolExecutor(max_workers=3, thread_name_prefix="db-reader")
+# The reply index of a shared backend (see reply_index.py) has a thread of its own, so that a lookup always runs after
+# the copies recorded before it, without waiting behind the other writes
+_replies = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reply-index")
+
+
+async def _run(executor, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+
+def shutdown():
+    """
+    Waits for the pending database calls and stops the database threads
+    :return: None
+    """
+    _readers.shutdown(wait=True)
+    _writer.shutdown(wait=True)
+    _replies.shutdown(wait=True)
+
+
+async def _call(executor, method, *args):
+    # Call a method of the storage backend, on the event loop if it does not block (e.g. the in-memory backend)
+    backend = storage.get_backend()
+    func = getattr(backend, method)
+    if not backend.blocking:
+        return func(*args)
+    return await _run(executor, func, *args)
+
+
+async def create_db():
+    return await _call(_writer, "create")
+
+
+async def insert_user(user_id):
+    return await _call(_writer, "insert_user", user_id)
+
+
+async def remove_user(user_id):
+    return await _call(_writer, "remove_user", user_id)
+
+
+async def get_user_status(user_id):
+    return await _call(_readers, "get_user_status", user_id)
+
+
+async def set_user_status(user_id, new_status, expected_status=None):
+    return await _call(_writer, "set_user_status", user_id, new_status, expected_status)
+
+
+async def get_partner_id(user_id):
+    return await _call(_readers, "get_partner_id", user_id)
+
+
+async def get_preferences(user_id):
+    return await _call(_readers, "get_preferences", user_id)
+
+
+async def set_preferences(user_id, preferences):
+    return await _call(_writer, "set_preferences", user_id, preferences)
+
+
+async def couple(current_user_id):
+    return await _call(_writer, "couple", current_user_id)
+
+
+async def match_waiting():
+    return await _call(_writer, "match_waiting")
+
+
+async def uncouple(user_id):
+    return await _call(_writer, "uncouple", user_id)
+
+
+async def retrieve_users_number():
+    return await _call(_readers, "retrieve_users_number")
+
+
+async def count_users_by_status():
+    return await _call(_readers, "count_users_by_status")
+
+
+async def reset_users_status():
+    return await _call(_writer, "reset_users_status")
+
+
+async def collect_statistics():
+    return await _call(_readers, "collect_statistics")
+
+
+async def expire_searches(older_than, limit):
+    return await _call(_writer, "expire_searches", older_than, limit)
+
+
+async def coupled_pairs():
+    return await _call(_readers, "coupled_pairs")
+
+
+async def touch(seen):
+    return await _call(_writer, "touch", seen)
+
+
+async def archive_inactive(inactive_for, limit):
+    return await _call(_writer, "archive_inactive", inactive_for, limit)
+
+
+def _call_replies(method, *args):
+    # Call a method of the reply index of the backend. A future is returned rather than a coroutine, so that the calls
+    # are ordered as they are made: an index kept in this process is updated right away
+    loop = asyncio.get_running_loop()
+    index = storage.get_backend().reply_index
+    if index.blocking:
+        future = loop.run_in_executor(_replies, functools.partial(getattr(index, method), *args))
+        future.add_done_callback(_log_failure)
+        return future
+    future = loop.create_future()
+    future.set_result(getattr(index, method)(*args))
+    return future
+
+
+def _log_failure(future):
+    # Records and drops are not awaited, so report their failures here
+    if not future.cancelled() and future.exception() is not None:
+        logging.warning("Reply index call failed: " + repr(future.exception()))
+
+
+def record_copies(user_id, partner_id, copies):
+    """
+    :return: a future, see ReplyIndex.record
+    """
+    return _call_replies("record", user_id, partner_id, copies)
+
+
+def lookup_reply(user_id, message_id, partner_id):
+    """
+    :return: a future, see ReplyIndex.lookup
+    """
+    return _call_replies("lookup", user_id, message_id, partner_id)
+
+
+def drop_replies(user_id, partner_id):
+    """
+    :return: a future, see ReplyIndex.drop
+    """
+    return _call_replies("drop", user_id, partner_id)
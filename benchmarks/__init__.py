@@ -0,0 +1,6 @@
+"""
+Micro-benchmarks of the hot paths of the bot. Each module is a script printing its results as JSON, in the format of
+load_test.py (which measures the whole bot end to end), so that results can be compared across commits.
+Run them from the root of the repository, e.g.:
+    python -m benchmarks.connections --operations 20000
+"""
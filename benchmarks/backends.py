@@ -0,0 +1,91 @@
+"""
+Latency and throughput of every storage backend, called directly on a single thread: users are inserted, paired,
+read as on the relay path (status and partner) and half of the pairs are ended. "sharded" is the backend of a worker
+of cluster.py, with the coordinator pairing the users in another process.
+
+Usage:
+    python -m benchmarks.backends --users 2000
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+import storage
+from kv_server import KeyValueServer
+from load_test import summarize
+
+
+def create_backend(name):
+    """
+    :return: (the started backend, the process of the coordinator of the sharded backend or None)
+    """
+    coordinator = None
+    if name == "sqlite":
+        backend = storage.create_backend("sqlite", database=os.path.join(tempfile.mkdtemp(prefix="chatbot-bench-"),
+                                                                           "chatbot_database.db"))
+    elif name == "kv":
+        backend = storage.create_backend("kv", port=KeyValueServer(port=0).start_in_thread())
+    elif name == "sharded":
+        from cluster import ShardedStorage, run_coordinator
+
+        context = multiprocessing.get_context("spawn")
+        ready, ready_sender = context.Pipe(duplex=False)
+        authkey = os.urandom(32)
+        coordinator = context.Process(target=run_coordinator, args=(ready_sender, authkey), daemon=True)
+        coordinator.start()
+        kv_host, kv_port, coordinator_address = ready.recv()
+        backend = ShardedStorage(kv_host, kv_port, coordinator_address, authkey)
+    else:
+        backend = storage.create_backend(name)
+    backend.create()
+    backend.start()
+    return backend, coordinator
+
+
+def measure(backend, users):
+    """
+    :return: dict operation -> summary of its latencies
+    """
+    user_ids = [str(1000000 + i) for i in range(users)]
+    operations = [
+        ("insert_user", lambda user_id: backend.insert_user(user_id), user_ids),
+        ("couple", lambda user_id: backend.couple(user_id), user_ids),
+        ("relay_reads", lambda user_id: (backend.get_user_status(user_id), backend.get_partner_id(user_id)),
+         user_ids),
+        ("uncouple", lambda user_id: backend.uncouple(user_id), user_ids[::2]),
+    ]
+    results = {}
+    for name, operation, arguments in operations:
+        latencies = []
+        started = time.perf_counter()
+        for user_id in arguments:
+            operation_started = time.perf_counter()
+            operation(user_id)
+            latencies.append(time.perf_counter() - operation_started)
+        results[name] = summarize(latencies, time.perf_counter() - started)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency of the operations of every storage backend")
+    parser.add_argument("--users", type=int, default=2000, help="users inserted and paired")
+    parser.add_argument("--backends", nargs="+", default=["memory", "sqlite", "kv", "sharded"],
+                        help="backends to measure")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.backends:
+        backend, coordinator = create_backend(name)
+        try:
+            results[name] = measure(backend, args.users)
+        finally:
+            if coordinator is not None:
+                coordinator.terminate()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
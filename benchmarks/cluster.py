@@ -0,0 +1,62 @@
+"""
+Scaling of the sharded deployment of cluster.py with the number of worker processes: the same saturating load test
+(users chatting back to back, without any rate limit) is run against the bot in the load test process and against
+clusters of an increasing number of workers, and the end-to-end relay throughput of each run is compared to the one of
+the single process. The router, the simulated users and the stand-in Bot API share the load test process, and each
+worker needs a core of its own, so the workers only pay off with more cores than workers.
+
+Each run is a separate load_test.py process, as the load test configures the modules of the bot.
+
+Usage:
+    python -m benchmarks.cluster --workers 0,1,2,4 --users 200
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run(workers, args):
+    with tempfile.TemporaryDirectory(prefix="chatbot-cluster-benchmark-") as work_dir:
+        output = os.path.join(work_dir, "results.json")
+        subprocess.run([sys.executable, os.path.join(ROOT, "load_test.py"), "--workers", str(workers),
+                        "--users", str(args.users), "--messages", str(args.messages), "--burst", str(args.burst),
+                        "--think-time", str(args.think_time), "--ramp-up", "0", "--reply-ratio", "0",
+                        "--newchat-ratio", "0", "--block-ratio", "0", "--global-rate", "100000", "--chat-rate", "1000",
+                        "--backend", args.backend, "--output", output], check=True, cwd=ROOT)
+        with open(output) as f:
+            results = json.load(f)
+    return {"duration_s": results["duration_s"], "relay_end_to_end": results["relay_end_to_end"],
+            "handler_errors": results["handler_errors"], "pairing_timeouts": results["pairing_timeouts"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of the cluster for an increasing number of workers")
+    parser.add_argument("--workers", default="0,1,2,4", help="comma separated numbers of worker processes, one run per "
+                                                             "number, 0 to run the bot in the load test process")
+    parser.add_argument("--users", type=int, default=200, help="number of simulated users")
+    parser.add_argument("--messages", type=int, default=20, help="messages sent by each user")
+    parser.add_argument("--burst", type=int, default=5, help="messages sent back to back")
+    parser.add_argument("--think-time", type=float, default=0.05, help="mean pause between bursts, in seconds")
+    parser.add_argument("--backend", default="sqlite", choices=("sqlite", "memory", "kv"),
+                        help="storage backend of the single process run")
+    args = parser.parse_args()
+
+    results = {"cpus": os.cpu_count()}
+    baseline = None
+    for workers in map(int, args.workers.split(",")):
+        result = run(workers, args)
+        throughput = result["relay_end_to_end"]["throughput_per_s"]
+        if baseline is None:
+            baseline = throughput
+        result["speedup"] = round(throughput / baseline, 2) if baseline else None
+        results["workers_" + str(workers)] = result
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Operations per second of the SQLite access patterns of db_connection: a new connection for every call (as the bot did
+before connection_manager) against the long-lived connections of the pool, for a point read and a single-row write
+transaction, from one thread and from several.
+
+Usage:
+    python -m benchmarks.connections --operations 20000 --threads 4
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from connection_manager import ConnectionPool
+from load_test import summarize
+
+USERS = 10000
+
+
+def _read(conn, user_id):
+    return conn.execute("SELECT status FROM users WHERE user_id=?", (user_id,)).fetchone()
+
+
+def _write(cursor, user_id):
+    cursor.execute("UPDATE users SET status=? WHERE user_id=?", (random.choice(("idle", "in_search")), user_id))
+
+
+def connect_per_call(database):
+    # One connection opened and closed by every call, as the functions of db_connection used to do
+    def read(user_id):
+        conn = sqlite3.connect(database)
+        try:
+            return _read(conn, user_id)
+        finally:
+            conn.close()
+
+    def write(user_id):
+        conn = sqlite3.connect(database, timeout=30)
+        try:
+            _write(conn.cursor(), user_id)
+            conn.commit()
+        finally:
+            conn.close()
+
+    return read, write
+
+
+def pooled(database, size):
+    pool = ConnectionPool(database, size=size)
+
+    def read(user_id):
+        with pool.connection() as conn:
+            return _read(conn, user_id)
+
+    def write(user_id):
+        with pool.transaction(immediate=True) as c:
+            _write(c, user_id)
+
+    return read, write
+
+
+def measure(call, operations, threads):
+    """
+    :param call: function called with a user id
+    :param operations: total number of calls
+    :param threads: number of threads sharing the calls
+    :return: summary of the latencies of the calls (see load_test.summarize)
+    """
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(count, seed):
+        rng = random.Random(seed)
+        measured = []
+        for _ in range(count):
+            user_id = str(rng.randrange(USERS))
+            started = time.perf_counter()
+            call(user_id)
+            measured.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(measured)
+
+    workers = [threading.Thread(target=worker, args=(operations // threads, seed)) for seed in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def create_database(directory):
+    database = os.path.join(directory, "chatbot_database.db")
+    conn = sqlite3.connect(database)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE users (user_id TEXT PRIMARY KEY, status TEXT, partner_id TEXT)")
+    conn.executemany("INSERT INTO users VALUES (?, 'idle', NULL)", ((str(i),) for i in range(USERS)))
+    conn.commit()
+    conn.close()
+    return database
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Connect-per-call against pooled SQLite connections")
+    parser.add_argument("--operations", type=int, default=20000, help="calls of each kind")
+    parser.add_argument("--threads", type=int, default=4, help="threads of the multi-threaded runs")
+    args = parser.parse_args()
+
+    database = create_database(tempfile.mkdtemp(prefix="chatbot-bench-"))
+    results = {}
+    for name, (read, write) in (("connect_per_call", connect_per_call(database)),
+                                ("pool", pooled(database, args.threads))):
+        results[name] = {
+            "read": measure(read, args.operations, 1),
+            "write": measure(write, args.operations // 4, 1),
+            "read_" + str(args.threads) + "_threads": measure(read, args.operations, args.threads),
+            "write_" + str(args.threads) + "_threads": measure(write, args.operations // 4, args.threads),
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
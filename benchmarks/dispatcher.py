@@ -0,0 +1,115 @@
+"""
+Throughput of the update processors and order of the updates of each pair, for an increasing number of active pairs:
+- sequential processing, as python-telegram-bot does without concurrent_updates (SimpleUpdateProcessor(1))
+- the default concurrent processor of python-telegram-bot (SimpleUpdateProcessor, concurrent but unordered)
+- OrderedUpdateProcessor, with the partners known from the memory backend and from the local cache of the kv backend
+Each update stands for a handler waiting for I/O (a random sleep) before relaying, and is out of order if it is
+relayed after a later update of its pair. The ordered processor runs the updates of a pair one at a time, so its
+throughput grows with the number of active pairs, up to --concurrency updates at a time.
+
+Usage:
+    python -m benchmarks.dispatcher --pairs 1,10,100,1000 --updates 20000
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from telegram import Update
+from telegram.ext import SimpleUpdateProcessor
+
+import storage
+from dispatcher import OrderedUpdateProcessor
+from kv_server import KeyValueServer
+from load_test import summarize
+
+
+def message(update_id, user_id):
+    return Update.de_json({"update_id": update_id,
+                           "message": {"message_id": update_id, "date": 0, "text": "message " + str(update_id),
+                                       "chat": {"id": user_id, "type": "private"},
+                                       "from": {"id": user_id, "is_bot": False, "first_name": "User"}}}, None)
+
+
+def create_backend(name, pairs):
+    if name == "kv":
+        backend = storage.create_backend("kv", port=KeyValueServer(port=0).start_in_thread())
+    else:
+        backend = storage.create_backend(name)
+    backend.create()
+    backend.start()
+    for index in range(2 * pairs):
+        backend.insert_user(str(1000000 + index))
+        backend.couple(str(1000000 + index))
+    storage.install(backend)
+    return backend
+
+
+async def run(processor, pairs, updates, max_io):
+    rng = random.Random(0)
+    # Built beforehand, not to measure the parsing of the updates
+    senders = [1000000 + rng.randrange(2 * pairs) for _ in range(updates)]
+    batch = [message(update_id, user_id) for update_id, user_id in enumerate(senders)]
+    latest = {}
+    out_of_order = 0
+    latencies = []
+
+    async def handle(update_id, pair, received):
+        nonlocal out_of_order
+        await asyncio.sleep(rng.random() * max_io)
+        # The message is relayed once the I/O is done
+        if latest.get(pair, -1) > update_id:
+            out_of_order += 1
+        latest[pair] = max(latest.get(pair, -1), update_id)
+        latencies.append(time.perf_counter() - received)
+
+    async with processor:
+        started = time.perf_counter()
+        tasks = []
+        for update_id, update in enumerate(batch):
+            # The pair of the partners 2 * i and 2 * i + 1, as paired by create_backend
+            pair = (senders[update_id] - 1000000) // 2
+            coroutine = handle(update_id, pair, time.perf_counter())
+            tasks.append(asyncio.create_task(processor.process_update(update, coroutine)))
+            if update_id % 100 == 99:
+                # Updates arrive in batches, as from getUpdates
+                await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        duration = time.perf_counter() - started
+    result = summarize(latencies, duration)
+    result["out_of_order"] = out_of_order
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and ordering of the update processors")
+    parser.add_argument("--pairs", default="1,10,100,1000", help="comma separated numbers of coupled pairs sending the "
+                                                                 "updates, one run per number")
+    parser.add_argument("--updates", type=int, default=20000, help="maximum number of updates processed in each run")
+    parser.add_argument("--updates-per-pair", type=int, default=200,
+                        help="updates processed in each run per pair, so that the runs with few pairs stay short")
+    parser.add_argument("--sequential-updates", type=int, default=1000,
+                        help="updates processed in each sequential run, which does not depend on the pairs")
+    parser.add_argument("--concurrency", type=int, default=256, help="max_concurrent_updates of the processors")
+    parser.add_argument("--max-io", type=float, default=0.002, help="maximum seconds each handler waits for I/O")
+    args = parser.parse_args()
+
+    results = {}
+    for backend_name in ("memory", "kv"):
+        for pairs in map(int, args.pairs.split(",")):
+            create_backend(backend_name, pairs)
+            updates = min(args.updates, args.updates_per_pair * pairs)
+            runs = {"sequential": asyncio.run(run(SimpleUpdateProcessor(1), pairs,
+                                                  min(updates, args.sequential_updates), args.max_io)),
+                    "simple": asyncio.run(run(SimpleUpdateProcessor(args.concurrency), pairs, updates, args.max_io)),
+                    "ordered": asyncio.run(run(OrderedUpdateProcessor(args.concurrency), pairs, updates,
+                                               args.max_io))}
+            runs["ordered_speedup"] = round(runs["ordered"]["throughput_per_s"] /
+                                            runs["sequential"]["throughput_per_s"], 1)
+            results[backend_name + "_" + str(pairs) + "_pairs"] = runs
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
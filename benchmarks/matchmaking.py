@@ -0,0 +1,159 @@
+"""
+Matchmaking by preferences (languages, regions and interests drawn from Zipf distributions, 30% of the users with no
+preference at all, then none of them):
+- latency of a search against 100k waiting users, with the preference index of MatchmakingQueue and with a scan of
+  the waiting users for the first compatible one (the oldest one of the narrowest level too, as they all wait below
+  the widening thresholds), and with the searches of a language nobody waiting speaks
+- steady state: users arrive at a fixed rate for 10 simulated minutes and the queue is widened every 5 seconds, to
+  see how long they wait and at which level they are paired
+The clock of matchmaking is simulated, so that the steady state runs in seconds.
+
+Usage:
+    python -m benchmarks.matchmaking --waiting 100000 --searches 5000
+"""
+import argparse
+import json
+import random
+import time
+from collections import OrderedDict
+
+import matchmaking
+from load_test import summarize
+from matchmaking import MatchmakingQueue, make_preferences
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+def preference_generator(seed, no_preference):
+    rng = random.Random(seed)
+
+    def zipf(n, s=1.2):
+        weights = [1 / (k ** s) for k in range(1, n + 1)]
+        return lambda: rng.choices(range(n), weights)[0]
+
+    language, region, interest = zipf(20), zipf(12), zipf(60)
+
+    def preferences():
+        if rng.random() < no_preference:
+            return make_preferences()
+        return make_preferences("l" + str(language()), "r" + str(region()) if rng.random() < 0.7 else None,
+                                ["i" + str(interest()) for _ in range(rng.choice([0, 1, 2, 3]))])
+
+    return preferences
+
+
+def compatible(a, b):
+    def same(x, y):
+        return x is None or y is None or x == y
+
+    return (same(a.language, b.language) and same(a.region, b.region) and
+            (not a.interests or not b.interests or bool(set(a.interests) & set(b.interests))))
+
+
+def search(queue, waiting_users, searching):
+    """
+    Searches through the index of the queue and through a scan of the waiting users, the users left waiting are
+    discarded
+    :param queue: MatchmakingQueue
+    :param waiting_users: OrderedDict user_id -> Preferences of the users in the queue, in FIFO order
+    :param searching: list of (user_id, Preferences) of the searching users
+    :return: (summary of the index, summary of the scan, number of users paired)
+    """
+    index_latencies = []
+    scan_latencies = []
+    paired = 0
+    for user_id, preferences in searching:
+        started = time.perf_counter()
+        next((other_id for other_id, other in waiting_users.items() if compatible(preferences, other)), None)
+        scan_latencies.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        match = queue.pair_or_enqueue(user_id, preferences=preferences)
+        index_latencies.append(time.perf_counter() - started)
+        if match is None:
+            queue.discard(user_id)
+        else:
+            paired += 1
+            del waiting_users[match[0]]
+    return summarize(index_latencies, sum(index_latencies)), summarize(scan_latencies, sum(scan_latencies)), paired
+
+
+def search_latency(no_preference, waiting, searches):
+    """
+    :return: summaries of the searches through the index and through a scan, and the share of searches paired at once
+    """
+    preferences = preference_generator(0, no_preference)
+    queue = MatchmakingQueue(matchmaking.settings.MATCH_WIDEN_AFTER)
+    # Loaded without pairing them, as after a restart, and waiting for less than the first widening threshold
+    waiting_users = OrderedDict(("w" + str(index), preferences()) for index in range(waiting))
+    queue.load(waiting_users.items())
+    index, scan, paired = search(queue, waiting_users, [("s" + str(i), preferences()) for i in range(searches)])
+    result = {"index": index, "scan": scan, "paired_at_once": round(paired / searches, 3),
+              "matches_by_level": list(queue.matches)}
+    # Compatible only with the users accepting any language
+    unspoken = [("u" + str(i), make_preferences("unspoken")) for i in range(min(searches, 200))]
+    index, scan, paired = search(queue, waiting_users, unspoken)
+    result["unspoken_language"] = {"index": index, "scan": scan, "paired_at_once": round(paired / len(unspoken), 3)}
+    return result
+
+
+def steady_state(clock, no_preference, widen_after, arrivals_per_second, seconds):
+    """
+    :return: summary of the waits, the users still waiting at the end, the pairs made by the sweeps and by level
+    """
+    preferences = preference_generator(1, no_preference)
+    queue = MatchmakingQueue(widen_after)
+    waits = []
+    sweeps = []
+    swept = 0
+    arrivals = 0
+    for second in range(seconds):
+        for _ in range(arrivals_per_second):
+            clock.now += 1 / arrivals_per_second
+            arrivals += 1
+            match = queue.pair_or_enqueue("a" + str(arrivals), preferences=preferences())
+            if match is not None:
+                waits.append(match[1])
+        if second % 5 == 4:
+            started = time.perf_counter()
+            pairs = queue.widen()
+            sweeps.append(time.perf_counter() - started)
+            swept += len(pairs)
+            waits += [clock.now - user.since for user, _ in pairs]
+    result = summarize(waits, seconds)
+    # Waits are in simulated seconds, not milliseconds
+    result = {name.replace("_ms", "_s"): None if value is None else round(value / 1000, 3)
+              for name, value in result.items() if name.endswith("_ms")}
+    return {"pairs": len(waits), "waits": result, "waiting_at_end": len(queue), "pairs_by_sweeps": swept,
+            "sweeps": summarize(sweeps, sum(sweeps)), "matches_by_level": queue.matches}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Latency and waits of the matchmaking by preferences")
+    parser.add_argument("--waiting", type=int, default=100000, help="users waiting during the searches")
+    parser.add_argument("--searches", type=int, default=5000, help="searches measured")
+    parser.add_argument("--no-preference", type=float, default=0.3,
+                        help="share of the users without any preference, also measured without such users")
+    parser.add_argument("--arrivals", type=int, default=200, help="users arriving per second in the steady state")
+    parser.add_argument("--seconds", type=int, default=600, help="simulated seconds of the steady state")
+    args = parser.parse_args()
+
+    clock = Clock()
+    matchmaking.time = clock
+    results = {}
+    for no_preference in (args.no_preference, 0):
+        name = "no_preference_" + str(no_preference)
+        results["search_" + name] = search_latency(no_preference, args.waiting, args.searches)
+        for widen_after in (matchmaking.settings.MATCH_WIDEN_AFTER, (0, 0, 0)):
+            results["steady_state_" + name + "_widen_after_" + "_".join(map(str, widen_after))] = \
+                steady_state(clock, no_preference, widen_after, args.arrivals, args.seconds)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
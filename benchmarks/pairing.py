@@ -0,0 +1,91 @@
+"""
+Pairing latency against the number of users in the database: the table scan of the original couple() (the first row
+in search, with no index on the status) against couple() of the SQLite backend, which pairs through the in-memory
+matchmaking queue in a single transaction. The latency measured is the one of the search that finds a partner.
+
+Usage:
+    python -m benchmarks.pairing --sizes 1000 10000 100000 1000000 --searches 200
+"""
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import storage
+from UserStatus import UserStatus
+from load_test import summarize
+
+
+def bulk_insert(database, users):
+    # Idle users inserted directly, much faster than insert_user one at a time
+    conn = sqlite3.connect(database)
+    conn.executemany("INSERT INTO users (user_id, status, partner_id) VALUES (?, ?, NULL)",
+                     ((str(1000000000 + i), UserStatus.IDLE) for i in range(users)))
+    conn.commit()
+    conn.close()
+
+
+def table_scan(directory, users, searches):
+    """
+    :return: summary of the latencies of the query the original couple() ran to find a partner, with a single user in
+    search, inserted after every other one
+    """
+    database = os.path.join(directory, "scan.db")
+    conn = sqlite3.connect(database)
+    conn.execute("CREATE TABLE users (user_id TEXT PRIMARY KEY, status TEXT, partner_id TEXT)")
+    conn.commit()
+    bulk_insert(database, users)
+    conn.execute("INSERT INTO users VALUES ('waiting', ?, NULL)", (UserStatus.IN_SEARCH,))
+    conn.commit()
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(searches):
+        query_started = time.perf_counter()
+        conn.execute("SELECT user_id FROM users WHERE status=? AND user_id!=?",
+                     (UserStatus.IN_SEARCH, "searching")).fetchone()
+        latencies.append(time.perf_counter() - query_started)
+    conn.close()
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def matchmaking_queue(directory, users, searches):
+    """
+    :return: summary of the latencies of couple() of the SQLite backend finding a partner in the queue
+    """
+    database = os.path.join(directory, "chatbot_database.db")
+    backend = storage.configure("sqlite", database=database)
+    backend.create()
+    bulk_insert(database, users)
+    backend.start()
+    waiting, searching = str(1000000000), str(1000000001)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(searches):
+        backend.couple(waiting)
+        search_started = time.perf_counter()
+        result = backend.couple(searching)
+        latencies.append(time.perf_counter() - search_started)
+        assert result.partner_id == waiting
+        backend.uncouple(waiting)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pairing latency from 1k to 1M users, table scan against queue")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                        help="numbers of users in the database")
+    parser.add_argument("--searches", type=int, default=200, help="searches finding a partner at each size")
+    args = parser.parse_args()
+
+    results = {}
+    for users in args.sizes:
+        directory = tempfile.mkdtemp(prefix="chatbot-bench-")
+        results[users] = {"table_scan": table_scan(directory, users, args.searches),
+                          "matchmaking_queue": matchmaking_queue(directory, users, args.searches)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
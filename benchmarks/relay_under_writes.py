@@ -0,0 +1,107 @@
+"""
+Latency of the relay path (the status and the partner of the sender) while other users keep writing, with the SQLite
+backend called directly on the event loop (as the handlers did before async_db) and through async_db. Also reports
+the lag of the event loop, i.e. how late a task sleeping 1 ms wakes up.
+
+Usage:
+    python -m benchmarks.relay_under_writes --duration 5 --writers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+
+import async_db
+import storage
+from load_test import summarize
+
+PAIRS = 1000
+
+
+async def run(mode, duration, writers, relays_per_second):
+    """
+    :param mode: "blocking" to call the backend on the event loop, "async_db" to go through async_db
+    :param duration: seconds of the run
+    :param writers: number of tasks searching and leaving chats without pause
+    :param relays_per_second: messages relayed per second
+    :return: dict with the summaries of the relay latencies and of the event loop lag, and the number of writes
+    """
+    backend = storage.configure("sqlite", database=os.path.join(tempfile.mkdtemp(prefix="chatbot-bench-"),
+                                                                 "chatbot_database.db"))
+    backend.create()
+    backend.start()
+    coupled = [str(i) for i in range(2 * PAIRS)]
+    for user_id in coupled:
+        backend.insert_user(user_id)
+        backend.couple(user_id)
+
+    async def call(method, *args):
+        if mode == "blocking":
+            result = getattr(backend, method)(*args)
+            # Each call stands for an update of its own, the other updates run in between
+            await asyncio.sleep(0)
+            return result
+        return await getattr(async_db, method)(*args)
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+    writes = 0
+    relays = []
+    lags = []
+
+    async def writer(index):
+        nonlocal writes
+        users = ["w" + str(index) + "-" + str(i) for i in range(2)]
+        for user_id in users:
+            backend.insert_user(user_id)
+        while loop.time() < deadline:
+            # Both users search, get paired, then one of them leaves
+            await call("couple", users[0])
+            await call("couple", users[1])
+            await call("uncouple", users[0])
+            writes += 3
+
+    async def relay(user_id, scheduled):
+        await call("get_user_status", user_id)
+        await call("get_partner_id", user_id)
+        relays.append(loop.time() - scheduled)
+
+    async def sender():
+        rng = random.Random(0)
+        tasks = []
+        interval = 1 / relays_per_second
+        scheduled = loop.time()
+        while scheduled < deadline:
+            scheduled += interval
+            await asyncio.sleep(max(0.0, scheduled - loop.time()))
+            tasks.append(asyncio.ensure_future(relay(rng.choice(coupled), scheduled)))
+        await asyncio.gather(*tasks)
+
+    async def ticker():
+        while loop.time() < deadline:
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - started - 0.001)
+
+    await asyncio.gather(sender(), ticker(), *(writer(index) for index in range(writers)))
+    return {"relay": summarize(relays, duration), "loop_lag": summarize(lags, duration), "writes": writes}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay latency under write load, blocking calls against async_db")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds of each run")
+    parser.add_argument("--writers", type=int, default=4, help="tasks writing without pause")
+    parser.add_argument("--relays", type=int, default=500, help="messages relayed per second")
+    args = parser.parse_args()
+
+    results = {mode: asyncio.run(run(mode, args.duration, args.writers, args.relays))
+               for mode in ("blocking", "async_db")}
+    async_db.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Memory and lookup latency of the reply index with many concurrent pairs, each with a number of relayed messages:
+- ReplyIndex, kept in the process, for a few numbers of slots
+- KeyValueReplyIndex, kept in the stand-in key-value server (run in this process, so that its memory is traced too)
+  and shared by the workers of the sharded mode
+- a dict keeping every relayed id, for reference
+The memory is measured with tracemalloc.
+
+Usage:
+    python -m benchmarks.reply_index --pairs 100000 --messages 100
+"""
+import argparse
+import json
+import random
+import time
+import tracemalloc
+
+from kv_server import KeyValueClient, KeyValueServer
+from load_test import summarize
+from reply_index import KeyValueReplyIndex, ReplyIndex
+
+
+def measure(index, pairs, messages, lookups):
+    """
+    :return: dict with the memory used per pair and the summary of the lookups
+    """
+    user_ids = [(str(1000000 + 2 * i), str(1000001 + 2 * i)) for i in range(pairs)]
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for user_id, partner_id in user_ids:
+        index.open(user_id, partner_id)
+        # The messages of the user are odd in his/her chat, their copies even in the chat of the partner
+        index.record(user_id, partner_id, [(message_id, message_id + 1) for message_id in range(1, 2 * messages, 2)])
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    rng = random.Random(0)
+    latencies = []
+    hits = 0
+    for _ in range(lookups):
+        user_id, partner_id = rng.choice(user_ids)
+        # One of the last messages of the chat
+        message_id = 2 * messages - 1 - 2 * rng.randrange(min(messages, index.slots // 2))
+        started = time.perf_counter()
+        hits += index.lookup(user_id, message_id, partner_id) == message_id + 1
+        latencies.append(time.perf_counter() - started)
+    return {"memory_mb": round(used / 1e6, 1), "bytes_per_pair": round(used / pairs),
+            "lookup": summarize(latencies, sum(latencies)), "hit_ratio": round(hits / lookups, 3)}
+
+
+def unbounded(pairs, messages):
+    # Every relayed id, as (user_id, message_id) -> (partner_id, id of the copy)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    index = {}
+    for i in range(pairs):
+        for message_id in range(1, 2 * messages, 2):
+            index[(1000000 + 2 * i, message_id)] = (1000001 + 2 * i, message_id + 1)
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return {"memory_mb": round(used / 1e6, 1), "bytes_per_pair": round(used / pairs),
+            "bytes_per_message": round(used / (pairs * messages))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory and lookup latency of the reply index")
+    parser.add_argument("--pairs", type=int, default=100000, help="concurrent pairs")
+    parser.add_argument("--messages", type=int, default=100, help="messages relayed by the first user of each pair")
+    parser.add_argument("--kv-pairs", type=int, default=20000, help="concurrent pairs in the key-value store")
+    parser.add_argument("--lookups", type=int, default=20000, help="lookups measured")
+    args = parser.parse_args()
+
+    results = {}
+    for slots in (32, 64):
+        results["local_" + str(slots)] = measure(ReplyIndex(slots), args.pairs, args.messages, args.lookups)
+    port = KeyValueServer(port=0).start_in_thread()
+    results["kv_32"] = measure(KeyValueReplyIndex(KeyValueClient(port=port), 32), args.kv_pairs, args.messages,
+                               args.lookups)
+    results["unbounded_dict"] = unbounded(args.pairs // 10, args.messages)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
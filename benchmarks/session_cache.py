@@ -0,0 +1,60 @@
+"""
+Latency of the reads of the relay hot path (the status and the partner of the sender) with the session cache warm,
+and cold (the session of the user evicted before each read, so that it is loaded from SQLite).
+
+Usage:
+    python -m benchmarks.session_cache --users 10000 --reads 50000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+import storage
+from load_test import summarize
+from session_cache import cache
+
+
+def measure(backend, users, reads, cold):
+    rng = random.Random(0)
+    latencies = []
+    before = cache.stats()
+    started = time.perf_counter()
+    for _ in range(reads):
+        user_id = rng.choice(users)
+        if cold:
+            cache.invalidate(user_id)
+        read_started = time.perf_counter()
+        backend.get_user_status(user_id)
+        backend.get_partner_id(user_id)
+        latencies.append(time.perf_counter() - read_started)
+    result = summarize(latencies, time.perf_counter() - started)
+    after = cache.stats()
+    result["cache_hits"] = after["hits"] - before["hits"]
+    result["cache_misses"] = after["misses"] - before["misses"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay reads with the session cache warm and cold")
+    parser.add_argument("--users", type=int, default=10000, help="coupled users")
+    parser.add_argument("--reads", type=int, default=50000, help="reads of each run")
+    args = parser.parse_args()
+
+    backend = storage.configure("sqlite", database=os.path.join(tempfile.mkdtemp(prefix="chatbot-bench-"),
+                                                                "chatbot_database.db"))
+    backend.create()
+    backend.start()
+    users = [str(1000000 + i) for i in range(args.users)]
+    for user_id in users:
+        backend.insert_user(user_id)
+        backend.couple(user_id)
+    results = {"cold": measure(backend, users, args.reads, cold=True),
+               "warm": measure(backend, users, args.reads, cold=False)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
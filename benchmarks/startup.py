@@ -0,0 +1,99 @@
+"""
+Startup time against the number of users in the database: the original startup (every row reset to idle, the search
+queue reloaded and the users counted by status) against start_epoch(), which begins a new epoch or restores the
+previous one. Also reports the one-time migration of a database created before the epochs.
+
+Usage:
+    python -m benchmarks.startup --users 10000000
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import connection_manager
+import db_connection
+from UserStatus import UserStatus
+from load_test import summarize
+
+
+def create_old_database(database, users):
+    # A database at the schema version preceding the epochs, where of every 10 users 8 are idle, 1 coupled and 1 in
+    # search
+    conn = sqlite3.connect(database)
+    for statement in db_connection.MIGRATIONS[0] + db_connection.MIGRATIONS[1]:
+        conn.execute(statement)
+    conn.execute("PRAGMA user_version=2")
+
+    def rows():
+        for i in range(users):
+            if i % 10 == 8:
+                yield str(i), UserStatus.COUPLED, str(i + 1)
+            elif i % 10 == 9:
+                yield str(i), UserStatus.IN_SEARCH, None
+            else:
+                yield str(i), UserStatus.IDLE, None
+
+    conn.executemany("INSERT INTO users VALUES (?, ?, ?)", rows())
+    conn.commit()
+    conn.close()
+
+
+def full_reset(database):
+    """
+    :return: seconds taken by the original startup
+    """
+    conn = sqlite3.connect(database)
+    started = time.perf_counter()
+    conn.execute("UPDATE users SET status=?", (UserStatus.IDLE,))
+    conn.commit()
+    conn.execute("SELECT user_id FROM users WHERE status=? ORDER BY rowid", (UserStatus.IN_SEARCH,)).fetchall()
+    conn.execute("SELECT status, COUNT(*) FROM users GROUP BY status").fetchall()
+    duration = time.perf_counter() - started
+    conn.close()
+    return duration
+
+
+def epochs(database, runs):
+    """
+    :return: (seconds taken by the migration, summary of start_epoch() beginning a new epoch, summary of start_epoch()
+    restoring the previous one)
+    """
+    connection_manager.configure(database=database)
+    started = time.perf_counter()
+    db_connection.create_db()
+    migration = time.perf_counter() - started
+    new, restored = [], []
+    for _ in range(runs):
+        started = time.perf_counter()
+        db_connection.start_epoch()
+        new.append(time.perf_counter() - started)
+        db_connection.mark_clean_shutdown()
+        started = time.perf_counter()
+        assert db_connection.start_epoch(restore_pairs=True)
+        restored.append(time.perf_counter() - started)
+    return migration, summarize(new, sum(new)), summarize(restored, sum(restored))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup time, full reset against epochs")
+    parser.add_argument("--users", type=int, default=1000000, help="users in the database")
+    parser.add_argument("--runs", type=int, default=20, help="startups measured with the epochs")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="chatbot-bench-")
+    old = os.path.join(directory, "old.db")
+    create_old_database(old, args.users)
+    database = os.path.join(directory, "chatbot_database.db")
+    shutil.copy(old, database)
+    migration, new_epoch, restore = epochs(database, args.runs)
+    results = {"users": args.users, "full_reset_s": round(full_reset(old), 3), "migration_s": round(migration, 3),
+               "start_epoch": new_epoch, "start_epoch_restore": restore}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,23 @@
+import asyncio
 import logging
 from telegram import Update, ChatMember
 from telegram.ext import (filters, ApplicationBuilder, ContextTypes, CommandHandler, ConversationHandler,
                           MessageHandler, ChatMemberHandler)
 from UserStatus import UserStatus
 from config import BOT_TOKEN, ADMIN_ID
-import db_connection
+import async_db
+from cluster import Cluster
+from coalescer import coalescer
+from dispatcher import OrderedUpdateProcessor
+import housekeeping
+from matchmaking import make_preferences
+import metrics
+import settings
+from outbound import scheduler
+from state_machine import Transition
+from stats import statistics
+import storage
+from webhook import run_webhook
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -17,10 +30,12 @@ logging.basicConfig(
 ---> chat - 💬 start searching for a partner
 ---> exit - 🔚 exit from the chat
 ---> newchat - ⏭ exit from the chat and open a new one
+---> settings - ⚙️ choose the language, region and interests of your partners
 ---> stats - 📊 show bot statistics (only for admin)
 """
 
 
+@metrics.time_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """
     Welcomes the user and sets his/her status to idle if he/she is not already in the database
@@ -28,16 +43,17 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     :param context: context of the bot
     :return: status USER_ACTION
     """
-    await context.bot.send_message(chat_id=update.effective_chat.id,
-                                   text="Welcome to this ChatBot! 🤖\nType /chat to start searching for a partner")
+    scheduler.notify(context.bot, update.effective_chat.id,
+                     text="Welcome to this ChatBot! 🤖\nType /chat to start searching for a partner")
 
     # Insert the user into the database, if not already present (check is done in the function)
     user_id = update.effective_user.id
-    db_connection.insert_user(user_id)
+    await async_db.insert_user(user_id)
 
     return USER_ACTION
 
 
+@metrics.time_handler
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Define the action to do based on the message received and the actual status of the user
@@ -47,9 +63,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     """
     user_id = update.effective_user.id
     # Check if the user is in chat
-    if db_connection.get_user_status(user_id=user_id) == UserStatus.COUPLED:
+    if await async_db.get_user_status(user_id=user_id) == UserStatus.COUPLED:
         # User is in chat, retrieve the other user
-        other_user_id = db_connection.get_partner_id(user_id)
+        other_user_id = await async_db.get_partner_id(user_id)
         if other_user_id is None:
             return await handle_not_in_chat(update, context)
         else:
@@ -58,6 +74,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return await handle_not_in_chat(update, context)
 
 
+@metrics.time_handler
 async def handle_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handles the /chat command, starting the search for a partner if the user is not already in search
@@ -65,34 +82,27 @@ async def handle_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     :param context: context of the bot
     :return: None
     """
-    # Handle the command /chat in different cases, based on the status of the user
+    # Start the search: the transition is guarded by the current status of the user, so if it is not applied the
+    # status returned tells why
     current_user_id = update.effective_user.id
-    current_user_status = db_connection.get_user_status(user_id=current_user_id)
-
-    if current_user_status == UserStatus.PARTNER_LEFT:
-        # First, check if the user has been left by his/her partner (he/she would have updated this user's status to
-        # PARTNER_LEFT)
-        db_connection.set_user_status(user_id=current_user_id, new_status=UserStatus.IDLE)
-
-        return await start_search(update, context)
-    elif current_user_status == UserStatus.IN_SEARCH:
+    result = await start_search(update, context)
+    if not result.applied and result.status is None:
+        # The user has been archived after a long inactivity (see housekeeping.py), bring him/her back
+        await async_db.insert_user(current_user_id)
+        result = await start_search(update, context)
+    if result.applied:
+        return
+    if result.status == UserStatus.IN_SEARCH:
         # Warn him/her that he/she is already in search
         return await handle_already_in_search(update, context)
-    elif current_user_status == UserStatus.COUPLED:
-        # Double check if the user is in chat
-        other_user = db_connection.get_partner_id(current_user_id)
-        if other_user is not None:
-            # If the user has been paired, then he/she is already in a chat, so warn him/her
-            await context.bot.send_message(chat_id=current_user_id,
-                                           text="🤖 You are already in a chat, type /exit to exit from the chat.")
-            return None
-        else:
-            return await start_search(update, context)
-    elif current_user_status == UserStatus.IDLE:
-        # The user is in IDLE status, so simply start the search
-        return await start_search(update, context)
+    elif result.status == UserStatus.COUPLED:
+        # If the user has been paired, then he/she is already in a chat, so warn him/her
+        scheduler.notify(context.bot, current_user_id,
+                         text="🤖 You are already in a chat, type /exit to exit from the chat.")
+        return
 
 
+@metrics.time_handler
 async def handle_not_in_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handles the case when the user is not in chat
@@ -101,18 +111,24 @@ async def handle_not_in_chat(update: Update, context: ContextTypes.DEFAULT_TYPE)
     :return: None
     """
     current_user_id = update.effective_user.id
-    current_user_status = db_connection.get_user_status(user_id=current_user_id)
+    current_user_status = await async_db.get_user_status(user_id=current_user_id)
+
+    if current_user_status is None:
+        # The user has been archived after a long inactivity (see housekeeping.py), bring him/her back
+        await async_db.insert_user(current_user_id)
+        current_user_status = UserStatus.IDLE
 
     if current_user_status in [UserStatus.IDLE, UserStatus.PARTNER_LEFT]:
-        await context.bot.send_message(chat_id=current_user_id,
-                                       text="🤖 You are not in a chat, type /chat to start searching for a partner.")
+        scheduler.notify(context.bot, current_user_id,
+                         text="🤖 You are not in a chat, type /chat to start searching for a partner.")
         return
     elif current_user_status == UserStatus.IN_SEARCH:
-        await context.bot.send_message(chat_id=current_user_id,
-                                       text="🤖 Message not delivered, you are still in search!")
+        scheduler.notify(context.bot, current_user_id,
+                         text="🤖 Message not delivered, you are still in search!")
         return
 
 
+@metrics.time_handler
 async def handle_already_in_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handles the case when the user is already in search
@@ -120,33 +136,36 @@ async def handle_already_in_search(update: Update, context: ContextTypes.DEFAULT
     :param context: context of the bot
     :return: None
     """
-    await context.bot.send_message(chat_id=update.effective_chat.id, text="🤖 You are already in search!")
+    scheduler.notify(context.bot, update.effective_chat.id, text="🤖 You are already in search!")
     return
 
 
-async def start_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+@metrics.time_handler
+async def start_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Transition:
     """
-    Starts the search for a partner, setting the user status to in_search and adding him/her to the list of users
+    Starts the search for a partner, setting the user status to in_search and pairing him/her with the user waiting
+    the longest, in a single transition
     :param update: update received from the user
     :param context: context of the bot
-    :return: None
+    :return: the outcome of the transition, not applied if the user can not search in his/her current status
     """
     current_user_id = update.effective_chat.id
 
-    # Set the user status to in_search
-    db_connection.set_user_status(user_id=current_user_id, new_status=UserStatus.IN_SEARCH)
-    await context.bot.send_message(chat_id=current_user_id, text="🤖 Searching for a partner...")
+    # Set the user status to in_search and search for a partner
+    result = await async_db.couple(current_user_id=current_user_id)
+    if not result.applied:
+        return result
+    scheduler.notify(context.bot, current_user_id, text="🤖 Searching for a partner...")
 
-    # Search for a partner
-    other_user_id = db_connection.couple(current_user_id=current_user_id)
     # If a partner is found, notify both the users
-    if other_user_id is not None:
-        await context.bot.send_message(chat_id=current_user_id, text="🤖 You have been paired with an user")
-        await context.bot.send_message(chat_id=other_user_id, text="🤖 You have been paired with an user")
+    if result.partner_id is not None:
+        scheduler.notify(context.bot, current_user_id, text="🤖 You have been paired with an user")
+        scheduler.notify(context.bot, result.partner_id, text="🤖 You have been paired with an user")
 
-    return
+    return result
 
 
+@metrics.time_handler
 async def handle_exit_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handles the /exit command, exiting from the chat if the user is in chat
@@ -158,6 +177,7 @@ async def handle_exit_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     return
 
 
+@metrics.time_handler
 async def handle_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handles the /stats command, showing the bot statistics if the user is the admin
@@ -167,46 +187,46 @@ async def handle_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     """
     user_id = update.effective_user.id
     if user_id == ADMIN_ID:
-        total_users_number, paired_users_number = db_connection.retrieve_users_number()
-        await context.bot.send_message(chat_id=user_id, text="Welcome to the admin panel")
-        await context.bot.send_message(chat_id=user_id,
-                                       text="Number of paired users: " + str(paired_users_number))
-        await context.bot.send_message(chat_id=user_id,
-                                       text="Number of active users: " + str(total_users_number))
+        # All the statistics are kept up to date by the storage and in memory, so they are rendered without a scan.
+        # With several worker processes they are collected from the coordinator
+        counts = await async_db.count_users_by_status()
+        collected = await async_db.collect_statistics()
+        scheduler.notify(context.bot, user_id, text="Welcome to the admin panel\n\n" + collected.report(counts))
     else:
 
         logging.warning("User " + str(user_id) + " tried to access the admin panel")
     return
 
 
+@metrics.time_handler
 async def exit_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Exits from the chat, sending a message to the other user and updating the status of both the users
     :param update: update received from the user
     :param context: context of the bot
-    :return: a boolean value, True if the user was in chat (and so exited), False otherwise
+    :return: None
     """
     current_user = update.effective_user.id
-    if db_connection.get_user_status(user_id=current_user) != UserStatus.COUPLED:
-        await context.bot.send_message(chat_id=current_user, text="🤖 You are not in a chat!")
+    # Perform the uncoupling, guarded by the user being coupled. The outcome tells who the partner was
+    result = await async_db.uncouple(user_id=current_user)
+    if not result.applied:
+        if result.status != UserStatus.COUPLED:
+            scheduler.notify(context.bot, current_user, text="🤖 You are not in a chat!")
         return
 
-    other_user = db_connection.get_partner_id(current_user)
-    if other_user is None:
-        return
-
-    # Perform the uncoupling
-    db_connection.uncouple(user_id=current_user)
-
-    await context.bot.send_message(chat_id=current_user, text="🤖 Ending chat...")
-    await context.bot.send_message(chat_id=other_user,
-                                   text="🤖 Your partner has left the chat, type /chat to start searching for a new "
-                                        "partner.")
-    await update.message.reply_text("🤖 You have left the chat.")
+    other_user = result.partner_id
+    # Deliver the messages of the chat still waiting to be copied before the chat ends, then forget their ids
+    coalescer.end_chat(current_user, other_user)
+    scheduler.notify(context.bot, current_user, text="🤖 Ending chat...")
+    scheduler.notify(context.bot, other_user,
+                     text="🤖 Your partner has left the chat, type /chat to start searching for a new partner.")
+    scheduler.notify(context.bot, current_user, "🤖 You have left the chat.",
+                     reply_to_message_id=update.message.message_id)
 
     return
 
 
+@metrics.time_handler
 async def exit_then_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handles the /newchat command, exiting from the chat and starting a new search if the user is in chat
@@ -215,14 +235,20 @@ async def exit_then_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     :return: None
     """
     current_user = update.effective_user.id
-    if db_connection.get_user_status(user_id=current_user) == UserStatus.IN_SEARCH:
+    current_user_status = await async_db.get_user_status(user_id=current_user)
+    if current_user_status == UserStatus.IN_SEARCH:
         return await handle_already_in_search(update, context)
-    # If exit_chat returns True, then the user was in chat and successfully exited
-    await exit_chat(update, context)
+    if current_user_status is None:
+        # The user has been archived after a long inactivity (see housekeeping.py), bring him/her back
+        await async_db.insert_user(current_user)
+    else:
+        await exit_chat(update, context)
     # Either the user was in chat or not, start the search
-    return await start_search(update, context)
+    await start_search(update, context)
+    return
 
 
+@metrics.time_handler
 async def in_chat(update: Update, other_user_id) -> None:
     """
     Handles the case when the user is in chat
@@ -230,38 +256,140 @@ async def in_chat(update: Update, other_user_id) -> None:
     :param other_user_id: id of the other user in chat
     :return: None
     """
+    reply_to_message_id = None
     # Check if the message is a reply to another message
     if update.message.reply_to_message is not None:
-        # If the message is a reply to another message, check if the message is a reply to a message sent by the user
-        # himself or by the other user
-        if update.message.reply_to_message.from_user.id == update.effective_user.id:
-            # The message is a reply to a message sent by the user himself, so send the message to the replyed+1
-            # message (the one copyed by the bot has id+1)
-            await update.effective_chat.copy_message(chat_id=other_user_id, message_id=update.message.message_id,
-                                                     protect_content=True,
-                                                     reply_to_message_id=update.message.reply_to_message.message_id + 1)
-
-        # Else, the replied message could be sent either by the other user, another previous user or the bot
-        # Since the bot sends non-protected-content messages, use this as discriminator
-        elif update.message.reply_to_message.has_protected_content is None:
-            # Message is sent by the bot, forward message without replying
-            await update.effective_chat.copy_message(chat_id=other_user_id, message_id=update.message.message_id,
-                                                     protect_content=True)
+        # The replied message, sent by the user or copied from the partner, is mapped to its counterpart in the chat of
+        # the partner by the reply index when the copy is sent. A message of the bot has none, so the copy is sent
+        # without replying
+        reply_to_message_id = update.message.reply_to_message.message_id
 
-        else:
-            # The message is a reply to a message sent by another user, forward the message replyed to the replyed -1
-            # message. Other user will see the message as a reply to the message he/she sent, only if he was the sender
-            await update.effective_chat.copy_message(chat_id=other_user_id, message_id=update.message.message_id,
-                                                     protect_content=True,
-                                                     reply_to_message_id=update.message.reply_to_message.message_id - 1)
-    else:
-        # The message is not a reply to another message, so send the message without replying
-        await update.effective_chat.copy_message(chat_id=other_user_id, message_id=update.message.message_id,
-                                                 protect_content=True)
+    metrics.count_relayed(update.message)
+    statistics.record_relay()
+    # Albums and bursts are copied in batches, replies one by one
+    coalescer.relay(update.get_bot(), update.effective_chat.id, other_user_id, update.message,
+                    reply_to_message_id=reply_to_message_id)
 
     return
 
 
+def _format_preferences(preferences) -> str:
+    return ("Language: " + (preferences["language"] or "any") + "\nRegion: " + (preferences["region"] or "any") +
+            "\nInterests: " + (", ".join(preferences["interests"]) or "any"))
+
+
+def _setting_typed(update: Update) -> bool:
+    # False if the user typed /skip to keep the current value
+    return not update.message.text.startswith("/")
+
+
+@metrics.time_handler
+async def handle_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handles the /settings command, showing the preferences of the user and asking for the new ones one at a time
+    :param update: update received from the user
+    :param context: context of the bot
+    :return: status SETTINGS_LANGUAGE, USER_ACTION if the user is in chat
+    """
+    user_id = update.effective_user.id
+    status = await async_db.get_user_status(user_id=user_id)
+    if status == UserStatus.IN_SEARCH:
+        # The preferences are read when a search starts, so the search is stopped for the new ones to be used
+        result = await async_db.set_user_status(user_id, UserStatus.IDLE, expected_status=UserStatus.IN_SEARCH)
+        status = result.status
+        if result.applied:
+            scheduler.notify(context.bot, user_id, text="🤖 Search stopped, type /chat to search again once your "
+                                                        "settings are saved.")
+    if status == UserStatus.COUPLED:
+        scheduler.notify(context.bot, user_id, text="🤖 You are in a chat, type /exit to exit from the chat before "
+                                                    "changing your settings.")
+        return USER_ACTION
+    preferences = (await async_db.get_preferences(user_id))._asdict()
+    context.user_data["preferences"] = preferences
+    scheduler.notify(context.bot, user_id,
+                     text="⚙️ Your settings:\n" + _format_preferences(preferences) +
+                          "\n\nType the language of your partners (e.g. en), \"any\" for any language, or /skip to "
+                          "keep it.")
+    return SETTINGS_LANGUAGE
+
+
+@metrics.time_handler
+async def handle_settings_language(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Stores the language typed by the user and asks for the region
+    :param update: update received from the user
+    :param context: context of the bot
+    :return: status SETTINGS_REGION
+    """
+    if _setting_typed(update):
+        context.user_data["preferences"]["language"] = update.message.text
+    scheduler.notify(context.bot, update.effective_user.id,
+                     text="Type the region of your partners (e.g. europe), \"any\" for any region, or /skip to keep "
+                          "it.")
+    return SETTINGS_REGION
+
+
+@metrics.time_handler
+async def handle_settings_region(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Stores the region typed by the user and asks for the interests
+    :param update: update received from the user
+    :param context: context of the bot
+    :return: status SETTINGS_INTERESTS
+    """
+    if _setting_typed(update):
+        context.user_data["preferences"]["region"] = update.message.text
+    scheduler.notify(context.bot, update.effective_user.id,
+                     text="Type your interests separated by commas (e.g. music, movies), \"any\" for none, or /skip "
+                          "to keep them.")
+    return SETTINGS_INTERESTS
+
+
+@metrics.time_handler
+async def handle_settings_interests(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Stores the interests typed by the user and saves his/her preferences
+    :param update: update received from the user
+    :param context: context of the bot
+    :return: status USER_ACTION
+    """
+    user_id = update.effective_user.id
+    preferences = context.user_data.pop("preferences")
+    if _setting_typed(update):
+        preferences["interests"] = update.message.text.split(",")
+    preferences = make_preferences(**preferences)
+    await async_db.set_preferences(user_id, preferences)
+    scheduler.notify(context.bot, user_id,
+                     text="🤖 Settings saved, they are used from your next search:\n" +
+                          _format_preferences(preferences._asdict()))
+    return USER_ACTION
+
+
+@metrics.time_handler
+async def cancel_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Handles any other command during the settings, leaving the preferences unchanged
+    :param update: update received from the user
+    :param context: context of the bot
+    :return: status USER_ACTION
+    """
+    context.user_data.pop("preferences", None)
+    scheduler.notify(context.bot, update.effective_user.id, text="🤖 Settings not changed.")
+    return USER_ACTION
+
+
+@metrics.time_handler
+async def match_waiting_users(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Job pairing the users in search who have waited long enough to accept a partner with other preferences
+    :param context: context of the bot
+    :return: None
+    """
+    for user_id, partner_id in await async_db.match_waiting():
+        scheduler.notify(context.bot, user_id, text="🤖 You have been paired with an user")
+        scheduler.notify(context.bot, partner_id, text="🤖 You have been paired with an user")
+
+
 def is_bot_blocked_by_user(update: Update) -> bool:
     new_member_status = update.my_chat_member.new_chat_member.status
     old_member_status = update.my_chat_member.old_chat_member.status
@@ -271,32 +399,61 @@ def is_bot_blocked_by_user(update: Update) -> bool:
         return False
 
 
+@metrics.time_handler
 async def blocked_bot_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if is_bot_blocked_by_user(update):
-        # Check if user was in chat
+        # Remove the user, leaving his/her partner if he/she was in chat, in a single transition
         user_id = update.effective_user.id
-        user_status = db_connection.get_user_status(user_id=user_id)
-        if user_status == UserStatus.COUPLED:
-            other_user = db_connection.get_partner_id(user_id)
-            db_connection.uncouple(user_id=user_id)
-            await context.bot.send_message(chat_id=other_user, text="🤖 Your partner has left the chat, type /chat to "
-                                                                    "start searching for a new partner.")
-        db_connection.remove_user(user_id=user_id)
+        result = await async_db.remove_user(user_id=user_id)
+        if result.partner_id is None:
+            coalescer.flush(user_id)
+        else:
+            coalescer.end_chat(user_id, result.partner_id)
+            scheduler.notify(context.bot, result.partner_id, text="🤖 Your partner has left the chat, type /chat to "
+                                                                  "start searching for a new partner.")
         return ConversationHandler.END
     else:
         # Telegram API does not provide a way to check if the bot was unblocked by the user
         return USER_ACTION
 
+
+async def stop_outbound(application) -> None:
+    """
+    Sends the relays and the outbound calls still queued before the bot shuts down
+    :param application: the bot application
+    :return: None
+    """
+    coalescer.flush_all()
+    await scheduler.stop()
+
+
 # Define status for the conversation handler
 USER_ACTION = 0
+SETTINGS_LANGUAGE, SETTINGS_REGION, SETTINGS_INTERESTS = range(1, 4)
 
-if __name__ == '__main__':
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
-    # Create the database, if not already present
-    db_connection.create_db()
 
-    # Reset the status of all the previous existent users to IDLE, if the bot is restarted
-    db_connection.reset_users_status()
+def settings_step(callback):
+    # Handlers of a step of /settings: a value or /skip, any other command cancels the settings
+    return [CommandHandler("skip", callback),
+            MessageHandler(filters.TEXT & ~filters.COMMAND, callback),
+            MessageHandler(filters.COMMAND, cancel_settings)]
+
+
+def build_application(token=BOT_TOKEN, base_url=None):
+    """
+    Builds the bot application with all its handlers
+    :param token: Telegram Bot API token
+    :param base_url: base URL of the Bot API, the official one if None (e.g. a stand-in server for load tests)
+    :return: the application, ready to be run
+    """
+    # Updates are processed concurrently across users, but in order for each user and each pair
+    processor = OrderedUpdateProcessor(settings.MAX_CONCURRENT_UPDATES, settings.MAX_PENDING_UPDATES_PER_USER)
+    # Outbound calls go through the scheduler, which keeps at most max_in_flight of them open
+    builder = (ApplicationBuilder().token(token).concurrent_updates(processor)
+               .connection_pool_size(scheduler.max_in_flight + 8).post_stop(stop_outbound))
+    if base_url is not None:
+        builder = builder.base_url(base_url)
+    application = builder.build()
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -311,9 +468,54 @@ if __name__ == '__main__':
                 CommandHandler("exit", handle_exit_chat),
                 CommandHandler("chat", handle_chat),
                 CommandHandler("newchat", exit_then_chat),
-                CommandHandler("stats", handle_stats)]
+                CommandHandler("stats", handle_stats),
+                CommandHandler("settings", handle_settings)],
+            SETTINGS_LANGUAGE: settings_step(handle_settings_language),
+            SETTINGS_REGION: settings_step(handle_settings_region),
+            SETTINGS_INTERESTS: settings_step(handle_settings_interests),
         },
-        fallbacks=[MessageHandler(filters.TEXT, handle_not_in_chat)]
+        fallbacks=[ChatMemberHandler(blocked_bot_handler), MessageHandler(filters.TEXT, handle_not_in_chat)]
     )
     application.add_handler(conv_handler)
-    application.run_polling()
+    if application.job_queue is not None:
+        # Pair the users waiting too long for a partner with their preferences
+        application.job_queue.run_repeating(match_waiting_users, interval=settings.MATCH_SWEEP_SECONDS)
+    else:
+        logging.warning("python-telegram-bot[job-queue] is not installed, users are paired only when they search")
+    # Expire the searches and the chats left idle, archive the users who do not come back
+    housekeeping.schedule(application)
+    return application
+
+
+if __name__ == '__main__':
+    if settings.WORKERS > 1:
+        # Sharded mode: this process only routes the updates to the worker processes, which run the handlers
+        cluster = Cluster(settings.WORKERS, BOT_TOKEN, restore_pairs=settings.RESTORE_PAIRS)
+        cluster.start()
+        application = cluster.build_router()
+        backend = None
+    else:
+        application = build_application()
+        backend = storage.get_backend()
+        # Create the storage, if not already present
+        backend.create()
+
+        # Start a new epoch, where all the previous existent users are idle, or restore the chats of the previous run
+        backend.start(restore_pairs=settings.RESTORE_PAIRS)
+
+        if metrics.ENABLED:
+            # Serve the metrics of the bot in the Prometheus format
+            metrics.register_bot_collectors(application)
+            metrics.start_server()
+
+    if settings.WEBHOOK_URL:
+        # Receive the updates through the embedded webhook server
+        asyncio.run(run_webhook(application, settings.WEBHOOK_URL, listen=settings.WEBHOOK_LISTEN,
+                                port=settings.WEBHOOK_PORT, secret_token=settings.WEBHOOK_SECRET_TOKEN,
+                                max_queue_size=settings.WEBHOOK_MAX_QUEUE_SIZE))
+    else:
+        application.run_polling()
+    if backend is not None:
+        # Let the pending database writes complete before exiting
+        async_db.shutdown()
+        backend.close()
@@ -0,0 +1,352 @@
+"""
+Sharded deployment on a single machine, without any outside service:
+- a router (the main process) receives the updates, by long polling or webhook, and forwards each one to the worker
+  owning its user, chosen by a hash of the user_id, so that the updates of a user are always handled by the same
+  worker and in order
+- N worker processes run the handlers of bot.py and send the relays and notices of their users
+- a coordinator process owns the shared state (the stand-in key-value server of kv_server.py, unless a "kv" storage
+  backend is configured) and pairs the users searching on any shard, so that the search list has a single consumer.
+  It also aggregates the statistics shown by /stats: the pairs it makes, and the chat durations and relays sent by
+  the workers every few seconds
+All of them talk over local IPC (pipes, multiprocessing.connection and the key-value server on localhost).
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import zlib
+from multiprocessing.connection import Client, Listener
+
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+
+import settings
+import storage
+from outbound import scheduler
+from stats import Statistics, statistics
+
+# Methods of the storage backend the workers can call on the coordinator
+_COORDINATOR_METHODS = {"couple", "close", "reset_users_status"}
+# Seconds between two sends of the statistics recorded by a worker to the coordinator
+_STATISTICS_FLUSH_SECONDS = 5
+
+
+def shard_of(user_id, shards):
+    """
+    :param user_id: id of the user
+    :param shards: number of shards
+    :return: index of the shard owning the user
+    """
+    return zlib.crc32(str(user_id).encode()) % shards
+
+
+def worker_rates(rates, workers):
+    """
+    Telegram limits the sends of the bot as a whole, so each worker gets its share of the global rate and burst. A chat
+    is mostly sent to by the worker of its user (and by the one of its partner), so it keeps the whole chat rate
+    :param rates: arguments of OutboundScheduler.set_rates for the whole bot
+    :param workers: number of worker processes
+    :return: arguments of OutboundScheduler.set_rates for each worker
+    """
+    # A bucket smaller than a single token would never send
+    return dict(rates, global_rate=rates["global_rate"] / workers,
+                global_burst=max(1.0, rates["global_burst"] / workers))
+
+
+class ShardedStorage(storage.KeyValueStorage):
+    """
+    Key-value storage of a worker: the users are read and changed directly in the shared key-value store, while the
+    searches are sent to the coordinator. cached_partner_id knows the partners of the sessions this worker has read
+    or changed, which may be stale when the partner (on another worker) changed them
+    """
+
+    def __init__(self, host, port, coordinator_address, authkey):
+        """
+        :param host: address of the key-value server
+        :param port: port of the key-value server
+        :param coordinator_address: address the coordinator listens on
+        :param authkey: key authenticating the connections to the coordinator
+        """
+        super().__init__(host, port)
+        self._coordinator_address = coordinator_address
+        self._authkey = authkey
+        self._local = threading.local()
+
+    def _call_coordinator(self, method, *args):
+        # One connection per thread, as for the key-value client
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = Client(self._coordinator_address, authkey=self._authkey)
+        conn.send((method, args))
+        result = conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def start(self, restore_pairs=False):
+        # The run is started by the coordinator
+        return False
+
+    def close(self):
+        self._call_coordinator("close")
+
+    def flush_statistics(self):
+        """
+        Sends the rolling series recorded by this worker (chat durations, relays) to the coordinator, which aggregates
+        the ones of every worker with the pairs it makes
+        :return: None
+        """
+        self._call_coordinator("merge_statistics", statistics.take_series())
+
+    def collect_statistics(self):
+        self.flush_statistics()
+        collected = Statistics()
+        collected.merge_series(self._call_coordinator("statistics"))
+        return collected
+
+    def reset_users_status(self):
+        # A new epoch, begun by the coordinator. The other workers still have the previous one until they restart, so
+        # this is meant for a single worker (e.g. tests) or before the workers handle any update
+        self._call_coordinator("reset_users_status")
+        self._epoch = None
+        self._sessions.clear()
+
+    def couple(self, user_id):
+        transition = self._call_coordinator("couple", str(user_id))
+        if transition.applied:
+            # Paired by the coordinator, keep the partner for cached_partner_id
+            self._sessions.put(str(user_id), transition.status, transition.partner_id)
+        return transition
+
+
+def run_coordinator(ready, authkey, kv_host=None, kv_port=None, restore_pairs=False):
+    """
+    Entry point of the coordinator process
+    :param ready: connection the addresses of the key-value server and of the coordinator are sent to once listening
+    :param authkey: key authenticating the connections of the workers
+    :param kv_host: address of the key-value server, the stand-in one is run in this process if None
+    :param kv_port: port of the key-value server
+    :param restore_pairs: if True, the pairs of the previous run are restored after a clean shutdown
+    :return: None
+    """
+    # Stopped by the router
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if kv_host is None:
+        from kv_server import KeyValueServer
+
+        kv_host = "127.0.0.1"
+        kv_port = KeyValueServer(kv_host, 0).start_in_thread()
+    backend = storage.KeyValueStorage(kv_host, kv_port)
+    backend.start(restore_pairs=restore_pairs)
+    # Searches are served one at a time, so that the search list is never contended
+    lock = threading.Lock()
+    methods = {method: getattr(backend, method) for method in _COORDINATOR_METHODS}
+    # The pairs are recorded here, the chat durations and the relays are sent by the workers
+    methods["merge_statistics"] = statistics.merge_series
+    methods["statistics"] = statistics.snapshot_series
+
+    def serve(conn):
+        with conn:
+            while True:
+                try:
+                    method, args = conn.recv()
+                except EOFError:
+                    return
+                try:
+                    if method not in methods:
+                        raise ValueError("Unknown coordinator method " + repr(method))
+                    with lock:
+                        result = methods[method](*args)
+                except Exception as e:
+                    result = e
+                conn.send(result)
+
+    listener = Listener(("127.0.0.1", 0), authkey=authkey)
+    ready.send((kv_host, kv_port, listener.address))
+    while True:
+        threading.Thread(target=serve, args=(listener.accept(),), daemon=True).start()
+
+
+def run_worker(index, updates, kv_host, kv_port, coordinator_address, authkey, token, base_url=None, rates=None):
+    """
+    Entry point of a worker process, handling the updates forwarded by the router until it receives None
+    :param index: index of the shard of the worker
+    :param updates: connection the updates are received from, as dicts
+    :param kv_host: address of the key-value server
+    :param kv_port: port of the key-value server
+    :param coordinator_address: address of the coordinator
+    :param authkey: key authenticating the connections to the coordinator
+    :param token: Telegram Bot API token
+    :param base_url: base URL of the Bot API, the official one if None
+    :param rates: arguments of OutboundScheduler.set_rates, the default rates if None
+    :return: None
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(format='%(asctime)s - worker ' + str(index) + ' - %(levelname)s - %(message)s',
+                        level=logging.WARNING)
+    storage.install(ShardedStorage(kv_host, kv_port, coordinator_address, authkey))
+    import async_db
+    import bot
+    import metrics
+
+    if rates is not None:
+        scheduler.set_rates(**rates)
+    application = bot.build_application(token=token, base_url=base_url)
+    if metrics.ENABLED:
+        # One endpoint per worker, on the ports following METRICS_PORT
+        metrics.register_bot_collectors(application)
+        metrics.start_server(port=settings.METRICS_PORT + 1 + index)
+    asyncio.run(_serve_updates(application, updates))
+    async_db.shutdown()
+
+
+async def _serve_updates(application, updates):
+    loop = asyncio.get_running_loop()
+    received = asyncio.Queue()
+
+    def read():
+        # Blocking reads from the pipe, on a thread of their own
+        while True:
+            try:
+                data = updates.recv()
+            except EOFError:
+                data = None
+            loop.call_soon_threadsafe(received.put_nowait, data)
+            if data is None:
+                return
+
+    async def flush_statistics():
+        backend = storage.get_backend()
+        while True:
+            await asyncio.sleep(_STATISTICS_FLUSH_SECONDS)
+            try:
+                await loop.run_in_executor(None, backend.flush_statistics)
+            except Exception as e:
+                logging.warning("Could not send the statistics to the coordinator: " + repr(e))
+
+    threading.Thread(target=read, name="update-reader", daemon=True).start()
+    flusher = loop.create_task(flush_statistics())
+    async with application:
+        await application.start()
+        while True:
+            data = await received.get()
+            if data is None:
+                break
+            application.update_queue.put_nowait(Update.de_json(data, application.bot))
+        # Handle the updates already forwarded, then flush the outbound calls
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    flusher.cancel()
+    await loop.run_in_executor(None, storage.get_backend().flush_statistics)
+
+
+class Cluster:
+    """
+    The coordinator and worker processes, and the router forwarding the updates to the workers
+    """
+
+    def __init__(self, workers, token, base_url=None, rates=None, restore_pairs=False):
+        """
+        :param workers: number of worker processes
+        :param token: Telegram Bot API token
+        :param base_url: base URL of the Bot API, the official one if None
+        :param rates: arguments of OutboundScheduler.set_rates for the whole bot, shared between the workers, the
+        default rates if None
+        :param restore_pairs: if True, the pairs of the previous run are restored after a clean shutdown
+        """
+        self.workers = workers
+        self.token = token
+        self.base_url = base_url
+        self.rates = rates
+        self.restore_pairs = restore_pairs
+        self._context = multiprocessing.get_context("spawn")
+        self._processes = []
+        self._connections = []
+        self._coordinator = None
+        self._coordinator_address = None
+        self._authkey = os.urandom(32)
+        self.forwarded = 0
+        # Updates forwarded to each worker
+        self.forwarded_by_shard = [0] * workers
+
+    def start(self):
+        """
+        Starts the coordinator and the workers
+        :return: None
+        """
+        kv_host = kv_port = None
+        if settings.STORAGE_BACKEND == "kv":
+            kv_host, kv_port = settings.KV_HOST, settings.KV_PORT
+        ready, ready_sender = self._context.Pipe(duplex=False)
+        self._coordinator = self._context.Process(target=run_coordinator, name="coordinator",
+                                                  args=(ready_sender, self._authkey, kv_host, kv_port,
+                                                        self.restore_pairs))
+        self._coordinator.start()
+        kv_host, kv_port, self._coordinator_address = ready.recv()
+        rates = worker_rates(self.rates if self.rates is not None else scheduler.rates, self.workers)
+        for index in range(self.workers):
+            receiver, sender = self._context.Pipe(duplex=False)
+            process = self._context.Process(target=run_worker, name="worker-" + str(index),
+                                            args=(index, receiver, kv_host, kv_port, self._coordinator_address,
+                                                  self._authkey, self.token, self.base_url, rates))
+            process.start()
+            self._processes.append(process)
+            self._connections.append(sender)
+
+    def forward(self, update):
+        """
+        Sends the update to the worker owning its user
+        :param update: the update
+        :return: None
+        """
+        user = update.effective_user or update.effective_chat
+        shard = shard_of(user.id, self.workers) if user is not None else 0
+        self._connections[shard].send(update.to_dict())
+        self.forwarded += 1
+        self.forwarded_by_shard[shard] += 1
+
+    def stop(self, timeout=60.0):
+        """
+        Lets the workers handle the updates already forwarded, then stops every process
+        :param timeout: seconds to wait for each worker
+        :return: None
+        """
+        for conn in self._connections:
+            conn.send(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logging.warning("Worker " + process.name + " did not stop in time, terminating it")
+                process.terminate()
+        self._connections = []
+        self._processes = []
+        if self._coordinator is not None:
+            # Record the clean shutdown before stopping the coordinator
+            with Client(self._coordinator_address, authkey=self._authkey) as conn:
+                conn.send(("close", ()))
+                conn.recv()
+            self._coordinator.terminate()
+            self._coordinator.join()
+            self._coordinator = None
+
+    def build_router(self):
+        """
+        Builds the application of the router: it only forwards every update, in the order they are received
+        :return: the application, to be run with run_polling() or webhook.run_webhook()
+        """
+
+        async def forward(update, context):
+            self.forward(update)
+
+        async def stop_cluster(application):
+            self.stop()
+
+        builder = ApplicationBuilder().token(self.token).post_stop(stop_cluster)
+        if self.base_url is not None:
+            builder = builder.base_url(self.base_url)
+        application = builder.build()
+        application.add_handler(TypeHandler(Update, forward))
+        return application
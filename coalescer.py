@@ -0,0 +1,178 @@
+import asyncio
+import time
+
+import async_db
+import settings
+import storage
+from outbound import scheduler
+
+
+class _Batch:
+    __slots__ = ("bot", "from_chat_id", "chat_id", "message_ids", "started", "media_group_id", "timer")
+
+    def __init__(self, bot, from_chat_id, chat_id):
+        self.bot = bot
+        self.from_chat_id = from_chat_id
+        self.chat_id = chat_id
+        self.message_ids = []
+        self.started = time.monotonic()
+        # Album of the last message of the batch, None if it is not part of an album
+        self.media_group_id = None
+        self.timer = None
+
+
+class RelayCoalescer:
+    """
+    Coalesces the messages a user sends to his/her partner before they are copied.
+    The items of an album (same media_group_id) and bursts of messages sent in a short time are copied with a single
+    copy_messages call, which keeps the albums grouped and the messages in order, instead of one copy_message per
+    message. A batch is sent once no message has been added for `window` seconds (`album_window` after an item of an
+    album), as soon as it is older than max_delay seconds, or before anything else the user sends to the partner
+    individually: replies are always copied one by one, as copy_messages can not reply.
+    The ids of the copies are recorded in the reply index, so that replies to any recent message of the chat are copied
+    as replies to its counterpart. The index of a pair is dropped once the copies queued when its chat ended are sent.
+    """
+
+    # Maximum number of messages of a copy_messages call
+    MAX_BATCH = 100
+
+    def __init__(self, window=0.25, album_window=0.5, max_delay=1.0):
+        """
+        :param window: seconds without new messages after which a burst is sent, 0 to copy the messages that are not
+        part of an album one by one right away
+        :param album_window: seconds without new messages after which a batch ending with an album item is sent
+        :param max_delay: maximum seconds a message waits in a batch, unless it continues the album of the batch
+        """
+        self.window = window
+        self.album_window = album_window
+        self.max_delay = max_delay
+        # from_chat_id -> batch of messages waiting to be copied
+        self._batches = {}
+        # Counters exposed for monitoring: messages copied, and API calls saved by copying them in batches
+        self.relayed = 0
+        self.saved_calls = 0
+        # chat_id -> future of the last copy queued to the chat, until it is done
+        self._last_copies = {}
+
+    def __len__(self):
+        return sum(len(batch.message_ids) for batch in self._batches.values())
+
+    def relay(self, bot, from_chat_id, chat_id, message, reply_to_message_id=None):
+        """
+        Copies a message of a user to his/her partner, possibly in a batch with the next ones
+        :param bot: bot copying the message
+        :param from_chat_id: id of the chat of the user
+        :param chat_id: id of the partner
+        :param message: the message to copy
+        :param reply_to_message_id: message of the user's chat the message replies to, None if not a reply
+        :return: None
+        """
+        self.relayed += 1
+        storage.get_backend().reply_index.open(from_chat_id, chat_id)
+        key = str(from_chat_id)
+        batch = self._batches.get(key)
+        media_group_id = message.media_group_id
+        if batch is not None and (str(batch.chat_id) != str(chat_id) or reply_to_message_id is not None or
+                                  len(batch.message_ids) >= self.MAX_BATCH or
+                                  (time.monotonic() - batch.started > self.max_delay and
+                                   (media_group_id is None or media_group_id != batch.media_group_id))):
+            self.flush(from_chat_id)
+            batch = None
+        if reply_to_message_id is not None or (batch is None and media_group_id is None and not self.window):
+            self._copy(bot, from_chat_id, chat_id, [message.message_id], reply_to_message_id)
+            return
+        if batch is None:
+            batch = self._batches[key] = _Batch(bot, from_chat_id, chat_id)
+        batch.message_ids.append(message.message_id)
+        batch.media_group_id = media_group_id
+        # Debounce: the batch is sent once no message has been added for a while
+        if batch.timer is not None:
+            batch.timer.cancel()
+        delay = self.album_window if media_group_id is not None else self.window
+        batch.timer = asyncio.get_running_loop().call_later(delay, self.flush, from_chat_id)
+
+    def flush(self, from_chat_id):
+        """
+        Sends the batch of messages of the user right away, e.g. before his/her chat ends
+        :param from_chat_id: id of the chat of the user
+        :return: None
+        """
+        batch = self._batches.pop(str(from_chat_id), None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        self._copy(batch.bot, batch.from_chat_id, batch.chat_id, batch.message_ids)
+
+    def flush_all(self):
+        for from_chat_id in list(self._batches):
+            self.flush(from_chat_id)
+
+    def end_chat(self, user_id, partner_id):
+        """
+        Sends the batches of both users right away, then drops the reply index of the pair once the copies queued to
+        both chats have been sent, so that the replies among them are still resolved. In the sharded mode only the
+        copies queued by this process are waited for
+        :param user_id: id of the user
+        :param partner_id: id of the partner
+        :return: None
+        """
+        self.flush(user_id)
+        self.flush(partner_id)
+        pending = {self._last_copies.get(str(chat_id)) for chat_id in (user_id, partner_id)} - {None}
+        if not pending:
+            async_db.drop_replies(user_id, partner_id)
+            return
+
+        def copied(future):
+            pending.discard(future)
+            if not pending:
+                async_db.drop_replies(user_id, partner_id)
+
+        for future in list(pending):
+            future.add_done_callback(copied)
+
+    def _copy(self, bot, from_chat_id, chat_id, message_ids, reply_to_message_id=None):
+        # Queue the copy in the relay lane of the outbound scheduler, ahead of the notices of the bot
+        if len(message_ids) == 1:
+            async def copy():
+                # The replied message is resolved when the copy is sent: the copies queued before it to the same chat
+                # have been sent and recorded by then
+                replied = None
+                if reply_to_message_id is not None:
+                    replied = await async_db.lookup_reply(from_chat_id, reply_to_message_id, chat_id)
+                return await bot.copy_message(chat_id=chat_id, from_chat_id=from_chat_id, message_id=message_ids[0],
+                                              protect_content=True, reply_to_message_id=replied)
+
+            future = scheduler.relay(chat_id, copy)
+        else:
+            self.saved_calls += len(message_ids) - 1
+            # Message ids of a chat only grow, and the updates of a user are processed in order
+            message_ids = sorted(message_ids)
+            future = scheduler.relay(chat_id, lambda: bot.copy_messages(chat_id=chat_id, from_chat_id=from_chat_id,
+                                                                        message_ids=message_ids, protect_content=True))
+        future.add_done_callback(lambda done: _record_copies(done, from_chat_id, chat_id, message_ids))
+        self._last_copies[str(chat_id)] = future
+        future.add_done_callback(lambda done: self._copied(str(chat_id), done))
+
+    def _copied(self, key, future):
+        if self._last_copies.get(key) is future:
+            del self._last_copies[key]
+
+
+def _record_copies(future, from_chat_id, chat_id, message_ids):
+    # Record the ids of the copies returned by copy_message (a MessageId) or copy_messages (a MessageId per message)
+    if future.cancelled() or future.exception() is not None:
+        return
+    copies = future.result()
+    copies = copies if isinstance(copies, (list, tuple)) else [copies]
+    if len(copies) != len(message_ids):
+        # Some messages could not be copied, the copies can not be matched to their originals
+        return
+    async_db.record_copies(from_chat_id, chat_id, [(message_id, copy.message_id)
+                                                  for message_id, copy in zip(message_ids, copies)])
+
+
+# Coalescer shared by the whole bot
+coalescer = RelayCoalescer(settings.RELAY_COALESCE_SECONDS, settings.RELAY_ALBUM_SECONDS,
+                           settings.RELAY_MAX_DELAY_SECONDS)
@@ -0,0 +1,143 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Default location of the chatbot database
+DATABASE_PATH = 'chatbot_database.db'
+
+# Pragmas applied once to every pooled connection
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",  # Readers do not block the writer and vice versa
+    "PRAGMA synchronous=NORMAL",  # Safe with WAL, fsync only at checkpoints
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",  # ~8 MB page cache per connection
+    "PRAGMA mmap_size=67108864",  # 64 MB memory mapped I/O
+    "PRAGMA busy_timeout=5000",  # Wait for the write lock instead of failing immediately
+)
+
+
+class ConnectionPool:
+    """
+    Bounded pool of long-lived SQLite connections.
+    Connections are opened lazily up to `size`, configured once with PRAGMAS and then reused, so every call keeps its
+    page cache and its cache of prepared statements (sqlite3 caches them per connection, keyed by the SQL text).
+    """
+
+    def __init__(self, database=DATABASE_PATH, size=4, cached_statements=128, timeout=30.0):
+        """
+        :param database: path of the SQLite database file
+        :param size: maximum number of open connections
+        :param cached_statements: number of prepared statements cached by each connection
+        :param timeout: seconds to wait for a free connection before raising TimeoutError
+        """
+        self.database = database
+        self.size = size
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._all = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False, cached_statements=self.cached_statements)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self):
+        # Prefer an idle connection, otherwise open a new one if the pool is not full yet
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._all) < self.size:
+                conn = self._connect()
+                self._all.append(conn)
+                return conn
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError("No database connection available after " + str(self.timeout) + " seconds")
+
+    def _release(self, conn):
+        if conn.in_transaction:
+            # Never hand out a connection with a dangling transaction
+            conn.rollback()
+        self._idle.put_nowait(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows a connection from the pool for read-only work
+        :return: a sqlite3 connection, given back to the pool on exit
+        """
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        """
+        Borrows a connection and runs the block in a single transaction, committed on success and rolled back on error
+        :param immediate: if True, the write lock is taken when the transaction begins, so that what the block reads
+        can not be changed by another connection before it writes
+        :return: a cursor bound to the borrowed connection
+        """
+        with self.connection() as conn:
+            try:
+                cursor = conn.cursor()
+                if immediate:
+                    cursor.execute("BEGIN IMMEDIATE")
+                yield cursor
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def close(self):
+        """
+        Closes every connection opened by the pool
+        :return: None
+        """
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all.clear()
+            self._idle = queue.LifoQueue(maxsize=self.size)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process-wide connection pool, creating it on first use
+    :return: the ConnectionPool instance
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool()
+    return _pool
+
+
+def configure(database=DATABASE_PATH, size=4, cached_statements=128):
+    """
+    Replaces the process-wide connection pool, closing the previous one
+    :param database: path of the SQLite database file
+    :param size: maximum number of open connections
+    :param cached_statements: number of prepared statements cached by each connection
+    :return: the new ConnectionPool instance
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = ConnectionPool(database=database, size=size, cached_statements=cached_statements)
+    return _pool
@@ -1,158 +1,490 @@
-import sqlite3
+import functools
+import threading
+import time
+
+import matchmaking
+import metrics
 from UserStatus import UserStatus
+from session_cache import cache
+from stats import statistics
+from connection_manager import get_pool
+from state_machine import Transition, compare_and_set, check_transition
+
+
+# Schema migrations, applied in order. The index of a migration in the list + 1 is the schema version it leads to,
+# the current version of a database is stored in its PRAGMA user_version
+MIGRATIONS = [
+    # 1: users table (user_id, status, partner_id)
+    [
+        "CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, status TEXT, partner_id TEXT)",
+    ],
+    # 2: indexes for the hot path queries
+    [
+        # get_partner_id (WHERE partner_id=?), on every relayed message. Idle users have no partner, so they are left
+        # out of the index
+        "CREATE INDEX IF NOT EXISTS idx_users_partner_id ON users (partner_id) WHERE partner_id IS NOT NULL",
+        # Counting the coupled users and rebuilding the matchmaking queue (WHERE status=?)
+        "CREATE INDEX IF NOT EXISTS idx_users_status ON users (status)",
+    ],
+    # 3: startup epochs. A row whose epoch is older than the current one belongs to a previous run of the bot, and its
+    # user is idle whatever its stored status (see start_epoch)
+    [
+        # Adding a column with a constant default does not rewrite the table
+        "ALTER TABLE users ADD COLUMN epoch INTEGER NOT NULL DEFAULT 0",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)",
+        "INSERT OR IGNORE INTO meta VALUES ('epoch', 0)",
+        "INSERT OR IGNORE INTO meta VALUES ('clean_shutdown', 0)",
+        # Number of users, kept up to date by insert_user and remove_user, so that startup does not count them
+        "INSERT OR IGNORE INTO meta SELECT 'users', COUNT(*) FROM users",
+        # Users in a status in the current epoch (WHERE status=? AND epoch=?)
+        "DROP INDEX IF EXISTS idx_users_status",
+        "CREATE INDEX IF NOT EXISTS idx_users_status_epoch ON users (status, epoch)",
+    ],
+    # 4: preferences of the users about their partners (see matchmaking.Preferences), NULL meaning any and the
+    # interests separated by commas
+    [
+        "CREATE TABLE IF NOT EXISTS preferences (user_id TEXT PRIMARY KEY, language TEXT, region TEXT, interests TEXT)",
+    ],
+    # 5: housekeeping (see housekeeping.py)
+    [
+        # Time of the last update of the user, written in batches by the housekeeping sweeps. 0 for the users not seen
+        # since this migration, whose time is the one in meta activity_since
+        "ALTER TABLE users ADD COLUMN last_seen INTEGER NOT NULL DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen)",
+        "INSERT OR IGNORE INTO meta SELECT 'activity_since', CAST(strftime('%s', 'now') AS INTEGER)",
+        # Cold table of the users archived after a long inactivity, they are moved back if they come back
+        "CREATE TABLE IF NOT EXISTS archived_users (user_id TEXT PRIMARY KEY, last_seen INTEGER, archived INTEGER)",
+    ],
+    # 6: get_partner_id reads the partner_id of the user's own row (partners point at each other), so the index of
+    # migration 2 on partner_id is never used and only slows down the writes
+    [
+        "DROP INDEX IF EXISTS idx_users_partner_id",
+    ],
+]
+
+# Epoch of the current run of the bot, set by start_epoch
+_epoch = 0
+
+# Writes are serialized within the process (SQLite allows a single writer anyway), so that the session cache, the
+# matchmaking queue and the counters are updated in the same order as the transactions are committed
+_write_lock = threading.RLock()
+
 
+def _serialized(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _write_lock:
+            return func(*args, **kwargs)
+    return wrapper
 
+
+@metrics.time_query
 def create_db():
-    # Connect to the chatbot database
-    conn = sqlite3.connect('chatbot_database.db')
-    c = conn.cursor()
-    # Create the users table if it does not exist (user_id, status, partner_id)
-    c.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, status TEXT, partner_id TEXT)")
-    conn.commit()
-    conn.close()
+    # Create the chatbot database or upgrade an existing one in place to the latest schema version
+    # Take the write lock first, so that two processes can not run the same migration
+    with get_pool().transaction(immediate=True) as c:
+        current_version = c.execute("PRAGMA user_version").fetchone()[0]
+        for version, statements in enumerate(MIGRATIONS[current_version:], start=current_version + 1):
+            for statement in statements:
+                c.execute(statement)
+            c.execute("PRAGMA user_version=" + str(version))
 
 
+@metrics.time_query
+@_serialized
 def insert_user(user_id):
-    # Connect to the chatbot database
-    conn = sqlite3.connect('chatbot_database.db')
-    c = conn.cursor()
-    # Check if the user is already in the users table
-    c.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
-    if c.fetchone():
-        # If the user is already in the users table, do nothing
-        conn.close()
-        return
-
-    # Otherwise, insert the user into the users table
-    c.execute("INSERT INTO users VALUES (?, ?, ?)", (user_id, UserStatus.IDLE, None))  # No partner_id initially
-    conn.commit()
-    conn.close()
+    with get_pool().transaction(immediate=True) as c:
+        # Check if the user is already in the users table
+        c.execute("SELECT * FROM users WHERE user_id=?", (user_id,))
+        if c.fetchone():
+            # If the user is already in the users table, do nothing
+            return
+
+        # Otherwise, insert the user into the users table, taking him/her out of the archive if he/she is back
+        c.execute("INSERT INTO users (user_id, status, partner_id, epoch, last_seen) VALUES (?, ?, ?, ?, ?)",
+                  (user_id, UserStatus.IDLE, None, _epoch, int(time.time())))  # No partner_id initially
+        c.execute("DELETE FROM archived_users WHERE user_id=?", (str(user_id),))
+        c.execute("UPDATE meta SET value=value+1 WHERE key='users'")
+    cache.put(str(user_id), UserStatus.IDLE, None)
+    statistics.users.added(UserStatus.IDLE)
 
 
+@metrics.time_query
+@_serialized
 def remove_user(user_id):
-    # If a user disconnects, remove him/her from the users table
-    conn = sqlite3.connect('chatbot_database.db')  # Connect to the chatbot database
-    c = conn.cursor()
-    # Check if the user had a partner
-    partner_id = get_partner_id(user_id)
-    if partner_id:
-        # If the user had a partner, remove the user from the partner's row
-        c.execute("UPDATE users SET partner_id=NULL WHERE user_id=?", (partner_id,))
-        # Update the partner's status to UserStatus.PARTNER_LEFT
-        set_user_status(partner_id, UserStatus.PARTNER_LEFT)
-    else:
-        # Simply remove the user from the users table
+    # If a user disconnects, remove him/her from the users table, in a single transaction with the partner leaving
+    user_id = str(user_id)
+    with get_pool().transaction(immediate=True) as c:
+        row = _get_row(c, user_id)
+        if row is None:
+            return Transition(False, None, None)
+        status, partner_id = row
+        # If the user had a partner, the partner is left alone
+        if partner_id is not None and not compare_and_set(c, partner_id, (UserStatus.COUPLED,),
+                                                          UserStatus.PARTNER_LEFT, None, _epoch):
+            partner_id = None
         c.execute("DELETE FROM users WHERE user_id=?", (user_id,))
-    conn.commit()
-    conn.close()
+        c.execute("DELETE FROM preferences WHERE user_id=?", (user_id,))
+        c.execute("UPDATE meta SET value=value-1 WHERE key='users'")
+    cache.invalidate(user_id)
+    statistics.users.removed(status)
+    if partner_id is not None:
+        cache.put(partner_id, UserStatus.PARTNER_LEFT, None)
+        statistics.users.transition(UserStatus.COUPLED, UserStatus.PARTNER_LEFT)
+        statistics.record_chat_end(user_id, partner_id)
+    # A removed user can no longer be paired
+    matchmaking.queue.discard(user_id)
+    return Transition(True, None, partner_id)
+
+
+def _get_row(c, user_id):
+    # Read (status, partner_id) of the user within the current transaction, None if the user does not exist.
+    # A row of an older epoch is moved to the current one as idle, the first time it is written
+    row = c.execute("SELECT status, partner_id, epoch FROM users WHERE user_id=?", (user_id,)).fetchone()
+    if row is None:
+        return None
+    status, partner_id, epoch = row
+    if epoch != _epoch:
+        c.execute("UPDATE users SET status=?, partner_id=NULL, epoch=? WHERE user_id=?",
+                  (UserStatus.IDLE, _epoch, user_id))
+        return UserStatus.IDLE, None
+    return status, partner_id
+
+
+def _get_session(user_id):
+    # Serve the session (status, partner_id) from the cache, loading it from the database on a miss
+    user_id = str(user_id)
+    session = cache.get(user_id)
+    if session is not None:
+        return session
+    version = cache.version
+    with get_pool().connection() as conn:
+        row = conn.execute("SELECT status, partner_id, epoch FROM users WHERE user_id=?", (user_id,)).fetchone()
+    if row is None:
+        return None
+    # The user of a row of an older epoch is idle
+    session = (row[0], row[1]) if row[2] == _epoch else (UserStatus.IDLE, None)
+    cache.fill(user_id, session[0], session[1], version)
+    return session
+
+
+def _to_preferences(language, region, interests):
+    return matchmaking.Preferences(language, region, tuple(interests.split(",")) if interests else ())
+
+
+def _get_preferences(c, user_id):
+    # Read the preferences of the user, none if he/she never set them
+    row = c.execute("SELECT language, region, interests FROM preferences WHERE user_id=?", (user_id,)).fetchone()
+    return matchmaking.NO_PREFERENCES if row is None else _to_preferences(*row)
+
+
+@metrics.time_query
+def get_preferences(user_id):
+    with get_pool().connection() as conn:
+        return _get_preferences(conn, str(user_id))
+
+
+@metrics.time_query
+@_serialized
+def set_preferences(user_id, preferences):
+    # Store the preferences of the user, used from his/her next search on
+    with get_pool().transaction(immediate=True) as c:
+        c.execute("INSERT OR REPLACE INTO preferences (user_id, language, region, interests) VALUES (?, ?, ?, ?)",
+                  (str(user_id), preferences.language, preferences.region, ",".join(preferences.interests)))
 
 
+@metrics.time_query
 def get_user_status(user_id):
-    # Connect to the chatbot database
-    conn = sqlite3.connect('chatbot_database.db')
-    c = conn.cursor()
-    # Get the status of the user
-    c.execute("SELECT status FROM users WHERE user_id=?", (user_id,))
-    status = c.fetchone()[0]
-    conn.close()
-    return status
-
-
-def set_user_status(user_id, new_status):
-    # Connect to the chatbot database
-    conn = sqlite3.connect('chatbot_database.db')
-    c = conn.cursor()
-    # Set the status of the user
-    c.execute("UPDATE users SET status=? WHERE user_id=?", (new_status, user_id))
-    conn.commit()
-    conn.close()
+    # Get the status of the user, None if the user does not exist
+    session = _get_session(user_id)
+    if session is None:
+        return None
+    return session[0]
+
+
+@metrics.time_query
+@_serialized
+def set_user_status(user_id, new_status, expected_status=None):
+    # Move the user to new_status, only if he/she is in expected_status (any status allowed by the state machine if
+    # None). The partner, if any, is left untouched: use couple/uncouple to change a pair
+    user_id = str(user_id)
+    with get_pool().transaction(immediate=True) as c:
+        row = _get_row(c, user_id)
+        if row is None:
+            return Transition(False, None, None)
+        old_status, partner_id = row
+        if expected_status is not None and old_status != expected_status:
+            return Transition(False, old_status, partner_id)
+        check_transition(old_status, new_status)
+        c.execute("UPDATE users SET status=? WHERE user_id=? AND status=?", (new_status, user_id, old_status))
+    cache.update(user_id, status=new_status)
+    statistics.users.transition(old_status, new_status)
+    if new_status != UserStatus.IN_SEARCH:
+        # The user stopped searching, take him/her out of the matchmaking queue
+        matchmaking.queue.discard(user_id)
+    return Transition(True, new_status, partner_id)
 
 
+@metrics.time_query
 def get_partner_id(user_id):
-    # Connect to the chatbot database
-    conn = sqlite3.connect('chatbot_database.db')
-    c = conn.cursor()
-    # If the user is a guest, then search for the host
-    c.execute("SELECT user_id FROM users WHERE partner_id=?", (user_id,))
-    other_user_id = c.fetchone()
-    if not other_user_id:
-        # If no user is found, return None
-        conn.close()
+    # Partners point at each other, so the partner is the partner_id of the user's own session
+    session = _get_session(user_id)
+    if session is None:
         return None
-    # otherwise, return the other user's id
-    other_user_id = other_user_id[0]
-    conn.close()
-
-    return other_user_id
+    return session[1]
 
 
+@metrics.time_query
+@_serialized
 def couple(current_user_id):
-    # Connect to the chatbot database
-    conn = sqlite3.connect('chatbot_database.db')
-    c = conn.cursor()
-    # If the user is not the current one and is in search, then couple them
-    c.execute("SELECT user_id FROM users WHERE status=? AND user_id!=?", (UserStatus.IN_SEARCH, current_user_id,))
-    # Verify if another user in search is found
-    other_user_id = c.fetchone()
-    if not other_user_id:
-        # If no user is found, return None
-        return None
-    # If another user in search is found, couple the users
-    other_user_id = other_user_id[0]
-    # Update both users' partner_id to reflect the coupling
-    c.execute("UPDATE users SET partner_id=? WHERE user_id=?", (other_user_id, current_user_id))
-    c.execute("UPDATE users SET partner_id=? WHERE user_id=?", (current_user_id, other_user_id))
+    # Start the search of the user and pair him/her with the compatible user waiting the longest, or leave him/her in
+    # the matchmaking queue if nobody is, all in a single transaction.
+    # The in_search status persisted here is only used to rebuild the queue after a crash
+    current_user_id = str(current_user_id)
+    other_user_id = None
+    with get_pool().transaction(immediate=True) as c:
+        row = _get_row(c, current_user_id)
+        if row is None:
+            return Transition(False, None, None)
+        old_status, partner_id = row
+        # Users can search only if they are idle, left by their partner, or coupled with a partner that is gone
+        if old_status == UserStatus.IN_SEARCH or (old_status == UserStatus.COUPLED and partner_id is not None):
+            return Transition(False, old_status, partner_id)
+        compare_and_set(c, current_user_id, (old_status,), UserStatus.IN_SEARCH, None, _epoch)
+        preferences = _get_preferences(c, current_user_id)
+        try:
+            while True:
+                match = matchmaking.queue.pair_or_enqueue(current_user_id, preferences=preferences)
+                if match is None:
+                    # If no user is found, the user waits in the queue
+                    break
+                other_user_id, waited, other_preferences = match
+                # The queue may hold a user who is no longer in search (e.g. changed by another process), skip him/her
+                if compare_and_set(c, other_user_id, (UserStatus.IN_SEARCH,), UserStatus.COUPLED, current_user_id,
+                                   _epoch):
+                    compare_and_set(c, current_user_id, (UserStatus.IN_SEARCH,), UserStatus.COUPLED, other_user_id,
+                                    _epoch)
+                    break
+                other_user_id = None
+        except Exception:
+            # The transaction is rolled back, so is the queue
+            matchmaking.queue.discard(current_user_id)
+            if other_user_id is not None:
+                matchmaking.queue.requeue(other_user_id, preferences=other_preferences)
+            raise
+    statistics.users.transition(old_status, UserStatus.IN_SEARCH)
+    if other_user_id is None:
+        cache.put(current_user_id, UserStatus.IN_SEARCH, None)
+        return Transition(True, UserStatus.IN_SEARCH, None)
 
-    # Update both users' status to UserStatus.COUPLED
-    c.execute("UPDATE users SET status=? WHERE user_id=?", (UserStatus.COUPLED, current_user_id))
-    c.execute("UPDATE users SET status=? WHERE user_id=?", (UserStatus.COUPLED, other_user_id))
+    cache.put(current_user_id, UserStatus.COUPLED, other_user_id)
+    cache.put(other_user_id, UserStatus.COUPLED, current_user_id)
+    statistics.users.transition(UserStatus.IN_SEARCH, UserStatus.COUPLED)
+    statistics.users.transition(UserStatus.IN_SEARCH, UserStatus.COUPLED)
+    statistics.record_pair(current_user_id, other_user_id, waited)
+    return Transition(True, UserStatus.COUPLED, other_user_id)
 
-    conn.commit()
-    conn.close()
 
-    return other_user_id
+@metrics.time_query
+@_serialized
+def match_waiting():
+    # Pair the users who have waited long enough to accept a partner of a wider bucket of the matchmaking queue, in a
+    # single transaction. Return the list of the (user_id, partner_id) pairs
+    pairs = matchmaking.queue.widen()
+    if not pairs:
+        return []
+    coupled = []
+    try:
+        with get_pool().transaction(immediate=True) as c:
+            for user, other in pairs:
+                # The queue may hold users who are no longer in search (e.g. changed by another process), the one still
+                # in search goes back to the queue
+                if not compare_and_set(c, other.user_id, (UserStatus.IN_SEARCH,), UserStatus.COUPLED, user.user_id,
+                                       _epoch):
+                    matchmaking.queue.requeue(user.user_id, user.since, user.preferences)
+                elif not compare_and_set(c, user.user_id, (UserStatus.IN_SEARCH,), UserStatus.COUPLED, other.user_id,
+                                         _epoch):
+                    compare_and_set(c, other.user_id, (UserStatus.COUPLED,), UserStatus.IN_SEARCH, None, _epoch)
+                    matchmaking.queue.requeue(other.user_id, other.since, other.preferences)
+                else:
+                    coupled.append((user, other))
+    except Exception:
+        # The transaction is rolled back, so is the queue
+        for user, other in pairs:
+            matchmaking.queue.requeue(other.user_id, other.since, other.preferences)
+            matchmaking.queue.requeue(user.user_id, user.since, user.preferences)
+        raise
+    now = time.monotonic()
+    for user, other in coupled:
+        cache.put(user.user_id, UserStatus.COUPLED, other.user_id)
+        cache.put(other.user_id, UserStatus.COUPLED, user.user_id)
+        statistics.users.transition(UserStatus.IN_SEARCH, UserStatus.COUPLED)
+        statistics.users.transition(UserStatus.IN_SEARCH, UserStatus.COUPLED)
+        statistics.record_pair(user.user_id, other.user_id, now - user.since)
+    return [(user.user_id, other.user_id) for user, other in coupled]
 
 
+@metrics.time_query
+@_serialized
 def uncouple(user_id):
-    # Connect to the chatbot database
-    conn = sqlite3.connect('chatbot_database.db')
-    c = conn.cursor()
-    # Retrieve the partner_id of the user
-    partner_id = get_partner_id(user_id)
-    if not partner_id:
-        # If the user is not coupled, return None
-        return None
+    # End the chat of the user, moving both the user and the partner to idle in a single transaction
+    user_id = str(user_id)
+    with get_pool().transaction(immediate=True) as c:
+        row = _get_row(c, user_id)
+        if row is None:
+            return Transition(False, None, None)
+        old_status, partner_id = row
+        if old_status != UserStatus.COUPLED or partner_id is None:
+            # If the user is not coupled, nothing to do
+            return Transition(False, old_status, partner_id)
+        compare_and_set(c, user_id, (UserStatus.COUPLED,), UserStatus.IDLE, None, _epoch)
+        # The partner is moved only if he/she is still coupled with the user
+        c.execute("UPDATE users SET status=?, partner_id=NULL "
+                  "WHERE user_id=? AND epoch=? AND status=? AND partner_id=?",
+                  (UserStatus.IDLE, partner_id, _epoch, UserStatus.COUPLED, user_id))
+        partner_updated = c.rowcount == 1
+    cache.put(user_id, UserStatus.IDLE, None)
+    statistics.users.transition(UserStatus.COUPLED, UserStatus.IDLE)
+    if partner_updated:
+        cache.put(partner_id, UserStatus.IDLE, None)
+        statistics.users.transition(UserStatus.COUPLED, UserStatus.IDLE)
+    else:
+        cache.invalidate(partner_id)
+    statistics.record_chat_end(user_id, partner_id)
+    return Transition(True, UserStatus.IDLE, partner_id)
+
+
+@metrics.time_query
+@_serialized
+def expire_searches(older_than, limit):
+    # Move to idle the users in search for more than older_than seconds (at most limit of them, the oldest first), in a
+    # single transaction. Return their ids
+    stale = matchmaking.queue.stale(older_than, limit)
+    if not stale:
+        return []
+    with get_pool().transaction(immediate=True) as c:
+        expired = [user_id for user_id in stale
+                   if compare_and_set(c, user_id, (UserStatus.IN_SEARCH,), UserStatus.IDLE, None, _epoch)]
+    # The others were no longer in search
+    for user_id in stale:
+        matchmaking.queue.discard(user_id)
+    for user_id in expired:
+        cache.put(user_id, UserStatus.IDLE, None)
+        statistics.users.transition(UserStatus.IN_SEARCH, UserStatus.IDLE)
+    return expired
+
+
+@metrics.time_query
+def coupled_pairs():
+    # Every pair of coupled users, once
+    with get_pool().connection() as conn:
+        return conn.execute("SELECT user_id, partner_id FROM users WHERE status=? AND epoch=? AND user_id<partner_id",
+                            (UserStatus.COUPLED, _epoch)).fetchall()
+
 
-    # Update both users' partner_id to reflect the uncoupling
-    c.execute("UPDATE users SET partner_id=NULL WHERE user_id=?", (user_id,))
-    c.execute("UPDATE users SET partner_id=NULL WHERE user_id=?", (partner_id,))
-    # Update both users' status to UserStatus.IDLE
-    c.execute("UPDATE users SET status=? WHERE user_id=?", (UserStatus.IDLE, user_id))
-    c.execute("UPDATE users SET status=? WHERE user_id=?", (UserStatus.IDLE, partner_id))
-    conn.commit()
-    conn.close()
-    return
+@metrics.time_query
+@_serialized
+def touch(seen):
+    # Record the time of the last update of the users, seen is a dict user_id -> time.time()
+    with get_pool().transaction(immediate=True) as c:
+        c.executemany("UPDATE users SET last_seen=? WHERE user_id=?",
+                      [(int(last_seen), str(user_id)) for user_id, last_seen in seen.items()])
 
 
+@metrics.time_query
+@_serialized
+def archive_inactive(inactive_for, limit):
+    # Move at most limit users who have not been seen for inactive_for seconds, and are neither coupled nor in search,
+    # to the archived_users table in a single transaction. Return the number of archived users
+    now = int(time.time())
+    with get_pool().transaction(immediate=True) as c:
+        activity_since = c.execute("SELECT value FROM meta WHERE key='activity_since'").fetchone()[0]
+        if now - inactive_for <= activity_since:
+            # The users not seen since the migration (last_seen=0) have not been inactive long enough yet
+            return 0
+        # Rows of an older epoch are idle, whatever their stored status
+        rows = c.execute("SELECT user_id, CASE WHEN epoch=? THEN status ELSE ? END FROM users "
+                         "WHERE last_seen<? AND (epoch<>? OR status IN (?, ?)) LIMIT ?",
+                         (_epoch, UserStatus.IDLE, now - inactive_for, _epoch, UserStatus.IDLE,
+                          UserStatus.PARTNER_LEFT, limit)).fetchall()
+        if not rows:
+            return 0
+        c.executemany("INSERT OR REPLACE INTO archived_users SELECT user_id, last_seen, ? FROM users WHERE user_id=?",
+                      [(now, row[0]) for row in rows])
+        c.executemany("DELETE FROM users WHERE user_id=?", [(row[0],) for row in rows])
+        c.execute("UPDATE meta SET value=value-? WHERE key='users'", (len(rows),))
+    for user_id, status in rows:
+        cache.invalidate(user_id)
+        statistics.users.removed(status)
+    return len(rows)
+
+
+@metrics.time_query
 def retrieve_users_number():
-    # Connect to the chatbot database
-    conn = sqlite3.connect('chatbot_database.db')
-    c = conn.cursor()
-    # Retrieve the number of users in the users table
-    c.execute("SELECT COUNT(*) FROM users")
-    total_users_number = c.fetchone()[0]
-    # Retrieve the number of users who are currently coupled
-    c.execute("SELECT COUNT(*) FROM users WHERE status='coupled'")
-    paired_users_number = c.fetchone()[0]
-    conn.close()
-    return total_users_number, paired_users_number
+    # Read the number of users and of the coupled ones from the counters kept up to date on every transition
+    counts = statistics.users.snapshot()
+    return sum(counts.values()), counts[UserStatus.COUPLED]
+
+
+@metrics.time_query
+@_serialized
+def start_epoch(restore_pairs=False):
+    """
+    Starts a run of the bot in constant time, whatever the number of users: instead of resetting the status of every
+    row, a new epoch begins and the rows of the older ones are treated as idle (and rewritten as such the first time
+    they are written). The matchmaking queue and the counters of users per status are loaded as well
+    :param restore_pairs: if True and the previous run was shut down cleanly (see mark_clean_shutdown), its epoch is
+    kept, so that the users coupled or in search are still coupled or in search
+    :return: True if the previous run has been restored, False if a new epoch has begun
+    """
+    global _epoch
+    with get_pool().transaction(immediate=True) as c:
+        meta = dict(c.execute("SELECT key, value FROM meta").fetchall())
+        restored = bool(restore_pairs and meta.get("clean_shutdown"))
+        _epoch = meta["epoch"] if restored else meta["epoch"] + 1
+        c.execute("UPDATE meta SET value=? WHERE key='epoch'", (_epoch,))
+        # Until mark_clean_shutdown is called again, a crash must not be mistaken for a clean shutdown
+        c.execute("UPDATE meta SET value=0 WHERE key='clean_shutdown'")
+    matchmaking.queue.clear()
+    cache.clear()
+    statistics.clear_chats()
+    if restored:
+        # The counters saved by mark_clean_shutdown
+        statistics.users.load({key[len("users:"):]: value for key, value in meta.items() if key.startswith("users:")})
+        load_search_queue()
+    else:
+        statistics.users.load({UserStatus.IDLE: meta["users"]})
+    return restored
+
 
+@metrics.time_query
+@_serialized
+def mark_clean_shutdown():
+    # Record that the bot stopped cleanly, together with the counters of users per status, so that the next run can
+    # restore the current epoch (see start_epoch)
+    with get_pool().transaction(immediate=True) as c:
+        c.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                      [("users:" + status, count) for status, count in statistics.users.snapshot().items()])
+        c.execute("UPDATE meta SET value=1 WHERE key='clean_shutdown'")
 
+
+@metrics.time_query
+@_serialized
 def reset_users_status():
-    # Connect to the chatbot database
-    conn = sqlite3.connect('chatbot_database.db')
-    c = conn.cursor()
-    # Reset the status of all users to UserStatus.IDLE
-    c.execute("UPDATE users SET status=?", (UserStatus.IDLE,))
-    conn.commit()
-    conn.close()
+    # Move every user to idle, by starting a new epoch
+    start_epoch()
+
+
+@metrics.time_query
+def load_search_queue():
+    with get_pool().connection() as conn:
+        # Rebuild the matchmaking queue from the users in search in the current epoch, oldest rows first
+        rows = conn.execute("SELECT u.user_id, p.language, p.region, p.interests FROM users u "
+                            "LEFT JOIN preferences p ON p.user_id=u.user_id "
+                            "WHERE u.status=? AND u.epoch=? ORDER BY u.rowid", (UserStatus.IN_SEARCH, _epoch))
+        matchmaking.queue.load((row[0], _to_preferences(*row[1:])) for row in rows)
+
+
+def count_users_by_status():
+    # Number of users in each status, from the counters kept up to date on every transition
+    return statistics.users.snapshot()
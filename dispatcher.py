@@ -0,0 +1,136 @@
+import asyncio
+from collections import deque
+
+from telegram.ext import BaseUpdateProcessor
+
+import storage
+
+
+class _KeyQueue:
+    __slots__ = ("waiters",)
+
+    def __init__(self):
+        # Futures of the updates holding or waiting for the key, in arrival order. The first one not cancelled holds it
+        self.waiters = deque()
+
+
+class OrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Processes updates concurrently across users, but strictly in arrival order for each user and each coupled pair.
+    Every update queues on the user it comes from and, if he/she is in a chat, on his/her partner: each key is a FIFO
+    of the updates waiting for it, and an update joins the FIFOs of all its keys at once, before waiting for any of
+    them. An update then only waits for updates that arrived before it, so two partners writing at the same time can
+    not deadlock, and updates of the same user or pair run one after the other in the order they arrived, while
+    updates of different pairs run in parallel, up to max_concurrent_updates at a time.
+    Updates waiting for their turn do not hold a worker slot: the semaphore of BaseUpdateProcessor only bounds the
+    updates held by the processor (max_pending_updates), the one limiting the updates being processed is taken once
+    the keys are. No update is ever dropped: accepts() tells when a user already has max_pending_per_user updates
+    queued, so that the webhook answers 503 and Telegram delivers the update again later (see webhook.py).
+    The partner is known only if the storage backend has it without I/O (StorageBackend.cached_partner_id): otherwise
+    the update queues on the user only, and is ordered with the other updates of the user but not with the ones of the
+    partner. With several worker processes the two partners may be on different workers, so the updates of a pair
+    are ordered only when both partners are on the same worker.
+    """
+
+    def __init__(self, max_concurrent_updates=256, max_pending_per_user=100, max_pending_updates=100000):
+        """
+        :param max_concurrent_updates: maximum number of updates processed at the same time
+        :param max_pending_per_user: number of queued updates of a single user above which accepts() refuses his/hers
+        :param max_pending_updates: maximum number of updates waiting or being processed, above it new updates wait
+        before being ordered (so it must be far above max_concurrent_updates)
+        """
+        super().__init__(max_pending_updates)
+        self.max_pending_per_user = max_pending_per_user
+        self._workers = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # key -> _KeyQueue of the updates holding or waiting for the key
+        self._key_queues = {}
+        # user key -> number of updates of the user waiting or being processed, and their total
+        self._queued = {}
+        self._pending = 0
+        # Updates refused by accepts()
+        self.throttled = 0
+
+    @property
+    def pending(self):
+        """
+        :return: number of updates waiting or being processed
+        """
+        return self._pending
+
+    @staticmethod
+    def _user_key(update):
+        user = update.effective_user or update.effective_chat
+        return None if user is None else str(user.id)
+
+    def accepts(self, update):
+        """
+        :param update: update about to be queued
+        :return: False if the user of the update already has max_pending_per_user updates waiting or being processed
+        """
+        if self._queued.get(self._user_key(update), 0) < self.max_pending_per_user:
+            return True
+        self.throttled += 1
+        return False
+
+    def _join(self, key):
+        # Queue on the key, return the future resolved once the update holds it
+        key_queue = self._key_queues.get(key)
+        if key_queue is None:
+            key_queue = self._key_queues[key] = _KeyQueue()
+        waiter = asyncio.get_running_loop().create_future()
+        if all(other.cancelled() for other in key_queue.waiters):
+            waiter.set_result(None)
+        key_queue.waiters.append(waiter)
+        return waiter
+
+    def _leave(self, key, waiter):
+        # Leave the queue of the key, and hand it over to the next update if this one held it
+        key_queue = self._key_queues[key]
+        key_queue.waiters.remove(waiter)
+        for other in key_queue.waiters:
+            if not other.cancelled():
+                if not other.done():
+                    other.set_result(None)
+                break
+        if not key_queue.waiters:
+            del self._key_queues[key]
+
+    async def do_process_update(self, update, coroutine):
+        # Wait for the turn of the user before taking a worker slot. Called in arrival order, and the update joins the
+        # queues of all its keys before its first await, so that they are granted in arrival order as well
+        user_key = self._user_key(update)
+        if user_key is None:
+            self._pending += 1
+            try:
+                async with self._workers:
+                    await coroutine
+            finally:
+                self._pending -= 1
+            return
+        keys = [user_key]
+        # The partner, only if known without I/O (e.g. from the session cache)
+        partner_id = storage.get_backend().cached_partner_id(user_key)
+        if partner_id is not None:
+            keys.append(partner_id)
+
+        waiters = [(key, self._join(key)) for key in keys]
+        self._queued[user_key] = self._queued.get(user_key, 0) + 1
+        self._pending += 1
+        try:
+            for _, waiter in waiters:
+                await waiter
+            async with self._workers:
+                await coroutine
+        finally:
+            for key, waiter in waiters:
+                self._leave(key, waiter)
+            self._queued[user_key] -= 1
+            if not self._queued[user_key]:
+                del self._queued[user_key]
+            self._pending -= 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,186 @@
+"""
+Housekeeping of the users, run periodically on the job queue of the application:
+- searches lasting longer than SEARCH_TIMEOUT_SECONDS are stopped, and the user is told so
+- chats where neither partner sent anything for PAIR_IDLE_TIMEOUT_SECONDS are closed, and both partners are told so
+- users not seen for ARCHIVE_AFTER_DAYS are moved to a cold table, and back if they return
+Every task works in batches of HOUSEKEEPING_BATCH_SIZE users, each one a separate storage call, so that the other
+writes are never queued behind a long transaction; the relay path only reads the storage.
+The time of the last update of each user is kept in memory, and written to the storage in batches by the sweeps.
+An archived user is inserted back by the handlers that miss his/her row (see bot.py), not on every update.
+"""
+import logging
+import time
+from collections import OrderedDict
+
+import async_db
+import metrics
+import settings
+from coalescer import coalescer
+from outbound import scheduler
+
+
+class Activity:
+    """
+    Time of the last update of each user, in memory
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        # user_id -> time.time() of his/her last update, least recently seen first
+        self._seen = OrderedDict()
+        # Users seen since the last call of take_unsaved
+        self._unsaved = {}
+
+    def __len__(self):
+        return len(self._seen)
+
+    def touch(self, user_id):
+        user_id, now = str(user_id), time.time()
+        self._seen[user_id] = now
+        self._seen.move_to_end(user_id)
+        self._unsaved[user_id] = now
+
+    def last_seen(self, user_id):
+        """
+        :param user_id: id of the user
+        :return: time of the last update of the user, the start of the bot if he/she has not been seen since
+        """
+        return self._seen.get(str(user_id), self.started)
+
+    def take_unsaved(self):
+        """
+        :return: dict user_id -> time of the last update, of the users seen since the previous call
+        """
+        unsaved, self._unsaved = self._unsaved, {}
+        return unsaved
+
+    def forget_before(self, before):
+        """
+        Forgets the users not seen since `before`, their last update is then considered older than that
+        :param before: time.time()
+        :return: None
+        """
+        self.started = max(self.started, before)
+        # The least recently seen users are first, so that only the forgotten ones are looked at
+        while self._seen and next(iter(self._seen.values())) < before:
+            self._seen.popitem(last=False)
+
+
+# Activity of the users of this process
+activity = Activity()
+
+
+async def touch_activity(update, context) -> None:
+    """
+    Handler recording the activity of the user of every update, before the other handlers
+    :param update: update received from the user
+    :param context: context of the bot
+    :return: None
+    """
+    user = update.effective_user
+    if user is not None:
+        activity.touch(user.id)
+
+
+async def _in_batches(task, call):
+    # Run call() until it processes less than a batch or the sweep has run enough batches, return the total processed
+    started = time.monotonic()
+    processed = 0
+    for _ in range(settings.HOUSEKEEPING_MAX_BATCHES):
+        count = await call()
+        processed += count
+        if count < settings.HOUSEKEEPING_BATCH_SIZE:
+            break
+    metrics.count_housekeeping(task, processed, time.monotonic() - started)
+    if processed:
+        logging.info("Housekeeping " + task + ": " + str(processed) + " users")
+    return processed
+
+
+async def expire_searches(bot):
+    async def batch():
+        expired = await async_db.expire_searches(settings.SEARCH_TIMEOUT_SECONDS, settings.HOUSEKEEPING_BATCH_SIZE)
+        for user_id in expired:
+            scheduler.notify(bot, user_id, text="🤖 No partner found for now, type /chat to search again.")
+        return len(expired)
+
+    return await _in_batches("expire_searches", batch)
+
+
+async def close_idle_pairs(bot):
+    # A pair is idle if neither partner sent anything for PAIR_IDLE_TIMEOUT_SECONDS
+    before = time.time() - settings.PAIR_IDLE_TIMEOUT_SECONDS
+    idle_pairs = [(user_id, partner_id) for user_id, partner_id in await async_db.coupled_pairs()
+                  if max(activity.last_seen(user_id), activity.last_seen(partner_id)) < before]
+
+    async def batch():
+        closed = 0
+        for user_id, partner_id in idle_pairs[:settings.HOUSEKEEPING_BATCH_SIZE]:
+            # Guarded by the user being still coupled: a chat closed or restarted in the meantime is left alone
+            result = await async_db.uncouple(user_id)
+            if not result.applied or result.partner_id != partner_id:
+                continue
+            closed += 1
+            coalescer.end_chat(user_id, partner_id)
+            for chat_id in (user_id, partner_id):
+                scheduler.notify(bot, chat_id, text="🤖 The chat has been closed after a long inactivity, type /chat "
+                                                    "to search for a new partner.")
+        del idle_pairs[:settings.HOUSEKEEPING_BATCH_SIZE]
+        return closed
+
+    return await _in_batches("close_idle_pairs", batch)
+
+
+async def archive_inactive_users():
+    # Save the activity first, so that no user seen recently is archived
+    unsaved = list(activity.take_unsaved().items())
+    for index in range(0, len(unsaved), settings.HOUSEKEEPING_BATCH_SIZE):
+        await async_db.touch(dict(unsaved[index:index + settings.HOUSEKEEPING_BATCH_SIZE]))
+
+    async def batch():
+        return await async_db.archive_inactive(settings.ARCHIVE_AFTER_DAYS * 24 * 60 * 60,
+                                               settings.HOUSEKEEPING_BATCH_SIZE)
+
+    return await _in_batches("archive_inactive_users", batch)
+
+
+async def sweep(context) -> None:
+    """
+    Job running the housekeeping tasks that are enabled in settings
+    :param context: context of the bot
+    :return: None
+    """
+    if settings.SEARCH_TIMEOUT_SECONDS is not None:
+        await expire_searches(context.bot)
+    if settings.PAIR_IDLE_TIMEOUT_SECONDS is not None:
+        await close_idle_pairs(context.bot)
+    if settings.ARCHIVE_AFTER_DAYS is not None:
+        await archive_inactive_users()
+    else:
+        # Nothing to save the activity for
+        activity.take_unsaved()
+    # The activity is only needed to find the idle pairs, the storage keeps the rest
+    if settings.PAIR_IDLE_TIMEOUT_SECONDS is not None:
+        activity.forget_before(time.time() - settings.PAIR_IDLE_TIMEOUT_SECONDS)
+    else:
+        activity.forget_before(time.time())
+
+
+def schedule(application):
+    """
+    Registers the activity handler and the periodic sweep on the application
+    :param application: the bot application
+    :return: None
+    """
+    if settings.HOUSEKEEPING_INTERVAL_SECONDS is None:
+        return
+    if application.job_queue is None:
+        logging.warning("python-telegram-bot[job-queue] is not installed, housekeeping is disabled")
+        return
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    # In a group of its own, so that it does not stop the conversation handler from handling the update
+    application.add_handler(TypeHandler(Update, touch_activity), group=-1)
+    application.job_queue.run_repeating(sweep, interval=settings.HOUSEKEEPING_INTERVAL_SECONDS,
+                                        first=settings.HOUSEKEEPING_INTERVAL_SECONDS)
@@ -0,0 +1,482 @@
+"""
+Stand-in key-value server speaking a subset of the Redis protocol (RESP), and a minimal client for it.
+It keeps everything in memory and serves one command at a time, so every command and every MULTI/EXEC block is
+atomic. It lets several bot processes share their state on a single machine without any outside service; the client
+works against a real Redis server as well.
+
+Usage: python kv_server.py [--host 127.0.0.1] [--port 6380]
+"""
+import argparse
+import asyncio
+import heapq
+import logging
+import socket
+import threading
+import time
+from collections import deque
+
+
+class KeyValueError(Exception):
+    pass
+
+
+def _encode(value):
+    # Encode a reply in RESP
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, bool):
+        return b":" + (b"1" if value else b"0") + b"\r\n"
+    if isinstance(value, int):
+        return b":" + str(value).encode() + b"\r\n"
+    if isinstance(value, KeyValueError):
+        return b"-ERR " + str(value).encode() + b"\r\n"
+    if isinstance(value, str):
+        return b"+" + value.encode() + b"\r\n"
+    if isinstance(value, bytes):
+        return b"$" + str(len(value)).encode() + b"\r\n" + value + b"\r\n"
+    if isinstance(value, _NullArray):
+        return b"*-1\r\n"
+    return b"*" + str(len(value)).encode() + b"\r\n" + b"".join(_encode(item) for item in value)
+
+
+class _NullArray:
+    pass
+
+
+_NULL_ARRAY = _NullArray()
+
+# Commands changing the key given as first argument, the transactions watching the key are aborted
+_WRITE_COMMANDS = {b"SET", b"INCRBY", b"HSET", b"HDEL", b"HINCRBY", b"RPUSH", b"LPOP", b"LREM", b"EXPIRE"}
+
+
+class _Watch:
+    __slots__ = ("keys", "dirty")
+
+    def __init__(self):
+        # Keys watched by a connection, and whether one of them has changed since
+        self.keys = set()
+        self.dirty = False
+
+
+class KeyValueServer:
+    """
+    Single-threaded in-memory store with strings, hashes and lists, optimistic transactions (WATCH/MULTI/EXEC) and
+    keys expiring after a time to live (EXPIRE)
+    """
+
+    def __init__(self, host="127.0.0.1", port=6380):
+        self.host = host
+        self.port = port
+        self._data = {}
+        # key -> _Watch of the connections watching it, as Redis does: only the keys being watched are tracked
+        self._watchers = {}
+        # key -> time.monotonic() it expires at, and a heap of (time, key) to remove them in order, with the time of
+        # the live entry of each key in _expiry_queued (the other entries of the key are stale). An entry whose key
+        # expires later than the entry is pushed again when popped, so that refreshing a time to live does not grow
+        # the heap
+        self._expires = {}
+        self._expiry_order = []
+        self._expiry_queued = {}
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def start_in_thread(self):
+        """
+        Runs the server on its own event loop in a daemon thread, e.g. next to a bot process or a load test
+        :return: the port the server listens on
+        """
+        started = threading.Event()
+
+        def run():
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(self.start())
+            started.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, name="kv-server", daemon=True).start()
+        started.wait()
+        return self.port
+
+    async def _handle_connection(self, reader, writer):
+        # Per connection state: watched keys, commands queued after MULTI (None outside a transaction)
+        watch = _Watch()
+        queued = None
+        try:
+            while True:
+                command = await _read_command(reader)
+                if command is None:
+                    break
+                self._expire(time.monotonic())
+                name = command[0].upper()
+                if name == b"MULTI":
+                    queued = []
+                    reply = "OK"
+                elif name == b"EXEC":
+                    if queued is None:
+                        reply = KeyValueError("EXEC without MULTI")
+                    elif watch.dirty:
+                        reply = _NULL_ARRAY
+                    else:
+                        reply = [self._execute(queued_command) for queued_command in queued]
+                    queued = None
+                    self._unwatch(watch)
+                elif name == b"DISCARD":
+                    queued = None
+                    self._unwatch(watch)
+                    reply = "OK"
+                elif name == b"WATCH":
+                    for key in command[1:]:
+                        watch.keys.add(key)
+                        self._watchers.setdefault(key, set()).add(watch)
+                    reply = "OK"
+                elif name == b"UNWATCH":
+                    self._unwatch(watch)
+                    reply = "OK"
+                elif queued is not None:
+                    queued.append(command)
+                    reply = "QUEUED"
+                else:
+                    reply = self._execute(command)
+                writer.write(_encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._unwatch(watch)
+            writer.close()
+
+    def _unwatch(self, watch):
+        for key in watch.keys:
+            watchers = self._watchers[key]
+            watchers.discard(watch)
+            if not watchers:
+                del self._watchers[key]
+        watch.keys.clear()
+        watch.dirty = False
+
+    def _touch(self, key):
+        # Abort the transactions watching the key
+        for watch in self._watchers.get(key, ()):
+            watch.dirty = True
+
+    def _execute(self, command):
+        name = command[0].upper()
+        args = command[1:]
+        handler = getattr(self, "_cmd_" + name.decode(errors="replace").lower(), None)
+        if handler is None:
+            return KeyValueError("unknown command '" + name.decode(errors="replace") + "'")
+        try:
+            if name in _WRITE_COMMANDS and args:
+                self._touch(args[0])
+            return handler(*args)
+        except (TypeError, ValueError) as e:
+            return KeyValueError(str(e))
+
+    def _expire(self, now):
+        # Remove the keys whose time to live is over, before any command sees them
+        while self._expiry_order and self._expiry_order[0][0] <= now:
+            queued, key = heapq.heappop(self._expiry_order)
+            if self._expiry_queued.get(key) != queued:
+                continue
+            del self._expiry_queued[key]
+            expires = self._expires.get(key)
+            if expires is None:
+                # Deleted in the meantime
+                continue
+            if expires > now:
+                heapq.heappush(self._expiry_order, (expires, key))
+                self._expiry_queued[key] = expires
+            else:
+                self._remove(key)
+                self._touch(key)
+
+    def _remove(self, key):
+        # Remove the key and its time to live, return True if it existed
+        self._expires.pop(key, None)
+        return self._data.pop(key, None) is not None
+
+    def _get(self, key, kind):
+        value = self._data.get(key)
+        if value is not None and not isinstance(value, kind):
+            raise ValueError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def _cmd_ping(self):
+        return "PONG"
+
+    def _cmd_flushdb(self):
+        for key in self._data:
+            self._touch(key)
+        self._data.clear()
+        self._expires.clear()
+        self._expiry_order.clear()
+        self._expiry_queued.clear()
+        return "OK"
+
+    def _cmd_dbsize(self):
+        return len(self._data)
+
+    def _cmd_get(self, key):
+        return self._get(key, bytes)
+
+    def _cmd_set(self, key, value):
+        # As in Redis, SET discards the time to live of the key
+        self._expires.pop(key, None)
+        self._data[key] = value
+        return "OK"
+
+    def _cmd_del(self, *keys):
+        deleted = 0
+        for key in keys:
+            if self._remove(key):
+                deleted += 1
+            self._touch(key)
+        return deleted
+
+    def _cmd_exists(self, key):
+        return int(key in self._data)
+
+    def _cmd_expire(self, key, seconds):
+        # Only the keys that exist get a time to live, a new one replaces the previous one
+        if key not in self._data:
+            return 0
+        expires = time.monotonic() + int(seconds)
+        self._expires[key] = expires
+        if expires < self._expiry_queued.get(key, float("inf")):
+            heapq.heappush(self._expiry_order, (expires, key))
+            self._expiry_queued[key] = expires
+        return 1
+
+    def _cmd_ttl(self, key):
+        if key not in self._data:
+            return -2
+        if key not in self._expires:
+            return -1
+        return max(0, round(self._expires[key] - time.monotonic()))
+
+    def _cmd_incrby(self, key, increment):
+        value = int(self._get(key, bytes) or 0) + int(increment)
+        self._data[key] = str(value).encode()
+        return value
+
+    def _cmd_hset(self, key, *pairs):
+        if not pairs or len(pairs) % 2:
+            raise ValueError("wrong number of arguments for 'hset' command")
+        hash_ = self._get(key, dict)
+        if hash_ is None:
+            hash_ = self._data[key] = {}
+        added = 0
+        for field, value in zip(pairs[::2], pairs[1::2]):
+            added += field not in hash_
+            hash_[field] = value
+        return added
+
+    def _cmd_hdel(self, key, *fields):
+        hash_ = self._get(key, dict) or {}
+        deleted = sum(hash_.pop(field, None) is not None for field in fields)
+        if key in self._data and not hash_:
+            self._remove(key)
+        return deleted
+
+    def _cmd_hget(self, key, field):
+        return (self._get(key, dict) or {}).get(field)
+
+    def _cmd_hgetall(self, key):
+        return [item for pair in (self._get(key, dict) or {}).items() for item in pair]
+
+    def _cmd_hincrby(self, key, field, increment):
+        hash_ = self._get(key, dict)
+        if hash_ is None:
+            hash_ = self._data[key] = {}
+        value = int(hash_.get(field, 0)) + int(increment)
+        hash_[field] = str(value).encode()
+        return value
+
+    def _cmd_rpush(self, key, *values):
+        list_ = self._get(key, deque)
+        if list_ is None:
+            list_ = self._data[key] = deque()
+        list_.extend(values)
+        return len(list_)
+
+    def _cmd_lpop(self, key):
+        list_ = self._get(key, deque)
+        if not list_:
+            return None
+        value = list_.popleft()
+        if not list_:
+            self._remove(key)
+        return value
+
+    def _cmd_lrem(self, key, count, value):
+        # Only count=0 (remove all the occurrences) and count>0 (the first `count` ones) are supported
+        list_ = self._get(key, deque)
+        if not list_:
+            return 0
+        count = int(count)
+        kept = deque()
+        removed = 0
+        for item in list_:
+            if item == value and (count <= 0 or removed < count):
+                removed += 1
+            else:
+                kept.append(item)
+        if kept:
+            self._data[key] = kept
+        else:
+            self._remove(key)
+        return removed
+
+    def _cmd_llen(self, key):
+        return len(self._get(key, deque) or ())
+
+    def _cmd_lrange(self, key, start, stop):
+        items = list(self._get(key, deque) or ())
+        start, stop = int(start), int(stop)
+        return items[start:(None if stop == -1 else stop + 1)]
+
+
+async def _read_command(reader):
+    # Read an array of bulk strings, None on end of stream
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        # Inline command
+        return line.split()
+    command = []
+    for _ in range(int(line[1:])):
+        length = int((await reader.readline())[1:])
+        command.append((await reader.readexactly(length + 2))[:-2])
+    return command
+
+
+class KeyValueClient:
+    """
+    Minimal blocking RESP client. Each thread gets its own connection, so that the WATCH state of a transaction is
+    never shared
+    """
+
+    def __init__(self, host="127.0.0.1", port=6380, timeout=10.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = self._local.conn = (sock, sock.makefile("rb"))
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+            self._local.conn = None
+
+    @staticmethod
+    def _pack(args):
+        parts = [b"*" + str(len(args)).encode() + b"\r\n"]
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode()
+            parts.append(b"$" + str(len(arg)).encode() + b"\r\n" + arg + b"\r\n")
+        return b"".join(parts)
+
+    def _read_reply(self, file):
+        line = file.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the key-value server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            return KeyValueError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            return None if length == -1 else file.read(length + 2)[:-2].decode()
+        if kind == b"*":
+            length = int(rest)
+            return None if length == -1 else [self._read_reply(file) for _ in range(length)]
+        raise KeyValueError("Unexpected reply " + repr(line))
+
+    def _send(self, commands):
+        sock, file = self._connection()
+        try:
+            sock.sendall(b"".join(self._pack(command) for command in commands))
+            return [self._read_reply(file) for _ in commands]
+        except (OSError, ConnectionError):
+            # Never reuse a connection in an unknown state
+            self.close()
+            raise
+
+    def execute(self, *args):
+        """
+        Runs a single command
+        :param args: name and arguments of the command
+        :return: the reply, decoded as str/int/list/None
+        """
+        reply = self._send([args])[0]
+        if isinstance(reply, KeyValueError):
+            raise reply
+        return reply
+
+    def pipeline(self, commands):
+        """
+        Sends several commands at once, paying a single round trip
+        :param commands: list of tuples (name, arguments...)
+        :return: list of the replies
+        """
+        replies = self._send(commands)
+        for reply in replies:
+            if isinstance(reply, KeyValueError):
+                raise reply
+        return replies
+
+    def multi_exec(self, commands):
+        """
+        Runs the commands atomically in a MULTI/EXEC block, in a single round trip
+        :param commands: list of tuples (name, arguments...)
+        :return: list of the replies, None if a watched key has changed (nothing has been run)
+        """
+        replies = self._send([("MULTI",)] + list(commands) + [("EXEC",)])
+        for reply in replies[:-1]:
+            if isinstance(reply, KeyValueError):
+                raise reply
+        return replies[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in key-value server (subset of the Redis protocol)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6380)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    async def serve():
+        server = KeyValueServer(args.host, args.port)
+        await server.start()
+        logging.info("Key-value server listening on " + args.host + ":" + str(server.port))
+        await asyncio.Event().wait()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,661 @@
+"""
+Load-testing harness of the bot.
+
+Runs the handlers of bot.py against a local stand-in of the Telegram Bot API and simulates thousands of concurrent
+users running realistic scripts (/start, /chat, message bursts, replies, /newchat, /exit, blocking the bot).
+Reports the throughput and the p50/p95/p99 latency of each handler and of the end-to-end relay (from the moment a
+message is received to the moment its copy reaches the Bot API) as JSON, so that results can be compared across commits.
+The updates are passed to the update processor of the bot directly, or go through the same path as in production:
+posted to the webhook server of webhook.py, or fetched with getUpdates by long polling (--ingestion). With the latter
+two the latency of each update only measures its delivery to the bot, compare the end-to-end relay instead.
+
+Usage:
+    python load_test.py --users 2000 --messages 20 --output results.json
+    python load_test.py --users 2000 --messages 20 --ingestion webhook
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+from urllib.parse import parse_qs, urlsplit
+
+TOKEN = "123456:LOAD-TEST"
+WEBHOOK_SECRET_TOKEN = "LOAD-TEST-SECRET"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "ChatBot", "username": "load_test_bot"}
+
+
+def percentile(values, p):
+    """
+    :param values: sorted list of values
+    :param p: percentile, between 0 and 100
+    :return: the nearest-rank percentile of the values, None if there are none
+    """
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(latencies, duration):
+    """
+    :param latencies: list of latencies in seconds
+    :param duration: duration of the run in seconds
+    :return: dict with count, throughput and latency percentiles (in milliseconds)
+    """
+    values = sorted(latencies)
+    result = {"count": len(values), "throughput_per_s": round(len(values) / duration, 2) if duration else None}
+    for name, p in (("p50_ms", 50), ("p95_ms", 95), ("p99_ms", 99)):
+        value = percentile(values, p)
+        result[name] = None if value is None else round(value * 1000, 3)
+    result["mean_ms"] = round(sum(values) / len(values) * 1000, 3) if values else None
+    return result
+
+
+class FakeBotAPI:
+    """
+    Stand-in for the Telegram Bot API, serving the methods used by the bot over HTTP/1.1 with keep-alive.
+    Optionally enforces the flood limits of Telegram (per chat and global), answering 429 with retry_after like the
+    real API does.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, enforce_limits=False, chat_limit=(1, 3), global_limit=(30, 30)):
+        """
+        :param host: address to listen on
+        :param port: port to listen on, a free one if 0
+        :param enforce_limits: whether to answer 429 above the flood limits
+        :param chat_limit: (messages per second, burst) allowed to a single chat
+        :param global_limit: (messages per second, burst) allowed across all the chats
+        """
+        self.host = host
+        self.port = port
+        self.enforce_limits = enforce_limits
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.calls = Counter()
+        self.rate_limited = 0
+        # chat_id -> last message id used in the chat, shared by the users and the bot as in Telegram
+        self._message_ids = defaultdict(int)
+        # (chat_id, message_id) -> time the simulated user sent the message, to measure the end-to-end relay
+        self.sent_at = {}
+        self.relay_latencies = []
+        # (chat_id, message_id) -> (partner chat_id, id of the copy) and the other way round, and (chat_id, message_id)
+        # of a reply -> id of the replied message, to check that the copies of the replies reply to the counterpart of
+        # the replied message
+        self.copies = {}
+        self.originals = {}
+        self.replies = {}
+        self.replies_threaded = 0
+        self.replies_unthreaded = 0
+        # Same, only for the replies to a copy of a message of the partner
+        self.partner_replies_threaded = 0
+        self.partner_replies_unthreaded = 0
+        # chat_id -> ids of the copies received in the chat, oldest first
+        self.received = defaultdict(list)
+        # chat_id -> event set when the bot tells the chat that it has been paired
+        self.paired_events = defaultdict(asyncio.Event)
+        # Updates waiting to be fetched with getUpdates, until the bot confirms them with a greater offset
+        self._updates = deque()
+        self._updates_added = asyncio.Event()
+        self._buckets = {}
+        self._server = None
+
+    def next_message_id(self, chat_id):
+        self._message_ids[chat_id] += 1
+        return self._message_ids[chat_id]
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    @property
+    def base_url(self):
+        return "http://" + self.host + ":" + str(self.port) + "/bot"
+
+    @property
+    def pending_updates(self):
+        """
+        :return: number of updates not yet fetched and confirmed by the bot
+        """
+        return len(self._updates)
+
+    def push_update(self, data):
+        """
+        Queues an update for the bot to fetch with getUpdates, as Telegram does in long polling mode
+        :param data: the update, as a dict
+        :return: None
+        """
+        self._updates.append(data)
+        self._updates_added.set()
+
+    async def _get_updates(self, params):
+        # Long polling: the updates before the offset are confirmed, wait up to timeout seconds if there are no others
+        offset = int(params.get("offset") or 0)
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        if not self._updates:
+            self._updates_added.clear()
+            try:
+                await asyncio.wait_for(self._updates_added.wait(), timeout=float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        limit = int(params.get("limit") or 100)
+        return 200, {"ok": True, "result": list(itertools.islice(self._updates, limit))}
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", "0"))
+                body = await reader.readexactly(length) if length else b""
+                method = request_line.split(" ")[1].rsplit("/", 1)[-1]
+                params = self._parse_body(headers, body)
+                if method == "getUpdates":
+                    self.calls[method] += 1
+                    status, payload = await self._get_updates(params)
+                else:
+                    status, payload = self._dispatch(method, params)
+                data = json.dumps(payload).encode()
+                writer.write(b"HTTP/1.1 " + str(status).encode() + b" OK\r\nContent-Type: application/json\r\n"
+                             b"Content-Length: " + str(len(data)).encode() + b"\r\n\r\n" + data)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _parse_body(headers, body):
+        if not body:
+            return {}
+        if headers.get("content-type", "").startswith("application/json"):
+            return json.loads(body)
+        # python-telegram-bot sends form encoded parameters, with JSON encoded values
+        params = {}
+        for name, values in parse_qs(body.decode(), keep_blank_values=True).items():
+            try:
+                params[name] = json.loads(values[0])
+            except ValueError:
+                params[name] = values[0]
+        return params
+
+    def _limited(self, chat_id):
+        # Token buckets mirroring the flood limits of Telegram, return the seconds to wait or 0
+        now = time.monotonic()
+        refilled = []
+        for key, (rate, burst) in ((("chat", chat_id), self.chat_limit), (("global",), self.global_limit)):
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens < 1:
+                return (1 - tokens) / rate
+            refilled.append((key, tokens))
+        for key, tokens in refilled:
+            self._buckets[key] = (tokens - 1, now)
+        return 0
+
+    def _dispatch(self, method, params):
+        self.calls[method] += 1
+        chat_id = params.get("chat_id")
+        if method in ("sendMessage", "copyMessage", "copyMessages") and self.enforce_limits:
+            wait = self._limited(chat_id)
+            if wait:
+                self.rate_limited += 1
+                retry_after = max(1, int(wait + 0.999))
+                return 429, {"ok": False, "error_code": 429,
+                             "description": "Too Many Requests: retry after " + str(retry_after),
+                             "parameters": {"retry_after": retry_after}}
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT_USER}
+        if method == "sendMessage":
+            text = params.get("text", "")
+            if "paired" in text:
+                self.paired_events[int(chat_id)].set()
+            return 200, {"ok": True, "result": {"message_id": self.next_message_id(chat_id), "date": int(time.time()),
+                                                "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER,
+                                                "text": text}}
+        if method == "copyMessage":
+            copy_id = self._record_relay(params["from_chat_id"], params["message_id"], chat_id,
+                                         (params.get("reply_parameters") or {}).get("message_id"))
+            return 200, {"ok": True, "result": {"message_id": copy_id}}
+        if method == "copyMessages":
+            return 200, {"ok": True, "result": [{"message_id": self._record_relay(params["from_chat_id"], message_id,
+                                                                                  chat_id)}
+                                                for message_id in params["message_ids"]]}
+        # setWebhook, deleteWebhook, ...
+        return 200, {"ok": True, "result": True}
+
+    def _record_relay(self, from_chat_id, message_id, chat_id, reply_to_message_id=None):
+        # Return the id of the copy
+        key = (int(from_chat_id), int(message_id))
+        sent_at = self.sent_at.pop(key, None)
+        if sent_at is not None:
+            self.relay_latencies.append(time.monotonic() - sent_at)
+        replied = self.replies.pop(key, None)
+        if replied is not None:
+            replied = (key[0], replied)
+            threaded = (self.copies.get(replied) or self.originals.get(replied)) == (int(chat_id), reply_to_message_id)
+            self.replies_threaded += threaded
+            self.replies_unthreaded += not threaded
+            if replied in self.originals:
+                self.partner_replies_threaded += threaded
+                self.partner_replies_unthreaded += not threaded
+        copy_id = self.next_message_id(chat_id)
+        self.copies[key] = (int(chat_id), copy_id)
+        self.originals[(int(chat_id), copy_id)] = key
+        self.received[int(chat_id)].append(copy_id)
+        return copy_id
+
+
+class WebhookClient:
+    """
+    Posts the updates to the webhook server of the bot as Telegram does: over a few keep-alive connections, with the
+    secret token, and again after Retry-After seconds when the bot answers 503
+    """
+
+    def __init__(self, url, secret_token=None, connections=40):
+        """
+        :param url: URL of the webhook server of the bot
+        :param secret_token: value of the X-Telegram-Bot-Api-Secret-Token header
+        :param connections: maximum number of connections open at the same time (max_connections of setWebhook)
+        """
+        url = urlsplit(url)
+        self.host = url.hostname
+        self.port = url.port
+        self.path = url.path or "/"
+        self.secret_token = secret_token
+        self.connections = connections
+        self.retried = 0
+        self._idle = asyncio.Queue()
+        self._open = 0
+
+    async def _connection(self):
+        if self._idle.empty() and self._open < self.connections:
+            self._open += 1
+            try:
+                return await asyncio.open_connection(self.host, self.port)
+            except OSError:
+                self._open -= 1
+                raise
+        return await self._idle.get()
+
+    async def post(self, data):
+        """
+        :param data: the update, as a dict
+        :return: HTTP status of the response, other than 503
+        """
+        body = json.dumps(data).encode()
+        head = ("POST " + self.path + " HTTP/1.1\r\nHost: " + self.host + "\r\nContent-Type: application/json\r\n"
+                "Content-Length: " + str(len(body)) + "\r\n")
+        if self.secret_token is not None:
+            head += "X-Telegram-Bot-Api-Secret-Token: " + self.secret_token + "\r\n"
+        request = (head + "\r\n").encode("latin-1") + body
+        while True:
+            reader, writer = await self._connection()
+            try:
+                writer.write(request)
+                await writer.drain()
+                response = await reader.readuntil(b"\r\n\r\n")
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                self._open -= 1
+                raise
+            status_line, *header_lines = response.decode("latin-1").split("\r\n")
+            headers = dict(line.lower().split(": ", 1) for line in header_lines if ": " in line)
+            if headers.get("connection") == "close":
+                writer.close()
+                self._open -= 1
+            else:
+                self._idle.put_nowait((reader, writer))
+            status = int(status_line.split(" ")[1])
+            if status != 503:
+                return status
+            self.retried += 1
+            await asyncio.sleep(float(headers.get("retry-after", 1)))
+
+    async def close(self):
+        while not self._idle.empty():
+            _, writer = self._idle.get_nowait()
+            writer.close()
+        self._open = 0
+
+
+class SimulatedUser:
+    """
+    A user running a random but realistic script against the bot
+    """
+
+    def __init__(self, harness, user_id, rng):
+        self.harness = harness
+        self.user_id = user_id
+        self.rng = rng
+        # Ids of the messages sent by the user, to reply to them as to the copies received from the partners
+        self.sent_message_ids = []
+
+    def _user(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": "User" + str(self.user_id)}
+
+    def _message(self, text, reply_to=None, media_group_id=None):
+        api = self.harness.api
+        message = {"message_id": api.next_message_id(self.user_id), "date": int(time.time()),
+                   "chat": {"id": self.user_id, "type": "private"}, "from": self._user()}
+        if media_group_id is None:
+            message["text"] = text
+        else:
+            message.update(caption=text, media_group_id=media_group_id,
+                           photo=[{"file_id": "photo", "file_unique_id": "photo", "width": 1, "height": 1}])
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if reply_to is not None:
+            # The copies received from the partner are sent by the bot
+            sender = BOT_USER if (self.user_id, reply_to) in api.originals else self._user()
+            message["reply_to_message"] = {"message_id": reply_to, "date": int(time.time()), "text": "...",
+                                           "chat": {"id": self.user_id, "type": "private"}, "from": sender}
+        return message
+
+    async def command(self, name):
+        await self.harness.send(name, {"message": self._message("/" + name)})
+
+    async def text(self):
+        reply_to = None
+        # One of the last 10 messages of the chat, sent by the user or copied from the partner
+        recent = sorted(self.sent_message_ids[-10:] + self.harness.api.received[self.user_id][-10:])[-10:]
+        if recent and self.rng.random() < self.harness.reply_ratio:
+            reply_to = self.rng.choice(recent)
+        message = self._message("hello " + str(self.rng.random()), reply_to)
+        self.sent_message_ids.append(message["message_id"])
+        if reply_to is not None:
+            self.harness.api.replies[(self.user_id, message["message_id"])] = reply_to
+        self.harness.api.sent_at[(self.user_id, message["message_id"])] = time.monotonic()
+        await self.harness.send("reply" if reply_to else "message", {"message": message})
+
+    async def album(self, size):
+        # The items of an album arrive as separate updates sharing a media_group_id
+        media_group_id = str(self.user_id) + "-" + str(len(self.sent_message_ids))
+        for _ in range(size):
+            message = self._message("photo " + str(self.rng.random()), media_group_id=media_group_id)
+            self.sent_message_ids.append(message["message_id"])
+            self.harness.api.sent_at[(self.user_id, message["message_id"])] = time.monotonic()
+            await self.harness.send("album", {"message": message})
+
+    async def block(self):
+        member = {"chat": {"id": self.user_id, "type": "private"}, "from": self._user(), "date": int(time.time()),
+                  "old_chat_member": {"user": BOT_USER, "status": "member"},
+                  "new_chat_member": {"user": BOT_USER, "status": "kicked", "until_date": 0}}
+        await self.harness.send("block", {"my_chat_member": member})
+
+    async def wait_paired(self):
+        event = self.harness.api.paired_events[self.user_id]
+        try:
+            await asyncio.wait_for(event.wait(), timeout=self.harness.pairing_timeout)
+        except asyncio.TimeoutError:
+            self.harness.pairing_timeouts += 1
+        event.clear()
+
+    async def chat(self):
+        for _ in range(self.harness.messages // self.harness.burst):
+            if self.rng.random() < self.harness.album_ratio:
+                await self.album(self.harness.burst)
+                continue
+            for _ in range(self.harness.burst):
+                await self.text()
+            await asyncio.sleep(self.rng.expovariate(1 / self.harness.think_time))
+
+    async def run(self):
+        # Users do not all arrive at the same moment
+        await asyncio.sleep(self.rng.random() * self.harness.ramp_up)
+        await self.command("start")
+        await self.command("chat")
+        await self.wait_paired()
+        await self.chat()
+        if self.rng.random() < self.harness.newchat_ratio:
+            await self.command("newchat")
+            await self.wait_paired()
+            await self.chat()
+        ending = self.rng.random()
+        if ending < self.harness.block_ratio:
+            await self.block()
+        else:
+            await self.command("exit")
+
+
+class LoadTest:
+    """
+    Runs the simulated users against the handlers of bot.py and collects the measures
+    """
+
+    def __init__(self, users=1000, messages=20, burst=5, think_time=0.2, ramp_up=2.0, reply_ratio=0.1,
+                 newchat_ratio=0.2, block_ratio=0.1, pairing_timeout=10.0, enforce_limits=False, chat_rate=20,
+                 global_rate=1000, seed=0, backend="sqlite", workers=0, album_ratio=0.0, coalesce_window=None,
+                 ingestion="direct"):
+        self.users = users
+        self.messages = messages
+        self.burst = burst
+        self.think_time = think_time
+        self.ramp_up = ramp_up
+        self.reply_ratio = reply_ratio
+        self.newchat_ratio = newchat_ratio
+        self.block_ratio = block_ratio
+        self.pairing_timeout = pairing_timeout
+        self.enforce_limits = enforce_limits
+        self.chat_rate = chat_rate
+        self.global_rate = global_rate
+        self.seed = seed
+        self.backend = backend
+        self.workers = workers
+        self.album_ratio = album_ratio
+        self.coalesce_window = coalesce_window
+        self.ingestion = ingestion
+        self.api = None
+        self.webhook_client = None
+        self.application = None
+        self.latencies = defaultdict(list)
+        self.pairing_timeouts = 0
+        self.errors = 0
+        self._update_ids = itertools.count(1)
+
+    async def send(self, kind, data):
+        from telegram import Update
+
+        data = dict(data, update_id=next(self._update_ids))
+        if self.ingestion == "polling":
+            # Fetched by the updater of the application, the delivery is measured by the end-to-end relay
+            self.api.push_update(data)
+            return
+        update = Update.de_json(data, self.application.bot) if self.ingestion == "direct" else None
+        started = time.monotonic()
+        try:
+            if self.ingestion == "webhook":
+                if await self.webhook_client.post(data) != 200:
+                    self.errors += 1
+            else:
+                # Go through the update processor, as the updates fetched by the application do. In sharded mode the
+                # application is the router, so this only measures the forwarding to the worker
+                await self.application.update_processor.process_update(update,
+                                                                       self.application.process_update(update))
+        except Exception:
+            self.errors += 1
+        self.latencies[kind].append(time.monotonic() - started)
+
+    async def _count_error(self, update, context):
+        # Error handler of the application: the exceptions of the handlers do not reach send()
+        self.errors += 1
+
+    async def run(self):
+        """
+        Runs the load test
+        :return: dict with the results
+        """
+        # The bot modules are imported here, after the storage has been pointed to a temporary database or server
+        import outbound
+        import storage
+        if self.backend == "sqlite":
+            work_dir = tempfile.mkdtemp(prefix="chatbot-load-test-")
+            backend = storage.configure("sqlite", database=os.path.join(work_dir, "chatbot_database.db"))
+        elif self.backend == "kv":
+            from kv_server import KeyValueServer
+            backend = storage.configure("kv", port=KeyValueServer(port=0).start_in_thread())
+        else:
+            backend = storage.configure(self.backend)
+        import bot
+        from coalescer import coalescer
+
+        if self.coalesce_window is not None:
+            coalescer.window = self.coalesce_window
+        backend.create()
+        backend.start()
+        outbound.scheduler.set_rates(global_rate=self.global_rate, global_burst=self.global_rate,
+                                     chat_rate=self.chat_rate, chat_burst=self.chat_rate)
+
+        self.api = FakeBotAPI(enforce_limits=self.enforce_limits)
+        await self.api.start()
+        cluster = None
+        if self.workers:
+            from cluster import Cluster
+            cluster = Cluster(self.workers, TOKEN, base_url=self.api.base_url,
+                              rates={"global_rate": self.global_rate, "global_burst": self.global_rate,
+                                     "chat_rate": self.chat_rate, "chat_burst": self.chat_rate})
+            # Spawning the processes blocks, let the stand-in API answer in the meantime
+            await asyncio.get_running_loop().run_in_executor(None, cluster.start)
+            self.application = cluster.build_router()
+        else:
+            self.application = bot.build_application(token=TOKEN, base_url=self.api.base_url)
+        self.application.add_error_handler(self._count_error)
+        rng = random.Random(self.seed)
+        users = [SimulatedUser(self, 1000000 + i, random.Random(rng.random())) for i in range(self.users)]
+
+        async with self.application:
+            webhook_server = None
+            if self.ingestion != "direct":
+                # The application takes the updates from its update queue, as in production
+                await self.application.start()
+            if self.ingestion == "webhook":
+                from webhook import WebhookServer
+                webhook_server = WebhookServer(self.application, path="/telegram", listen="127.0.0.1", port=0,
+                                               secret_token=WEBHOOK_SECRET_TOKEN)
+                await webhook_server.start()
+                self.webhook_client = WebhookClient("http://127.0.0.1:" + str(webhook_server.port) + "/telegram",
+                                                    secret_token=WEBHOOK_SECRET_TOKEN)
+            elif self.ingestion == "polling":
+                await self.application.updater.start_polling(timeout=1)
+            started = time.monotonic()
+            await asyncio.gather(*(user.run() for user in users))
+            if self.ingestion == "polling":
+                # Let the updater fetch the last updates
+                while self.api.pending_updates:
+                    await asyncio.sleep(0.01)
+                await self.application.updater.stop()
+            elif webhook_server is not None:
+                await self.webhook_client.close()
+                await webhook_server.stop()
+            if self.ingestion != "direct":
+                # Handles the updates still in the update queue
+                await self.application.stop()
+            if cluster is not None:
+                # The workers handle what has been forwarded and deliver their outbound calls before exiting
+                await asyncio.get_running_loop().run_in_executor(None, cluster.stop)
+            else:
+                # Let the outbound scheduler deliver what is still queued
+                await outbound.scheduler.stop(timeout=60)
+            duration = time.monotonic() - started
+        await self.api.stop()
+
+        all_latencies = [latency for values in self.latencies.values() for latency in values]
+        return {
+            "commit": _git_commit(),
+            "timestamp": int(time.time()),
+            "parameters": {"users": self.users, "messages": self.messages, "burst": self.burst,
+                           "think_time": self.think_time, "reply_ratio": self.reply_ratio,
+                           "newchat_ratio": self.newchat_ratio, "block_ratio": self.block_ratio,
+                           "enforce_limits": self.enforce_limits, "chat_rate": self.chat_rate,
+                           "global_rate": self.global_rate, "seed": self.seed, "backend": self.backend,
+                           "workers": self.workers, "album_ratio": self.album_ratio,
+                           "coalesce_window": coalescer.window, "ingestion": self.ingestion},
+            "duration_s": round(duration, 3),
+            "updates": summarize(all_latencies, duration),
+            "handlers": {kind: summarize(values, duration) for kind, values in sorted(self.latencies.items())},
+            "relay_end_to_end": summarize(self.api.relay_latencies, duration),
+            "api_calls": dict(self.api.calls),
+            "api_rate_limited": self.api.rate_limited,
+            "replies_threaded": self.api.replies_threaded,
+            "replies_unthreaded": self.api.replies_unthreaded,
+            "partner_replies_threaded": self.api.partner_replies_threaded,
+            "partner_replies_unthreaded": self.api.partner_replies_unthreaded,
+            "handler_errors": self.errors,
+            "pairing_timeouts": self.pairing_timeouts,
+            "webhook_retries": self.webhook_client.retried if self.webhook_client is not None else None,
+        }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the bot against a stand-in Telegram Bot API")
+    parser.add_argument("--users", type=int, default=1000, help="number of simulated users")
+    parser.add_argument("--messages", type=int, default=20, help="messages sent by each user in each chat")
+    parser.add_argument("--burst", type=int, default=5, help="messages sent back to back")
+    parser.add_argument("--think-time", type=float, default=0.2, help="mean pause between bursts, in seconds")
+    parser.add_argument("--ramp-up", type=float, default=2.0, help="seconds over which the users arrive")
+    parser.add_argument("--reply-ratio", type=float, default=0.1, help="share of messages that are replies")
+    parser.add_argument("--newchat-ratio", type=float, default=0.2, help="share of users that run /newchat")
+    parser.add_argument("--block-ratio", type=float, default=0.1, help="share of users that block the bot")
+    parser.add_argument("--enforce-limits", action="store_true",
+                        help="make the stand-in API answer 429 above the Telegram flood limits")
+    parser.add_argument("--chat-rate", type=float, default=20,
+                        help="messages per second the bot sends to a single chat")
+    parser.add_argument("--global-rate", type=float, default=1000,
+                        help="messages per second the bot sends across all the chats")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the simulated users")
+    parser.add_argument("--backend", default="sqlite", choices=("sqlite", "memory", "kv"),
+                        help="storage backend of the bot (kv runs a stand-in key-value server in the process)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run the bot as a router and this many worker processes (see cluster.py), 0 to run it "
+                             "in the load test process")
+    parser.add_argument("--album-ratio", type=float, default=0.0,
+                        help="share of the bursts sent as an album (a single media group)")
+    parser.add_argument("--coalesce-window", type=float,
+                        help="seconds within which the messages of a user are copied together, 0 to copy them one by "
+                             "one (RELAY_COALESCE_SECONDS if omitted, not applied to the workers)")
+    parser.add_argument("--ingestion", default="direct", choices=("direct", "webhook", "polling"),
+                        help="how the updates reach the bot: passed to its update processor, posted to its webhook "
+                             "server, or fetched by long polling from the stand-in API")
+    parser.add_argument("--output", help="file to write the JSON results to, stdout if omitted")
+    args = parser.parse_args()
+
+    load_test = LoadTest(users=args.users, messages=args.messages, burst=args.burst, think_time=args.think_time,
+                         ramp_up=args.ramp_up, reply_ratio=args.reply_ratio, newchat_ratio=args.newchat_ratio,
+                         block_ratio=args.block_ratio, enforce_limits=args.enforce_limits, chat_rate=args.chat_rate,
+                         global_rate=args.global_rate, seed=args.seed, backend=args.backend,
+                         workers=args.workers, album_ratio=args.album_ratio, coalesce_window=args.coalesce_window,
+                         ingestion=args.ingestion)
+    results = json.dumps(asyncio.run(load_test.run()), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(results + "\n")
+    else:
+        print(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import settings
+
+# Preferences of a user about his/her partners. A None language or region ("any") matches every language or region, and
+# so does a user without interests match every interest
+Preferences = namedtuple("Preferences", ["language", "region", "interests"])
+NO_PREFERENCES = Preferences(None, None, ())
+
+# Stands for every value of a field in the bucket keys, never equal to a value typed by a user
+_WILDCARD = object()
+
+# Maximum number of interests of a user, each one adds a bucket to the narrowest level
+MAX_INTERESTS = 5
+
+# A user waiting in the queue
+Waiting = namedtuple("Waiting", ["user_id", "since", "preferences"])
+
+
+def make_preferences(language=None, region=None, interests=()):
+    """
+    Normalizes the preferences typed by a user
+    :param language: language of the partners, any if None, empty or "any"
+    :param region: region of the partners, any if None, empty or "any"
+    :param interests: interests, at least one of them shared with the partners
+    :return: Preferences
+    """
+
+    def normalize(value):
+        value = (value or "").strip().lower()[:32]
+        return None if value in ("", "any") else value
+
+    interests = sorted({normalize(interest) for interest in interests} - {None})[:MAX_INTERESTS]
+    return Preferences(normalize(language), normalize(region), tuple(interests))
+
+
+def bucket_keys(preferences):
+    """
+    Buckets a waiting user is in, from the narrowest level to the widest:
+    0. same language, same region and at least one shared interest
+    1. same language and region
+    2. same language
+    3. anyone
+    where a field left to any matches every value. Besides the buckets of his/her own values (None, or no interests,
+    for any), the user is in the ones where each field is a wildcard, looked up by the users accepting any value
+    :param preferences: Preferences of the user
+    :return: list with the keys of the buckets of the user at each level
+    """
+    language, region, interests = preferences
+    languages = (language, _WILDCARD)
+    regions = (region, _WILDCARD)
+    interests = (tuple(interests) or (None,)) + (_WILDCARD,)
+    return [
+        [(0, lang, reg, interest) for lang in languages for reg in regions for interest in interests],
+        [(1, lang, reg) for lang in languages for reg in regions],
+        [(2, lang) for lang in languages],
+        [(3,)],
+    ]
+
+
+def search_keys(preferences):
+    """
+    Buckets looked up by a searching user at each level of bucket_keys: for each field, the buckets of his/her own value
+    and of the users accepting any value, or the wildcard buckets (where everybody is) if he/she accepts any value
+    :param preferences: Preferences of the user
+    :return: list with the keys of the buckets to look up at each level
+    """
+    language, region, interests = preferences
+    languages = (_WILDCARD,) if language is None else (language, None)
+    regions = (_WILDCARD,) if region is None else (region, None)
+    interests = tuple(interests) + (None,) if interests else (_WILDCARD,)
+    return [
+        [(0, lang, reg, interest) for lang in languages for reg in regions for interest in interests],
+        [(1, lang, reg) for lang in languages for reg in regions],
+        [(2, lang) for lang in languages],
+        [(3,)],
+    ]
+
+
+class MatchmakingQueue:
+    """
+    Queue of the users waiting for a partner, indexed by preferences.
+    Each waiting user is in a few FIFO buckets per level (see bucket_keys), so a compatible partner is found by looking
+    only at the heads of the few buckets of the user (see search_keys), whatever the number of users waiting: enqueue,
+    removal and pairing are O(number of interests), and run under a lock, so two concurrent searches can never pick the
+    same user. A user accepting any partner is paired right away with the one waiting the longest.
+    A user is paired in the narrowest level with somebody waiting, but a wider level is used only once one of the two
+    users waited widen_after[level] seconds; the users left waiting are paired by widen(), called periodically.
+    """
+
+    def __init__(self, widen_after=(0, 0, 0)):
+        """
+        :param widen_after: seconds one of the two users must have waited to be paired at the levels 1, 2 and 3
+        (0 everywhere: the user waiting the longest is picked if nobody shares the bucket of the searching user)
+        """
+        self.widen_after = (0,) + tuple(widen_after)
+        # Number of pairings made at each level
+        self.matches = [0] * len(self.widen_after)
+        # user_id -> (time the user started waiting, preferences), in insertion (FIFO) order
+        self._waiting = OrderedDict()
+        # bucket key -> OrderedDict user_id -> time the user started waiting, in FIFO order
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def __contains__(self, user_id):
+        return user_id in self._waiting
+
+    def _add(self, user_id, since, preferences, first=False):
+        self._waiting[user_id] = (since, preferences)
+        if first:
+            self._waiting.move_to_end(user_id, last=False)
+        for keys in bucket_keys(preferences):
+            for key in keys:
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    bucket = self._buckets[key] = OrderedDict()
+                bucket[user_id] = since
+                if first:
+                    bucket.move_to_end(user_id, last=False)
+
+    def _remove(self, user_id):
+        entry = self._waiting.pop(user_id, None)
+        if entry is None:
+            return None
+        for keys in bucket_keys(entry[1]):
+            for key in keys:
+                bucket = self._buckets[key]
+                del bucket[user_id]
+                if not bucket:
+                    del self._buckets[key]
+        return entry
+
+    def _find(self, user_id, preferences, waited, now):
+        # The oldest user of the narrowest level the searching user can be paired at, None if there is none
+        for level, keys in enumerate(search_keys(preferences)):
+            best = None
+            for key in keys:
+                # The head of the bucket, skipping the user himself/herself
+                head = next((item for item in itertools.islice(self._buckets.get(key, {}).items(), 2)
+                             if item[0] != user_id), None)
+                if head is not None and (best is None or head[1] < best[1]):
+                    best = head
+            if best is not None and max(waited, now - best[1]) >= self.widen_after[level]:
+                self.matches[level] += 1
+                return best
+        return None
+
+    def pair_or_enqueue(self, user_id, since=None, preferences=None):
+        """
+        Pairs the user with the compatible user waiting the longest, or puts him/her at the end of the queue if none
+        :param user_id: id of the user searching for a partner
+        :param since: time the user started waiting, now if None
+        :param preferences: Preferences of the user, none if None
+        :return: (id of the partner, seconds the partner waited, Preferences of the partner), None if the user has been
+        enqueued
+        """
+        now = time.monotonic()
+        since = now if since is None else since
+        preferences = preferences or NO_PREFERENCES
+        with self._lock:
+            # The user may already be waiting (e.g. repeated /chat), never pair him/her with himself/herself
+            self._remove(user_id)
+            match = self._find(user_id, preferences, now - since, now)
+            if match is None:
+                self._add(user_id, since, preferences)
+                return None
+            other_user_id, other_since = match
+            return other_user_id, now - other_since, self._remove(other_user_id)[1]
+
+    def widen(self):
+        """
+        Pairs the users who have waited long enough to be paired in a wider bucket, oldest first
+        :return: list of (Waiting, Waiting) pairs, the first one being the user who waited the longest. They are no
+        longer in the queue
+        """
+        now = time.monotonic()
+        threshold = min(self.widen_after[1:])
+        pairs = []
+        with self._lock:
+            # Only the users waiting for more than the first threshold can be paired now and not before
+            candidates = list(itertools.takewhile(lambda item: now - item[1][0] >= threshold, self._waiting.items()))
+            for user_id, (since, preferences) in candidates:
+                if user_id not in self._waiting:
+                    # Already paired in this sweep
+                    continue
+                match = self._find(user_id, preferences, now - since, now)
+                if match is not None:
+                    self._remove(user_id)
+                    other_since, other_preferences = self._remove(match[0])
+                    pairs.append((Waiting(user_id, since, preferences),
+                                  Waiting(match[0], other_since, other_preferences)))
+        return pairs
+
+    def stale(self, older_than, limit):
+        """
+        :param older_than: seconds
+        :param limit: maximum number of users returned
+        :return: ids of the users waiting for more than older_than seconds, oldest first. They are left in the queue
+        """
+        now = time.monotonic()
+        with self._lock:
+            waiting = itertools.takewhile(lambda item: now - item[1][0] >= older_than, self._waiting.items())
+            return [user_id for user_id, _ in itertools.islice(waiting, limit)]
+
+    def requeue(self, user_id, since=None, preferences=None):
+        """
+        Puts a user back at the head of the queue, e.g. when persisting a pairing failed
+        :param user_id: id of the user
+        :param since: time the user started waiting, now if None
+        :param preferences: Preferences of the user, none if None
+        :return: None
+        """
+        with self._lock:
+            self._remove(user_id)
+            self._add(user_id, time.monotonic() if since is None else since, preferences or NO_PREFERENCES,
+                      first=True)
+
+    def discard(self, user_id):
+        """
+        Removes the user from the queue, if present
+        :param user_id: id of the user
+        :return: time the user started waiting, None if he/she was not waiting
+        """
+        with self._lock:
+            entry = self._remove(user_id)
+            return None if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._waiting.clear()
+            self._buckets.clear()
+
+    def load(self, users):
+        """
+        Rebuilds the queue, e.g. from the users persisted as in search before a crash
+        :param users: (id, Preferences) of the waiting users, in FIFO order
+        :return: None
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._waiting.clear()
+            self._buckets.clear()
+            for user_id, preferences in users:
+                self._add(user_id, now, preferences or NO_PREFERENCES)
+
+
+# Queue shared by the whole process
+queue = MatchmakingQueue(settings.MATCH_WIDEN_AFTER)
@@ -0,0 +1,366 @@
+import bisect
+import collections
+import functools
+import inspect
+import logging
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import settings
+
+# Instrumentation is on only if the metrics endpoint is configured. When it is off, the decorators below return the
+# functions unchanged, so that the hot path pays nothing
+ENABLED = settings.METRICS_PORT is not None
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = (name + '="' + str(value).replace('"', '\\"') + '"' for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    """
+    Monotonically increasing counter, optionally read from a callback at scrape time
+    """
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labels=(), callback=None):
+        """
+        :param name: name of the metric
+        :param documentation: help text of the metric
+        :param labels: names of the labels of the metric
+        :param callback: function returning {label values tuple: value}, if the value is owned by someone else
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.callback = callback
+        self._values = collections.defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def samples(self):
+        values = self.callback() if self.callback is not None else dict(self._values)
+        return [(self.name, _format_labels(self.labels, key), value) for key, value in sorted(values.items())]
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down, usually read from a callback at scrape time
+    """
+
+    type = "gauge"
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram:
+    """
+    Histogram of observed values (e.g. latencies) with fixed buckets
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append((self.name + "_bucket", _format_labels(self.labels + ("le",), key + (le,)), cumulative))
+            samples.append((self.name + "_sum", _format_labels(self.labels, key), counts[-1]))
+            samples.append((self.name + "_count", _format_labels(self.labels, key), cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        :return: all the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logging.warning("Could not collect metric " + metric.name + ": " + repr(e))
+                continue
+            lines.append("# HELP " + metric.name + " " + metric.documentation)
+            lines.append("# TYPE " + metric.name + " " + metric.type)
+            for name, labels, value in samples:
+                lines.append(name + labels + " " + repr(float(value)))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HANDLER_SECONDS = registry.register(Histogram("chatbot_handler_duration_seconds",
+                                              "Time spent in each handler of the bot", labels=("handler",)))
+DB_QUERY_SECONDS = registry.register(Histogram("chatbot_db_query_duration_seconds",
+                                               "Time spent in each database function", labels=("query",)))
+HANDLER_ERRORS = registry.register(Counter("chatbot_handler_errors_total",
+                                           "Exceptions raised by each handler of the bot", labels=("handler",)))
+RELAYED_MESSAGES = registry.register(Counter("chatbot_relayed_messages_total",
+                                             "Messages relayed between partners, by media type", labels=("media",)))
+HOUSEKEEPING_PROCESSED = registry.register(Counter("chatbot_housekeeping_processed_total",
+                                                   "Users processed by the housekeeping sweeps, by task",
+                                                   labels=("task",)))
+HOUSEKEEPING_SECONDS = registry.register(Histogram("chatbot_housekeeping_duration_seconds",
+                                                   "Time spent in each housekeeping task", labels=("task",)))
+
+
+def register_callback(metric_class, name, documentation, labels, callback):
+    """
+    Registers a counter or a gauge whose values are read from a callback at scrape time
+    :param metric_class: Counter or Gauge
+    :param name: name of the metric
+    :param documentation: help text of the metric
+    :param labels: names of the labels of the metric
+    :param callback: function returning {label values tuple: value}
+    :return: the registered metric
+    """
+    return registry.register(metric_class(name, documentation, labels=labels, callback=callback))
+
+
+def register_bot_collectors(application=None):
+    """
+    Registers the metrics read from the other modules of the bot at scrape time: users per status, outbound calls,
+    session cache, matchmaking queue and, if the application is given, updates waiting to be processed
+    :param application: the bot application
+    :return: None
+    """
+    import storage
+    from UserStatus import UserStatus
+    from coalescer import coalescer
+    from outbound import scheduler
+    from session_cache import cache
+
+    backend = storage.get_backend()
+    register_callback(Gauge, "chatbot_users", "Registered users, by status", ("status",),
+                      lambda: {(status,): count for status, count in backend.count_users_by_status().items()})
+    register_callback(Gauge, "chatbot_matchmaking_queue_length", "Users waiting for a partner", (),
+                      lambda: {(): backend.count_users_by_status().get(UserStatus.IN_SEARCH, 0)})
+    register_callback(Counter, "chatbot_outbound_calls_total", "Outbound Bot API calls, by result", ("result",),
+                      lambda: {("sent",): scheduler.sent, ("error",): scheduler.errors,
+                               ("rate_limited",): scheduler.rate_limited, ("merged",): scheduler.merged})
+    register_callback(Gauge, "chatbot_outbound_queue_length", "Outbound Bot API calls waiting to be sent", (),
+                      lambda: {(): len(scheduler)})
+    register_callback(Counter, "chatbot_relay_calls_saved_total", "copy_message calls saved by copying albums and "
+                      "bursts in batches", (), lambda: {(): coalescer.saved_calls})
+    if not backend.reply_index.blocking:
+        # The index shared by several processes is in the key-value store, where pairs are not counted
+        register_callback(Gauge, "chatbot_reply_index_pairs", "Pairs whose relayed message ids are indexed", (),
+                          lambda: {(): len(backend.reply_index)})
+    register_callback(Counter, "chatbot_session_cache_requests_total", "Session cache lookups, by result",
+                      ("result",), lambda: {("hit",): cache.hits, ("miss",): cache.misses})
+    processor = getattr(application, "update_processor", None)
+    if hasattr(processor, "pending"):
+        register_callback(Gauge, "chatbot_pending_updates", "Updates waiting or being processed", (),
+                          lambda: {(): processor.pending})
+        register_callback(Counter, "chatbot_throttled_updates_total", "Updates refused by the webhook because their "
+                          "user had too many updates waiting", (), lambda: {(): processor.throttled})
+
+
+def _timed(histogram, errors=None):
+    def decorator(func):
+        if not ENABLED:
+            return func
+        label = func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                token = profiler.enter(label) if profiler is not None else None
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(label)
+                    raise
+                finally:
+                    elapsed = time.perf_counter() - started
+                    histogram.observe(elapsed, label)
+                    if token is not None:
+                        profiler.exit(token, elapsed)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started, label)
+        return wrapper
+
+    return decorator
+
+
+def time_handler(func):
+    """
+    Decorator measuring the latency of a handler of the bot, labelled with the name of the function
+    """
+    return _timed(HANDLER_SECONDS, HANDLER_ERRORS)(func)
+
+
+def time_query(func):
+    """
+    Decorator measuring the latency of a database function, labelled with the name of the function
+    """
+    return _timed(DB_QUERY_SECONDS)(func)
+
+
+def media_type(message):
+    """
+    :param message: a telegram Message
+    :return: name of the kind of content of the message (text, photo, sticker, ...)
+    """
+    if message.text is not None:
+        return "text"
+    for kind in ("photo", "video", "animation", "sticker", "voice", "video_note", "audio", "document", "contact",
+                 "location", "poll", "dice"):
+        if getattr(message, kind, None):
+            return kind
+    return "other"
+
+
+def count_relayed(message):
+    if ENABLED:
+        RELAYED_MESSAGES.inc(media_type(message))
+
+
+def count_housekeeping(task, processed, elapsed):
+    if ENABLED:
+        HOUSEKEEPING_PROCESSED.inc(task, amount=processed)
+        HOUSEKEEPING_SECONDS.observe(elapsed, task)
+
+
+class SlowHandlerProfiler:
+    """
+    Sampling profiler for slow handlers.
+    While a handler has been running for more than `threshold` seconds, a background thread samples the stack of the
+    event loop thread every `interval` seconds. When the handler completes, the most frequent stacks are logged, showing
+    what kept it (or the whole loop) busy.
+    """
+
+    def __init__(self, threshold, interval=0.005, top=3):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self._in_flight = {}
+        self._samples = collections.defaultdict(collections.Counter)
+        self._next_token = 0
+        self._lock = threading.Lock()
+        self._loop_thread_id = None
+        self._thread = threading.Thread(target=self._run, name="slow-handler-profiler", daemon=True)
+        self._thread.start()
+
+    def enter(self, label):
+        with self._lock:
+            self._loop_thread_id = threading.get_ident()
+            self._next_token += 1
+            self._in_flight[self._next_token] = (label, time.perf_counter())
+            return self._next_token
+
+    def exit(self, token, elapsed):
+        with self._lock:
+            label, _ = self._in_flight.pop(token)
+            samples = self._samples.pop(token, None)
+        if samples:
+            lines = ["Slow handler " + label + " took " + format(elapsed, ".3f") + "s, most sampled stacks:"]
+            total = sum(samples.values())
+            for stack, count in samples.most_common(self.top):
+                lines.append("--- " + str(count) + "/" + str(total) + " samples\n" + stack)
+            logging.warning("\n".join(lines))
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            with self._lock:
+                slow = [token for token, (_, started) in self._in_flight.items() if now - started > self.threshold]
+                thread_id = self._loop_thread_id
+            if not slow or thread_id is None:
+                continue
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame, limit=15))
+            with self._lock:
+                for token in slow:
+                    if token in self._in_flight:
+                        self._samples[token][stack] += 1
+
+
+profiler = SlowHandlerProfiler(settings.SLOW_HANDLER_SECONDS) if ENABLED and settings.SLOW_HANDLER_SECONDS else None
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Do not log every scrape
+        pass
+
+
+def start_server(listen=settings.METRICS_LISTEN, port=settings.METRICS_PORT):
+    """
+    Serves the metrics in the Prometheus format on http://<listen>:<port>/metrics, from a background thread
+    :param listen: address to listen on
+    :param port: port to listen on
+    :return: the HTTP server
+    """
+    server = ThreadingHTTPServer((listen, port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
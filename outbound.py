@@ -0,0 +1,343 @@
+import asyncio
+import heapq
+import logging
+import time
+from collections import deque
+
+from telegram.constants import MessageLimit
+from telegram.error import RetryAfter
+
+# Priority lanes, lower values are served first
+RELAY = 0  # Messages of a user copied to his/her partner
+NOTICE = 1  # Messages of the bot itself ("Searching for a partner...", ...)
+
+
+class TokenBucket:
+    """
+    Token bucket allowing `rate` sends per second on average, with bursts of up to `capacity` sends
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # Time until which the bucket is blocked, after Telegram answered with a 429 Too Many Requests
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """
+        :param now: current time.monotonic()
+        :return: seconds to wait before a token is available, 0 if one is available right now
+        """
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class _Job:
+    __slots__ = ("chat_id", "key", "priority", "call", "future", "text", "kwargs", "bot")
+
+    def __init__(self, chat_id, priority, call, future, bot=None, text=None, kwargs=None):
+        self.chat_id = chat_id
+        # Chat ids come both as int (from the updates) and as str (from the database)
+        self.key = str(chat_id)
+        self.priority = priority
+        # Coroutine function performing the API call, None for notices (built from bot, text and kwargs when sent)
+        self.call = call
+        self.future = future
+        self.bot = bot
+        self.text = text
+        self.kwargs = kwargs
+
+
+class OutboundScheduler:
+    """
+    Schedules every outbound Bot API call of the bot.
+    Calls are rate limited by a token bucket per chat and a global one, chat relays are always served before the notices
+    of the bot, consecutive notices to the same chat that are still waiting are merged into a single message and calls
+    rejected with 429 Too Many Requests are retried after the delay requested by Telegram.
+    Calls to the same chat are sent one at a time and in order (within the same lane), and at most max_in_flight calls
+    are sent at the same time.
+    Each lane keeps a FIFO of jobs per chat and a queue of the chats ready to be sent to, so picking the next call does
+    not depend on the number of chats blocked by their rate limit or by a 429.
+    """
+
+    def __init__(self, global_rate=30, global_burst=30, chat_rate=1, chat_burst=3, max_retries=3, max_in_flight=64):
+        """
+        :param global_rate: sends per second allowed across all the chats
+        :param global_burst: maximum burst across all the chats
+        :param chat_rate: sends per second allowed to a single chat
+        :param chat_burst: maximum burst to a single chat
+        :param max_retries: number of times a call rejected with 429 is retried before failing
+        :param max_in_flight: maximum number of calls sent at the same time, above it the HTTP connection pool gets
+        slower than the calls it saves
+        """
+        self.max_in_flight = max_in_flight
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}
+        # priority -> chat key -> FIFO of the jobs of the lane waiting to be sent to the chat
+        self._queues = {RELAY: {}, NOTICE: {}}
+        # priority -> chats with jobs in the lane that may be sent now, in the order they became ready (and the same
+        # chats as a set). A chat leaves them while a call to it is in flight or while it waits for its rate limit
+        self._ready = {RELAY: deque(), NOTICE: deque()}
+        self._ready_keys = {RELAY: set(), NOTICE: set()}
+        # Chats waiting for their rate limit: heap of (time.monotonic() they can be sent to, chat key), and their keys
+        self._delayed = []
+        self._delayed_keys = set()
+        self._queued = 0
+        # chat_id -> notice still waiting in the NOTICE lane, new notices to the same chat are merged into it
+        self._pending_notices = {}
+        self._in_flight = set()
+        self._retries = {}
+        self._wakeup = None
+        self._task = None
+        # Counters of what has been sent, exposed for monitoring
+        self.sent = 0
+        self.merged = 0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def __len__(self):
+        return self._queued
+
+    @property
+    def rates(self):
+        """
+        :return: the current rate limits, as the arguments of set_rates
+        """
+        return {"global_rate": self._global.rate, "global_burst": self._global.capacity, "chat_rate": self.chat_rate,
+                "chat_burst": self.chat_burst}
+
+    def set_rates(self, global_rate, global_burst, chat_rate, chat_burst):
+        """
+        Changes the rate limits of the scheduler, e.g. for load tests against a stand-in Bot API
+        :param global_rate: sends per second allowed across all the chats
+        :param global_burst: maximum burst across all the chats
+        :param chat_rate: sends per second allowed to a single chat
+        :param chat_burst: maximum burst to a single chat
+        :return: None
+        """
+        self._global = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chats = {}
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._wakeup.set()
+
+    def submit(self, chat_id, call, priority=NOTICE):
+        """
+        Queues a generic API call to a chat
+        :param chat_id: id of the chat the call sends to
+        :param call: coroutine function without arguments performing the call
+        :param priority: lane of the call, RELAY or NOTICE
+        :return: a future resolved with the result of the call
+        """
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_log_failure)
+        self._enqueue(_Job(chat_id, priority, call, future))
+        self._ensure_started()
+        return future
+
+    def relay(self, chat_id, call):
+        """
+        Queues the copy of a user's message to his/her partner, served before any notice
+        :param chat_id: id of the partner
+        :param call: coroutine function without arguments performing the copy
+        :return: a future resolved with the result of the call
+        """
+        return self.submit(chat_id, call, priority=RELAY)
+
+    def notify(self, bot, chat_id, text, **kwargs):
+        """
+        Queues a notice of the bot. A plain notice is merged with the previous one to the same chat if that one has not
+        been sent yet, as long as the merged text fits in a single message
+        :param bot: bot sending the notice
+        :param chat_id: id of the chat
+        :param text: text of the notice
+        :param kwargs: other arguments of send_message, notices with arguments are never merged
+        :return: a future resolved with the sent message
+        """
+        pending = self._pending_notices.get(str(chat_id))
+        if pending is not None and not kwargs and len(pending.text) + 1 + len(text) <= MessageLimit.MAX_TEXT_LENGTH:
+            pending.text += "\n" + text
+            self.merged += 1
+            return pending.future
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_log_failure)
+        job = _Job(chat_id, NOTICE, None, future, bot=bot, text=text, kwargs=kwargs)
+        self._enqueue(job)
+        if kwargs:
+            # Later notices must not be merged into a notice queued before this one
+            self._pending_notices.pop(job.key, None)
+        else:
+            self._pending_notices[job.key] = job
+        self._ensure_started()
+        return future
+
+    def _chat_bucket(self, key):
+        bucket = self._chats.get(key)
+        if bucket is None:
+            if len(self._chats) > 10000:
+                # Forget the chats that have not been written recently
+                now = time.monotonic()
+                self._chats = {chat: b for chat, b in self._chats.items() if not b.is_idle(now)}
+            bucket = self._chats[key] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _enqueue(self, job, first=False):
+        jobs = self._queues[job.priority].get(job.key)
+        if jobs is None:
+            jobs = self._queues[job.priority][job.key] = deque()
+        if first:
+            jobs.appendleft(job)
+        else:
+            jobs.append(job)
+        self._queued += 1
+        self._make_ready(job.key)
+
+    def _make_ready(self, key):
+        # Put the chat back in the ready queues of the lanes where it has jobs, unless a call to it is in flight or it
+        # waits for its rate limit (it is made ready again when the call completes or the delay is over)
+        if key in self._in_flight or key in self._delayed_keys:
+            return
+        for priority, queues in self._queues.items():
+            if key in queues and key not in self._ready_keys[priority]:
+                self._ready_keys[priority].add(key)
+                self._ready[priority].append(key)
+
+    def _next_job(self):
+        # Return the next job allowed to be sent, or None and how long to wait before trying again (None: until woken).
+        # Only the chats that can be sent to are looked at: the ones waiting for their rate limit are in a heap
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            key = heapq.heappop(self._delayed)[1]
+            self._delayed_keys.discard(key)
+            self._make_ready(key)
+        if len(self._in_flight) >= self.max_in_flight:
+            # Woken up when a call completes
+            return None, None
+        global_delay = self._global.delay(now)
+        if global_delay > 0:
+            return None, (global_delay if len(self) else None)
+        for priority in (RELAY, NOTICE):
+            if priority == RELAY and len(self._in_flight) >= self.max_in_flight - self.max_in_flight // 4:
+                # A quarter of the calls in flight is kept for the notices, not to starve them behind the relays
+                continue
+            ready = self._ready[priority]
+            while ready:
+                key = ready.popleft()
+                self._ready_keys[priority].discard(key)
+                if key in self._in_flight or key in self._delayed_keys:
+                    # Already waiting, e.g. for a call of the other lane
+                    continue
+                chat_delay = self._chat_bucket(key).delay(now)
+                if chat_delay > 0:
+                    # The later jobs of the chat wait too, to keep the order
+                    heapq.heappush(self._delayed, (now + chat_delay, key))
+                    self._delayed_keys.add(key)
+                    continue
+                jobs = self._queues[priority][key]
+                job = jobs.popleft()
+                if not jobs:
+                    del self._queues[priority][key]
+                self._queued -= 1
+                return job, None
+        return None, (self._delayed[0][0] - now if self._delayed else None)
+
+    async def _run(self):
+        while True:
+            job, wait = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            now = time.monotonic()
+            self._global.consume(now)
+            self._chat_bucket(job.key).consume(now)
+            if self._pending_notices.get(job.key) is job:
+                del self._pending_notices[job.key]
+            self._in_flight.add(job.key)
+            asyncio.get_running_loop().create_task(self._send(job))
+
+    async def _send(self, job):
+        try:
+            if job.call is not None:
+                result = await job.call()
+            else:
+                result = await job.bot.send_message(chat_id=job.chat_id, text=job.text, **job.kwargs)
+        except RetryAfter as e:
+            self.rate_limited += 1
+            retries = self._retries.get(job.future, 0)
+            if retries < self.max_retries:
+                retry_after = e.retry_after
+                if hasattr(retry_after, "total_seconds"):
+                    retry_after = retry_after.total_seconds()
+                # Block the chat for the requested time and put the job back at the head of its lane
+                self._chat_bucket(job.key).blocked_until = time.monotonic() + retry_after
+                self._retries[job.future] = retries + 1
+                self._enqueue(job, first=True)
+            else:
+                self._retries.pop(job.future, None)
+                self.errors += 1
+                job.future.set_exception(e)
+        except Exception as e:
+            self._retries.pop(job.future, None)
+            self.errors += 1
+            job.future.set_exception(e)
+        else:
+            self._retries.pop(job.future, None)
+            self.sent += 1
+            job.future.set_result(result)
+        finally:
+            self._in_flight.discard(job.key)
+            self._make_ready(job.key)
+            self._wakeup.set()
+
+    async def stop(self, timeout=10.0):
+        """
+        Waits (up to `timeout` seconds) for the queued calls to be sent, then stops the scheduler
+        :param timeout: maximum number of seconds to wait
+        :return: None
+        """
+        deadline = time.monotonic() + timeout
+        while (len(self) or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+def _log_failure(future):
+    # Calls are usually not awaited by the handlers, so report their failures here
+    if not future.cancelled() and future.exception() is not None:
+        logging.warning("Outbound call failed: " + repr(future.exception()))
+
+
+# Scheduler shared by the whole bot
+scheduler = OutboundScheduler()
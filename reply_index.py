@@ -0,0 +1,158 @@
+from array import array
+
+
+class ReplyIndex:
+    """
+    Maps every message of a chat between two partners to its counterpart in the chat of the other one: the messages of
+    a user to their copies sent to the partner, and the copies received from the partner to the partner's originals.
+    Replies are then copied as replies to the right message in O(1).
+    Each pair has a fixed size ring per chat: a message id is stored in the slot message_id % slots, so a chat only
+    remembers its last `slots` message ids (they grow by one with every message, whoever sends it) and the memory
+    used by a pair is bounded. A pair is dropped when its chat ends.
+    The index is kept in this process, see KeyValueReplyIndex for the processes of the sharded mode.
+    """
+
+    # True if the methods block on I/O, so that async_db runs them on a thread of their own. open() never blocks
+    blocking = False
+
+    def __init__(self, slots=32):
+        """
+        :param slots: number of message ids remembered in the chat of each user of a pair
+        """
+        self.slots = slots
+        # user_id -> (ring of the pair, 0 or 1 for the half of the ring of the user's chat, partner_id)
+        self._pairs = {}
+
+    def __len__(self):
+        return len(self._pairs) // 2
+
+    def _ring(self, user_id, partner_id):
+        # The ring and the half of the user, None if the two users are not indexed as a pair
+        entry = self._pairs.get(str(user_id))
+        if entry is None or entry[2] != str(partner_id):
+            return None
+        return entry[:2]
+
+    def open(self, user_id, partner_id):
+        """
+        Starts the index of a pair, unless the user is already indexed with this partner
+        :param user_id: id of the user
+        :param partner_id: id of the partner
+        :return: None
+        """
+        key, partner_key = str(user_id), str(partner_id)
+        if self._ring(key, partner_key) is not None:
+            return
+        for entry_key in (key, partner_key):
+            entry = self._pairs.get(entry_key)
+            if entry is not None:
+                self.drop(entry_key, entry[2])
+        # Two halves of `slots` (message id, counterpart id) slots, one per chat
+        ring = array("i", bytes(4 * 4 * self.slots))
+        self._pairs[key] = (ring, 0, partner_key)
+        self._pairs[partner_key] = (ring, 1, key)
+
+    def _slot(self, half, message_id):
+        return 2 * (half * self.slots + message_id % self.slots)
+
+    def record(self, user_id, partner_id, copies):
+        """
+        Records the copies sent to the partner of messages of the user, if they are still indexed as a pair
+        :param user_id: id of the user who sent the messages
+        :param partner_id: id of the partner
+        :param copies: list of (id of the message in the chat of the user, id of its copy in the chat of the partner)
+        :return: None
+        """
+        ring = self._ring(user_id, partner_id)
+        if ring is None:
+            # The chat has ended in the meantime
+            return
+        ring, half = ring
+        for message_id, copied_message_id in copies:
+            slot = self._slot(half, message_id)
+            ring[slot], ring[slot + 1] = message_id, copied_message_id
+            slot = self._slot(1 - half, copied_message_id)
+            ring[slot], ring[slot + 1] = copied_message_id, message_id
+
+    def lookup(self, user_id, message_id, partner_id):
+        """
+        :param user_id: id of the user
+        :param message_id: id of a message in the chat of the user
+        :param partner_id: id of the partner the message is copied to
+        :return: id of its counterpart in the chat of the partner, None if unknown (e.g. a message of the bot, or one
+        too old to be remembered)
+        """
+        ring = self._ring(user_id, partner_id)
+        if ring is None:
+            return None
+        ring, half = ring
+        slot = self._slot(half, message_id)
+        if ring[slot] != message_id:
+            return None
+        return ring[slot + 1]
+
+    def drop(self, user_id, partner_id):
+        """
+        Forgets the pair, e.g. when the chat ends. A later pair of one of the users is left alone
+        :param user_id: id of the user
+        :param partner_id: id of the partner
+        :return: None
+        """
+        if self._ring(user_id, partner_id) is not None:
+            del self._pairs[str(user_id)]
+            del self._pairs[str(partner_id)]
+
+
+class KeyValueReplyIndex:
+    """
+    ReplyIndex kept in the key-value store (the stand-in kv_server or a real Redis), shared by every process: in the
+    sharded mode (see cluster.py) a message is copied and recorded by the worker of its sender, while a reply to its
+    copy is handled by the worker of the partner.
+    Keys:
+    - replies:<user_id>:<partner_id>: hash slot -> "<message id>:<counterpart id>" of the chat of the user with the
+      partner, where the slot is message_id % slots as in ReplyIndex, so that a chat has at most `slots` fields
+    Every call is a single round trip. There is nothing to open: the keys of a pair exist once a copy is recorded.
+    drop() deletes them when the chat ends, and they expire `ttl` seconds after the last recorded copy otherwise (e.g.
+    after a crash of the worker, or a chat closed by a restart)
+    """
+
+    blocking = True
+
+    def __init__(self, client, slots=32, ttl=24 * 60 * 60):
+        """
+        :param client: KeyValueClient of the key-value server
+        :param slots: number of message ids remembered in the chat of each user of a pair
+        :param ttl: seconds the keys of a pair are kept after its last recorded copy
+        """
+        self._client = client
+        self.slots = slots
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(user_id, partner_id):
+        return "replies:" + str(user_id) + ":" + str(partner_id)
+
+    def open(self, user_id, partner_id):
+        pass
+
+    def record(self, user_id, partner_id, copies):
+        commands = []
+        for message_id, copied_message_id in copies:
+            commands.append(("HSET", self._key(user_id, partner_id), message_id % self.slots,
+                             str(message_id) + ":" + str(copied_message_id)))
+            commands.append(("HSET", self._key(partner_id, user_id), copied_message_id % self.slots,
+                             str(copied_message_id) + ":" + str(message_id)))
+        if commands:
+            commands.append(("EXPIRE", self._key(user_id, partner_id), self.ttl))
+            commands.append(("EXPIRE", self._key(partner_id, user_id), self.ttl))
+            self._client.pipeline(commands)
+
+    def lookup(self, user_id, message_id, partner_id):
+        value = self._client.execute("HGET", self._key(user_id, partner_id), message_id % self.slots)
+        if value is None:
+            return None
+        stored_message_id, counterpart = value.split(":")
+        return int(counterpart) if int(stored_message_id) == message_id else None
+
+    def drop(self, user_id, partner_id):
+        self._client.execute("DEL", self._key(user_id, partner_id), self._key(partner_id, user_id))
@@ -0,0 +1,120 @@
+import threading
+from collections import OrderedDict
+
+
+class SessionCache:
+    """
+    Bounded LRU cache of the user sessions: user_id -> (status, partner_id).
+    db_connection writes through it on every state change, so relaying a message needs no database read once the
+    sessions of the two users are cached.
+    """
+
+    def __init__(self, max_size=100000):
+        """
+        :param max_size: maximum number of cached sessions, the least recently used ones are evicted first
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Bumped by every write, so that a session read from the database concurrently with a write is not cached
+        self.version = 0
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, user_id):
+        """
+        Returns the cached session of the user, counting a hit or a miss
+        :param user_id: id of the user
+        :return: (status, partner_id), None if the session is not cached
+        """
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                self.misses += 1
+                return None
+            self._sessions.move_to_end(user_id)
+            self.hits += 1
+            return session
+
+    def peek(self, user_id):
+        """
+        Returns the cached session of the user without counting a hit or a miss and without refreshing it
+        :param user_id: id of the user
+        :return: (status, partner_id), None if the session is not cached
+        """
+        with self._lock:
+            return self._sessions.get(user_id)
+
+    def _store(self, user_id, status, partner_id):
+        self._sessions[user_id] = (status, partner_id)
+        self._sessions.move_to_end(user_id)
+        if len(self._sessions) > self.max_size:
+            self._sessions.popitem(last=False)
+
+    def put(self, user_id, status, partner_id):
+        """
+        Writes the session of the user through the cache, evicting the least recently used one if the cache is full
+        :param user_id: id of the user
+        :param status: status of the user
+        :param partner_id: id of the partner of the user, None if he/she has no partner
+        :return: None
+        """
+        with self._lock:
+            self.version += 1
+            self._store(user_id, status, partner_id)
+
+    def fill(self, user_id, status, partner_id, version):
+        """
+        Caches a session read from the database after a miss, unless a write happened in the meantime
+        :param user_id: id of the user
+        :param status: status of the user
+        :param partner_id: id of the partner of the user, None if he/she has no partner
+        :param version: value of `version` taken before reading the session from the database
+        :return: None
+        """
+        with self._lock:
+            if version == self.version:
+                self._store(user_id, status, partner_id)
+
+    def update(self, user_id, status=None, partner_id=None, clear_partner=False):
+        """
+        Updates the cached session of the user, if cached. A session that is not cached is left alone, the next read
+        will load it from the database
+        :param user_id: id of the user
+        :param status: new status, unchanged if None
+        :param partner_id: new partner id, unchanged if None
+        :param clear_partner: if True, the partner id is set to None
+        :return: None
+        """
+        with self._lock:
+            self.version += 1
+            session = self._sessions.get(user_id)
+            if session is None:
+                return
+            old_status, old_partner_id = session
+            new_partner_id = None if clear_partner else (old_partner_id if partner_id is None else partner_id)
+            self._sessions[user_id] = (old_status if status is None else status, new_partner_id)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self.version += 1
+            self._sessions.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self.version += 1
+            self._sessions.clear()
+
+    def stats(self):
+        """
+        :return: dict with the number of hits, misses and cached sessions
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._sessions)}
+
+
+# Cache shared by the whole process
+cache = SessionCache()
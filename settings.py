@@ -0,0 +1,87 @@
+try:
+    import config
+except ImportError:
+    # The modules that only need the optional settings (e.g. db_connection) can be used without a config.py
+    config = None
+
+# Optional settings of the bot. Each one can be overridden by defining a variable with the same name in config.py
+
+# ####### Webhook mode #######
+# Public HTTPS URL Telegram posts the updates to (e.g. "https://example.com/telegram"), long polling is used if None
+WEBHOOK_URL = getattr(config, "WEBHOOK_URL", None)
+# Address and port the embedded HTTP server listens on (usually behind a reverse proxy terminating TLS)
+WEBHOOK_LISTEN = getattr(config, "WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = getattr(config, "WEBHOOK_PORT", 8443)
+# Secret sent by Telegram in the X-Telegram-Bot-Api-Secret-Token header of every update, requests without it are
+# rejected
+WEBHOOK_SECRET_TOKEN = getattr(config, "WEBHOOK_SECRET_TOKEN", None)
+# Maximum number of updates waiting to be processed, above it Telegram is asked to retry later
+WEBHOOK_MAX_QUEUE_SIZE = getattr(config, "WEBHOOK_MAX_QUEUE_SIZE", 1000)
+
+# ####### Metrics #######
+# Port of the Prometheus endpoint (http://<METRICS_LISTEN>:<METRICS_PORT>/metrics), instrumentation is off if None
+METRICS_PORT = getattr(config, "METRICS_PORT", None)
+METRICS_LISTEN = getattr(config, "METRICS_LISTEN", "0.0.0.0")
+# Handlers running longer than this many seconds are profiled by sampling and their hottest stacks are logged,
+# the profiler is off if None
+SLOW_HANDLER_SECONDS = getattr(config, "SLOW_HANDLER_SECONDS", None)
+
+# ####### Update processing #######
+# Maximum number of updates processed at the same time (updates of the same user or pair are always processed in order)
+MAX_CONCURRENT_UPDATES = getattr(config, "MAX_CONCURRENT_UPDATES", 256)
+# Number of updates of a single user waiting to be processed above which the webhook answers 503 to his/her next ones
+MAX_PENDING_UPDATES_PER_USER = getattr(config, "MAX_PENDING_UPDATES_PER_USER", 100)
+
+# ####### Restart #######
+# If True, the users coupled or in search when the bot was stopped are still coupled or in search after a restart,
+# provided that the bot was stopped cleanly. Otherwise every user is idle after a restart
+RESTORE_PAIRS = getattr(config, "RESTORE_PAIRS", False)
+
+# ####### Storage #######
+# Where the users are stored: "sqlite" (the database file DATABASE_PATH), "memory" (lost on restart, the fastest) or
+# "kv" (a key-value server speaking the Redis protocol at KV_HOST:KV_PORT, e.g. kv_server.py, shared by processes)
+STORAGE_BACKEND = getattr(config, "STORAGE_BACKEND", "sqlite")
+DATABASE_PATH = getattr(config, "DATABASE_PATH", "chatbot_database.db")
+KV_HOST = getattr(config, "KV_HOST", "127.0.0.1")
+KV_PORT = getattr(config, "KV_PORT", 6380)
+
+# ####### Sharding #######
+# Number of worker processes handling the updates (see cluster.py). With more than 1, a router process forwards each
+# update to the worker owning its user and a coordinator process pairs the users, sharing the state through the
+# key-value server at KV_HOST:KV_PORT if STORAGE_BACKEND is "kv", or through a stand-in one run by the coordinator
+WORKERS = getattr(config, "WORKERS", 1)
+
+# ####### Matchmaking #######
+# Seconds one of two users must have waited before they are paired with a partner of a wider bucket: same language and
+# region whatever the interests, same language whatever the region, and anyone (see matchmaking.bucket_keys)
+MATCH_WIDEN_AFTER = getattr(config, "MATCH_WIDEN_AFTER", (15, 30, 60))
+# Seconds between two sweeps pairing the users who have waited long enough to be paired in a wider bucket
+MATCH_SWEEP_SECONDS = getattr(config, "MATCH_SWEEP_SECONDS", 5)
+
+# ####### Relay #######
+# Messages sent by a user within this many seconds of each other are copied to the partner with a single API call,
+# 0 to copy each message right away (the items of an album are always copied together, see coalescer.py)
+RELAY_COALESCE_SECONDS = getattr(config, "RELAY_COALESCE_SECONDS", 0.25)
+# Seconds to wait for the next item of an album before copying it
+RELAY_ALBUM_SECONDS = getattr(config, "RELAY_ALBUM_SECONDS", 0.5)
+# Maximum seconds a message waits for the next ones before being copied
+RELAY_MAX_DELAY_SECONDS = getattr(config, "RELAY_MAX_DELAY_SECONDS", 1.0)
+# Number of message ids remembered in the chat of each user to copy the replies (see reply_index.py): a reply to an
+# older message is copied as a plain message
+REPLY_INDEX_SLOTS = getattr(config, "REPLY_INDEX_SLOTS", 32)
+# Seconds the reply index of a pair is kept in the key-value store after its last message, in case its chat never
+# ends cleanly (e.g. a worker crashes)
+REPLY_INDEX_TTL_SECONDS = getattr(config, "REPLY_INDEX_TTL_SECONDS", 24 * 60 * 60)
+
+# ####### Housekeeping #######
+# Seconds between two housekeeping sweeps (see housekeeping.py), None to disable them
+HOUSEKEEPING_INTERVAL_SECONDS = getattr(config, "HOUSEKEEPING_INTERVAL_SECONDS", 60)
+# Searches longer than this many seconds are stopped and the user is told so, never if None
+SEARCH_TIMEOUT_SECONDS = getattr(config, "SEARCH_TIMEOUT_SECONDS", 15 * 60)
+# Chats where neither partner sent anything for this many seconds are closed, never if None
+PAIR_IDLE_TIMEOUT_SECONDS = getattr(config, "PAIR_IDLE_TIMEOUT_SECONDS", 60 * 60)
+# Users not seen for this many days are moved to the archived_users table, and back if they return, never if None
+ARCHIVE_AFTER_DAYS = getattr(config, "ARCHIVE_AFTER_DAYS", 180)
+# Maximum number of users processed in a single transaction, and number of transactions of each task per sweep
+HOUSEKEEPING_BATCH_SIZE = getattr(config, "HOUSEKEEPING_BATCH_SIZE", 500)
+HOUSEKEEPING_MAX_BATCHES = getattr(config, "HOUSEKEEPING_MAX_BATCHES", 20)
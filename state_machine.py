@@ -0,0 +1,58 @@
+from collections import namedtuple
+
+from UserStatus import UserStatus
+
+# Allowed transitions of the state machine of a user: new status -> statuses it can be reached from
+ALLOWED_TRANSITIONS = {
+    # /chat, /newchat (from COUPLED only if the partner is gone)
+    UserStatus.IN_SEARCH: (UserStatus.IDLE, UserStatus.PARTNER_LEFT, UserStatus.COUPLED),
+    # A partner has been found
+    UserStatus.COUPLED: (UserStatus.IN_SEARCH,),
+    # /exit, or the search is abandoned
+    UserStatus.IDLE: (UserStatus.COUPLED, UserStatus.IN_SEARCH, UserStatus.PARTNER_LEFT),
+    # The partner blocked the bot
+    UserStatus.PARTNER_LEFT: (UserStatus.COUPLED,),
+}
+
+# Outcome of a transition:
+# - applied: True if the transition has been committed, False if the user was not in one of the expected statuses
+# - status: status of the user after the transition, or the current one if it has not been applied (None if the user
+#   does not exist)
+# - partner_id: partner of the user after the transition. For the transitions ending a chat, the former partner, who
+#   has to be notified
+Transition = namedtuple("Transition", ["applied", "status", "partner_id"])
+
+
+class InvalidTransition(ValueError):
+    pass
+
+
+def check_transition(old_status, new_status):
+    """
+    Raises InvalidTransition if the state machine does not allow going from old_status to new_status
+    :param old_status: current status of the user
+    :param new_status: requested status of the user
+    :return: None
+    """
+    if old_status != new_status and old_status not in ALLOWED_TRANSITIONS.get(new_status, ()):
+        raise InvalidTransition("Transition from " + str(old_status) + " to " + str(new_status) + " is not allowed")
+
+
+def compare_and_set(c, user_id, expected_statuses, new_status, partner_id, epoch):
+    """
+    Moves the user to new_status only if he/she is currently in one of expected_statuses, within the transaction of c
+    :param c: cursor of the current transaction
+    :param user_id: id of the user
+    :param expected_statuses: statuses the user is expected to be in
+    :param new_status: new status of the user
+    :param partner_id: new partner of the user, None to clear it
+    :param epoch: current startup epoch, rows of an older epoch are never matched (their stored status is stale)
+    :return: True if the user has been updated, False if he/she was not in an expected status
+    """
+    for expected_status in expected_statuses:
+        check_transition(expected_status, new_status)
+    placeholders = ",".join("?" * len(expected_statuses))
+    c.execute("UPDATE users SET status=?, partner_id=? "
+              "WHERE user_id=? AND epoch=? AND status IN (" + placeholders + ")",
+              (new_status, partner_id, user_id, epoch) + tuple(expected_statuses))
+    return c.rowcount == 1
@@ -0,0 +1,256 @@
+import threading
+import time
+
+from UserStatus import UserStatus
+
+
+class StatusCounters:
+    """
+    Number of users in each status, updated on every state transition so that reading it costs O(1)
+    """
+
+    def __init__(self):
+        self._counts = {status: 0 for status in UserStatus.possible_states}
+        self._lock = threading.Lock()
+
+    def load(self, counts):
+        """
+        Initializes the counters, e.g. from a single GROUP BY query at startup
+        :param counts: dict status -> number of users
+        :return: None
+        """
+        with self._lock:
+            self._counts = {status: 0 for status in UserStatus.possible_states}
+            self._counts.update(counts)
+
+    def added(self, status):
+        with self._lock:
+            self._counts[status] = self._counts.get(status, 0) + 1
+
+    def removed(self, status):
+        with self._lock:
+            self._counts[status] = self._counts.get(status, 0) - 1
+
+    def transition(self, old_status, new_status):
+        if old_status == new_status:
+            return
+        with self._lock:
+            self._counts[old_status] = self._counts.get(old_status, 0) - 1
+            self._counts[new_status] = self._counts.get(new_status, 0) + 1
+
+    def reset(self, status):
+        """
+        Moves every user to the given status
+        :param status: new status of all the users
+        :return: None
+        """
+        with self._lock:
+            total = sum(self._counts.values())
+            self._counts = {s: 0 for s in UserStatus.possible_states}
+            self._counts[status] = total
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def total(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+
+class RollingSeries:
+    """
+    Time series of fixed size: a ring buffer of `slots` slots of `slot_seconds` seconds each, keeping the count and the
+    sum of the values recorded in each slot. Old slots are overwritten, so memory never grows.
+    """
+
+    def __init__(self, slots=60, slot_seconds=60):
+        self.slots = slots
+        self.slot_seconds = slot_seconds
+        self._counts = [0] * slots
+        self._sums = [0.0] * slots
+        # Index (time // slot_seconds) of the period currently stored in each slot
+        self._periods = [-1] * slots
+        self._lock = threading.Lock()
+
+    def record(self, value=1.0, now=None):
+        period = int((time.time() if now is None else now) // self.slot_seconds)
+        slot = period % self.slots
+        with self._lock:
+            if self._periods[slot] != period:
+                # The slot holds an expired period, start it over
+                self._periods[slot] = period
+                self._counts[slot] = 0
+                self._sums[slot] = 0.0
+            self._counts[slot] += 1
+            self._sums[slot] += value
+
+    def window(self, periods=None, now=None):
+        """
+        :param periods: number of most recent slots to aggregate, all of them if None
+        :param now: current time.time()
+        :return: (count, sum) of the values recorded in the most recent `periods` slots
+        """
+        periods = self.slots if periods is None else min(periods, self.slots)
+        current = int((time.time() if now is None else now) // self.slot_seconds)
+        count = 0
+        total = 0.0
+        with self._lock:
+            for period in range(current - periods + 1, current + 1):
+                slot = period % self.slots
+                if self._periods[slot] == period:
+                    count += self._counts[slot]
+                    total += self._sums[slot]
+        return count, total
+
+    def take(self):
+        """
+        Empties the series, e.g. to send what has been recorded to the process aggregating the statistics
+        :return: list of the (period, count, sum) of the slots holding values
+        """
+        with self._lock:
+            slots = [(period, count, total) for period, count, total in zip(self._periods, self._counts, self._sums)
+                     if period >= 0 and count]
+            self._counts = [0] * self.slots
+            self._sums = [0.0] * self.slots
+            self._periods = [-1] * self.slots
+        return slots
+
+    def snapshot(self):
+        """
+        :return: list of the (period, count, sum) of the slots holding values
+        """
+        with self._lock:
+            return [(period, count, total) for period, count, total in zip(self._periods, self._counts, self._sums)
+                    if period >= 0 and count]
+
+    def merge(self, slots):
+        """
+        Adds values recorded by another series with the same slot_seconds, the periods older than the ones kept are
+        ignored
+        :param slots: list of (period, count, sum), as returned by take or snapshot
+        :return: None
+        """
+        with self._lock:
+            for period, count, total in slots:
+                slot = period % self.slots
+                if self._periods[slot] > period:
+                    continue
+                if self._periods[slot] < period:
+                    self._periods[slot] = period
+                    self._counts[slot] = 0
+                    self._sums[slot] = 0.0
+                self._counts[slot] += count
+                self._sums[slot] += total
+
+
+class Statistics:
+    """
+    Statistics of the bot: users per status and rolling series (one slot per minute, for the last hour) of pairs,
+    chat durations, queue waits and relayed messages
+    """
+
+    SERIES = ("pairs", "chat_durations", "queue_waits", "relayed_messages")
+
+    def __init__(self, slots=60, slot_seconds=60):
+        self.users = StatusCounters()
+        self.pairs = RollingSeries(slots, slot_seconds)
+        self.chat_durations = RollingSeries(slots, slot_seconds)
+        self.queue_waits = RollingSeries(slots, slot_seconds)
+        self.relayed_messages = RollingSeries(slots, slot_seconds)
+        # user_id -> time the current chat of the user started, only for the users in a chat
+        self._chat_started = {}
+        self._lock = threading.Lock()
+
+    def record_pair(self, user_id, other_user_id, waited):
+        """
+        :param user_id: id of the user who found the partner
+        :param other_user_id: id of the partner
+        :param waited: seconds the partner waited in the matchmaking queue
+        :return: None
+        """
+        now = time.time()
+        self.pairs.record(1, now)
+        self.queue_waits.record(waited, now)
+        with self._lock:
+            self._chat_started[user_id] = now
+            self._chat_started[other_user_id] = now
+
+    def record_chat_end(self, user_id, other_user_id, started=None):
+        """
+        :param user_id: id of the user who ended the chat
+        :param other_user_id: id of the partner
+        :param started: time.time() the chat started, the time recorded by record_pair in this process if None
+        :return: None
+        """
+        now = time.time()
+        with self._lock:
+            recorded = self._chat_started.pop(user_id, None)
+            self._chat_started.pop(other_user_id, None)
+        started = recorded if started is None else started
+        if started is not None:
+            self.chat_durations.record(now - started, now)
+
+    def record_relay(self):
+        self.relayed_messages.record()
+
+    def clear_chats(self):
+        with self._lock:
+            self._chat_started.clear()
+
+    def take_series(self):
+        """
+        Empties the rolling series, see RollingSeries.take
+        :return: dict name of the series -> its slots
+        """
+        return {name: getattr(self, name).take() for name in self.SERIES}
+
+    def snapshot_series(self):
+        """
+        :return: dict name of the series -> its slots, see RollingSeries.snapshot
+        """
+        return {name: getattr(self, name).snapshot() for name in self.SERIES}
+
+    def merge_series(self, series):
+        """
+        Adds the rolling series of another process, e.g. the ones of the workers of cluster.py
+        :param series: dict name of the series -> its slots, as returned by take_series or snapshot_series
+        :return: None
+        """
+        for name, slots in series.items():
+            getattr(self, name).merge(slots)
+
+    def report(self, counts=None):
+        """
+        :param counts: dict status -> number of users, the counters of this process if None
+        :return: text of the /stats message, with all the statistics
+        """
+        counts = self.users.snapshot() if counts is None else counts
+        minutes = self.pairs.slots * self.pairs.slot_seconds // 60
+        pairs, _ = self.pairs.window()
+        pairs_last_minute, _ = self.pairs.window(1)
+        chats, chats_duration = self.chat_durations.window()
+        waits, waits_duration = self.queue_waits.window()
+        relayed, _ = self.relayed_messages.window()
+        relayed_last_minute, _ = self.relayed_messages.window(1)
+        return ("📊 Bot statistics\n"
+                "Number of active users: " + str(sum(counts.values())) + "\n"
+                "Number of paired users: " + str(counts.get(UserStatus.COUPLED, 0)) + "\n"
+                "Users in search: " + str(counts.get(UserStatus.IN_SEARCH, 0)) + "\n"
+                "Users left by their partner: " + str(counts.get(UserStatus.PARTNER_LEFT, 0)) + "\n"
+                "Idle users: " + str(counts.get(UserStatus.IDLE, 0)) + "\n"
+                "\nLast " + str(minutes) + " minutes:\n"
+                "Pairs: " + str(pairs) + " (" + format(pairs / minutes, ".1f") + "/min, last minute "
+                + str(pairs_last_minute) + ")\n"
+                "Average chat duration: " + _format_seconds(chats_duration / chats if chats else 0) + "\n"
+                "Average queue wait: " + _format_seconds(waits_duration / waits if waits else 0) + "\n"
+                "Messages relayed: " + str(relayed) + " (last minute " + str(relayed_last_minute) + ")")
+
+
+def _format_seconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return (str(minutes) + "m " if minutes else "") + str(seconds) + "s"
+
+
+# Statistics of the whole process
+statistics = Statistics()
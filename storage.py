@@ -0,0 +1,848 @@
+import abc
+import functools
+import threading
+import time
+
+import settings
+from UserStatus import UserStatus
+from matchmaking import NO_PREFERENCES, MatchmakingQueue, Preferences
+from reply_index import KeyValueReplyIndex, ReplyIndex
+from session_cache import SessionCache, cache
+from state_machine import Transition, check_transition
+from stats import StatusCounters, statistics
+
+
+class StorageBackend(abc.ABC):
+    """
+    Storage of the users of the bot: lifecycle, status, pairing and statistics.
+    Every change of status follows the state machine (state_machine.ALLOWED_TRANSITIONS) and is atomic, and the
+    methods changing a status return a Transition.
+    """
+
+    # True if the methods block on I/O, so that async_db runs them on its database threads instead of the event loop
+    blocking = True
+
+    def create(self):
+        """
+        Creates the storage, or upgrades an existing one
+        :return: None
+        """
+
+    @abc.abstractmethod
+    def start(self, restore_pairs=False):
+        """
+        Starts a run of the bot: the users of the previous run are idle, unless restore_pairs is True and the previous
+        run was closed cleanly
+        :param restore_pairs: if True, the users coupled or in search after a clean shutdown still are
+        :return: True if the previous run has been restored
+        """
+
+    def close(self):
+        """
+        Records that the bot stopped cleanly, so that the next run can restore the pairs
+        :return: None
+        """
+
+    @abc.abstractmethod
+    def insert_user(self, user_id):
+        """
+        Adds the user as idle, if not already present
+        :param user_id: id of the user
+        :return: None
+        """
+
+    @abc.abstractmethod
+    def remove_user(self, user_id):
+        """
+        Removes the user, his/her partner (if any) is left alone
+        :param user_id: id of the user
+        :return: Transition, whose partner_id is the partner who has been left
+        """
+
+    @abc.abstractmethod
+    def get_user_status(self, user_id):
+        """
+        :param user_id: id of the user
+        :return: status of the user, None if the user does not exist
+        """
+
+    @abc.abstractmethod
+    def set_user_status(self, user_id, new_status, expected_status=None):
+        """
+        Moves the user to new_status, leaving his/her partner untouched
+        :param user_id: id of the user
+        :param new_status: new status of the user
+        :param expected_status: the status is changed only if the user is in this status (any status allowed by the
+        state machine if None)
+        :return: Transition
+        """
+
+    @abc.abstractmethod
+    def get_partner_id(self, user_id):
+        """
+        :param user_id: id of the user
+        :return: id of the partner of the user, None if he/she has no partner
+        """
+
+    def cached_partner_id(self, user_id):
+        """
+        Returns the partner of the user only if it is known without any I/O, e.g. for the dispatcher to keep the
+        updates of a pair in order
+        :param user_id: id of the user
+        :return: id of the partner, None if he/she has no partner or it is not known
+        """
+        return None
+
+    @functools.cached_property
+    def reply_index(self):
+        """
+        Index of the relayed messages, to copy the replies (see reply_index.py), called through async_db. Kept in this
+        process unless the backend is shared by several processes
+        """
+        return ReplyIndex(settings.REPLY_INDEX_SLOTS)
+
+    def get_preferences(self, user_id):
+        """
+        :param user_id: id of the user
+        :return: Preferences of the user about his/her partners
+        """
+        return NO_PREFERENCES
+
+    def set_preferences(self, user_id, preferences):
+        """
+        Stores the preferences of the user, used from his/her next search on
+        :param user_id: id of the user
+        :param preferences: Preferences of the user
+        :return: None
+        """
+
+    @abc.abstractmethod
+    def couple(self, user_id):
+        """
+        Starts the search of the user, pairing him/her with the compatible user waiting the longest if any
+        :param user_id: id of the user
+        :return: Transition, to COUPLED with the partner or to IN_SEARCH
+        """
+
+    def match_waiting(self):
+        """
+        Pairs the users in search who have waited long enough to accept a partner with other preferences (see
+        matchmaking.MatchmakingQueue.widen). Backends without a preference index pair any two users on search, so
+        there is nobody to pair later
+        :return: list of the (user_id, partner_id) pairs
+        """
+        return []
+
+    @abc.abstractmethod
+    def uncouple(self, user_id):
+        """
+        Ends the chat of the user, moving him/her and the partner to idle
+        :param user_id: id of the user
+        :return: Transition, whose partner_id is the former partner
+        """
+
+    @abc.abstractmethod
+    def count_users_by_status(self):
+        """
+        :return: dict status -> number of users
+        """
+
+    def retrieve_users_number(self):
+        """
+        :return: (number of users, number of coupled users)
+        """
+        counts = self.count_users_by_status()
+        return sum(counts.values()), counts.get(UserStatus.COUPLED, 0)
+
+    @abc.abstractmethod
+    def reset_users_status(self):
+        """
+        Moves every user to idle
+        :return: None
+        """
+
+    # Housekeeping (see housekeeping.py). Backends without a way to find the users to clean up do nothing
+
+    def expire_searches(self, older_than, limit):
+        """
+        Moves to idle the users in search for more than older_than seconds
+        :param older_than: seconds
+        :param limit: maximum number of users moved, the oldest searches first
+        :return: list of the ids of the users moved to idle
+        """
+        return []
+
+    def coupled_pairs(self):
+        """
+        :return: list of the (user_id, partner_id) coupled pairs, each pair once
+        """
+        return []
+
+    def touch(self, seen):
+        """
+        Records the time of the last update of the users
+        :param seen: dict user_id -> time.time() of his/her last update
+        :return: None
+        """
+
+    def archive_inactive(self, inactive_for, limit):
+        """
+        Moves the users who have not been seen for inactive_for seconds, and are neither coupled nor in search, to a
+        cold storage. They are brought back by insert_user
+        :param inactive_for: seconds
+        :param limit: maximum number of users moved
+        :return: number of users moved
+        """
+        return 0
+
+    def collect_statistics(self):
+        """
+        :return: Statistics with the pairs, chats and relays of every process of the bot, the ones of this process
+        unless the backend aggregates them elsewhere
+        """
+        return statistics
+
+
+class MemoryStorage(StorageBackend):
+    """
+    Everything in the memory of the process: the fastest backend, for tests and for single process deployments that
+    can lose the users on restart
+    """
+
+    blocking = False
+
+    def __init__(self):
+        # user_id -> (status, partner_id)
+        self._users = {}
+        # user_id -> Preferences, for the users who set them
+        self._preferences = {}
+        # user_id -> time.time() of the last update of the user, and the users archived after a long inactivity
+        self._last_seen = {}
+        self._archived = {}
+        # Hour of the last update -> user_ids last seen in that hour, so that archive_inactive() only looks at the
+        # users of the hours before its limit
+        self._seen_hours = {}
+        # (user_id, partner_id) of the coupled pairs, the smaller id first, so that the housekeeping does not scan
+        # every user
+        self._pairs = {}
+        self._queue = MatchmakingQueue(settings.MATCH_WIDEN_AFTER)
+        self._counts = StatusCounters()
+        self._lock = threading.RLock()
+
+    def start(self, restore_pairs=False):
+        # Nothing survives a restart
+        self.reset_users_status()
+        return False
+
+    def insert_user(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            if user_id not in self._users:
+                self._users[user_id] = (UserStatus.IDLE, None)
+                self._seen(user_id, time.time())
+                self._archived.pop(user_id, None)
+                self._counts.added(UserStatus.IDLE)
+
+    def remove_user(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            session = self._users.pop(user_id, None)
+            if session is None:
+                return Transition(False, None, None)
+            status, partner_id = session
+            self._counts.removed(status)
+            self._preferences.pop(user_id, None)
+            self._unseen(user_id)
+            self._queue.discard(user_id)
+            self._unpair(user_id, partner_id)
+            # If the user had a partner, the partner is left alone
+            if partner_id is not None and self._users.get(partner_id, (None,))[0] == UserStatus.COUPLED:
+                self._users[partner_id] = (UserStatus.PARTNER_LEFT, None)
+                self._counts.transition(UserStatus.COUPLED, UserStatus.PARTNER_LEFT)
+                statistics.record_chat_end(user_id, partner_id)
+            else:
+                partner_id = None
+        return Transition(True, None, partner_id)
+
+    def get_user_status(self, user_id):
+        session = self._users.get(str(user_id))
+        return None if session is None else session[0]
+
+    def set_user_status(self, user_id, new_status, expected_status=None):
+        user_id = str(user_id)
+        with self._lock:
+            session = self._users.get(user_id)
+            if session is None:
+                return Transition(False, None, None)
+            old_status, partner_id = session
+            if expected_status is not None and old_status != expected_status:
+                return Transition(False, old_status, partner_id)
+            check_transition(old_status, new_status)
+            self._users[user_id] = (new_status, partner_id)
+            self._counts.transition(old_status, new_status)
+            if new_status != UserStatus.IN_SEARCH:
+                self._queue.discard(user_id)
+            if new_status != UserStatus.COUPLED:
+                self._unpair(user_id, partner_id)
+        return Transition(True, new_status, partner_id)
+
+    def get_partner_id(self, user_id):
+        session = self._users.get(str(user_id))
+        return None if session is None else session[1]
+
+    def cached_partner_id(self, user_id):
+        return self.get_partner_id(user_id)
+
+    def get_preferences(self, user_id):
+        return self._preferences.get(str(user_id), NO_PREFERENCES)
+
+    def set_preferences(self, user_id, preferences):
+        self._preferences[str(user_id)] = preferences
+
+    def couple(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            session = self._users.get(user_id)
+            if session is None:
+                return Transition(False, None, None)
+            old_status, partner_id = session
+            # Users can search only if they are idle, left by their partner, or coupled with a partner that is gone
+            if old_status == UserStatus.IN_SEARCH or (old_status == UserStatus.COUPLED and partner_id is not None):
+                return Transition(False, old_status, partner_id)
+            check_transition(old_status, UserStatus.IN_SEARCH)
+            self._counts.transition(old_status, UserStatus.IN_SEARCH)
+            preferences = self.get_preferences(user_id)
+            match = self._queue.pair_or_enqueue(user_id, preferences=preferences)
+            # Skip the users who are no longer in search
+            while match is not None and self._users.get(match[0], (None,))[0] != UserStatus.IN_SEARCH:
+                match = self._queue.pair_or_enqueue(user_id, preferences=preferences)
+            if match is None:
+                self._users[user_id] = (UserStatus.IN_SEARCH, None)
+                return Transition(True, UserStatus.IN_SEARCH, None)
+            other_user_id, waited, _ = match
+            self._users[user_id] = (UserStatus.COUPLED, other_user_id)
+            self._users[other_user_id] = (UserStatus.COUPLED, user_id)
+            self._pair(user_id, other_user_id)
+            self._counts.transition(UserStatus.IN_SEARCH, UserStatus.COUPLED)
+            self._counts.transition(UserStatus.IN_SEARCH, UserStatus.COUPLED)
+        statistics.record_pair(user_id, other_user_id, waited)
+        return Transition(True, UserStatus.COUPLED, other_user_id)
+
+    def match_waiting(self):
+        coupled = []
+        with self._lock:
+            now = time.monotonic()
+            for user, other in self._queue.widen():
+                # The queue only holds users in search, who are paired as couple does
+                self._users[user.user_id] = (UserStatus.COUPLED, other.user_id)
+                self._users[other.user_id] = (UserStatus.COUPLED, user.user_id)
+                self._pair(user.user_id, other.user_id)
+                self._counts.transition(UserStatus.IN_SEARCH, UserStatus.COUPLED)
+                self._counts.transition(UserStatus.IN_SEARCH, UserStatus.COUPLED)
+                coupled.append((user.user_id, other.user_id, now - user.since))
+        for user_id, other_user_id, waited in coupled:
+            statistics.record_pair(user_id, other_user_id, waited)
+        return [(user_id, other_user_id) for user_id, other_user_id, _ in coupled]
+
+    def uncouple(self, user_id):
+        user_id = str(user_id)
+        with self._lock:
+            session = self._users.get(user_id)
+            if session is None:
+                return Transition(False, None, None)
+            old_status, partner_id = session
+            if old_status != UserStatus.COUPLED or partner_id is None:
+                return Transition(False, old_status, partner_id)
+            self._users[user_id] = (UserStatus.IDLE, None)
+            self._counts.transition(UserStatus.COUPLED, UserStatus.IDLE)
+            self._unpair(user_id, partner_id)
+            # The partner is moved only if he/she is still coupled with the user
+            if self._users.get(partner_id) == (UserStatus.COUPLED, user_id):
+                self._users[partner_id] = (UserStatus.IDLE, None)
+                self._counts.transition(UserStatus.COUPLED, UserStatus.IDLE)
+        statistics.record_chat_end(user_id, partner_id)
+        return Transition(True, UserStatus.IDLE, partner_id)
+
+    def count_users_by_status(self):
+        return self._counts.snapshot()
+
+    def reset_users_status(self):
+        with self._lock:
+            self._users = dict.fromkeys(self._users, (UserStatus.IDLE, None))
+            self._pairs.clear()
+            self._queue.clear()
+            self._counts.reset(UserStatus.IDLE)
+        statistics.clear_chats()
+
+    def expire_searches(self, older_than, limit):
+        expired = []
+        with self._lock:
+            for user_id in self._queue.stale(older_than, limit):
+                self._queue.discard(user_id)
+                if self._users.get(user_id) == (UserStatus.IN_SEARCH, None):
+                    self._users[user_id] = (UserStatus.IDLE, None)
+                    self._counts.transition(UserStatus.IN_SEARCH, UserStatus.IDLE)
+                    expired.append(user_id)
+        return expired
+
+    def _pair(self, user_id, partner_id):
+        self._pairs[(user_id, partner_id) if user_id < partner_id else (partner_id, user_id)] = None
+
+    def _unpair(self, user_id, partner_id):
+        if partner_id is not None:
+            self._pairs.pop((user_id, partner_id) if user_id < partner_id else (partner_id, user_id), None)
+
+    def coupled_pairs(self):
+        with self._lock:
+            return list(self._pairs)
+
+    def _seen(self, user_id, last_seen):
+        self._unseen(user_id)
+        self._last_seen[user_id] = last_seen
+        self._seen_hours.setdefault(int(last_seen // 3600), set()).add(user_id)
+
+    def _unseen(self, user_id):
+        last_seen = self._last_seen.pop(user_id, None)
+        if last_seen is not None:
+            hour = int(last_seen // 3600)
+            self._seen_hours[hour].discard(user_id)
+            if not self._seen_hours[hour]:
+                del self._seen_hours[hour]
+
+    def touch(self, seen):
+        with self._lock:
+            for user_id, last_seen in seen.items():
+                user_id = str(user_id)
+                if user_id in self._users:
+                    self._seen(user_id, last_seen)
+
+    def archive_inactive(self, inactive_for, limit):
+        before = time.time() - inactive_for
+        with self._lock:
+            # Only the users of the hours up to `before` are looked at, the least recently seen first. The coupled
+            # and searching ones among them are left to the other tasks
+            inactive = []
+            for hour in sorted(hour for hour in self._seen_hours if hour <= before // 3600):
+                for user_id in self._seen_hours[hour]:
+                    status = self._users[user_id][0]
+                    if self._last_seen[user_id] < before and status in (UserStatus.IDLE, UserStatus.PARTNER_LEFT):
+                        inactive.append(user_id)
+                        if len(inactive) == limit:
+                            break
+                if len(inactive) == limit:
+                    break
+            for user_id in inactive:
+                self._counts.removed(self._users.pop(user_id)[0])
+                self._archived[user_id] = self._last_seen[user_id]
+                self._unseen(user_id)
+        return len(inactive)
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    The SQLite database of db_connection, which survives restarts
+    """
+
+    def __init__(self, database=None, pool_size=4):
+        """
+        :param database: path of the SQLite database file, connection_manager.DATABASE_PATH if None
+        :param pool_size: maximum number of open connections
+        """
+        import connection_manager
+        import db_connection
+
+        if database is not None:
+            connection_manager.configure(database=database, size=pool_size)
+        self._db = db_connection
+
+    def create(self):
+        self._db.create_db()
+
+    def start(self, restore_pairs=False):
+        return self._db.start_epoch(restore_pairs=restore_pairs)
+
+    def close(self):
+        self._db.mark_clean_shutdown()
+
+    def insert_user(self, user_id):
+        self._db.insert_user(user_id)
+
+    def remove_user(self, user_id):
+        return self._db.remove_user(user_id)
+
+    def get_user_status(self, user_id):
+        return self._db.get_user_status(user_id)
+
+    def set_user_status(self, user_id, new_status, expected_status=None):
+        return self._db.set_user_status(user_id, new_status, expected_status)
+
+    def get_partner_id(self, user_id):
+        return self._db.get_partner_id(user_id)
+
+    def cached_partner_id(self, user_id):
+        session = cache.peek(str(user_id))
+        return None if session is None else session[1]
+
+    def get_preferences(self, user_id):
+        return self._db.get_preferences(user_id)
+
+    def set_preferences(self, user_id, preferences):
+        self._db.set_preferences(user_id, preferences)
+
+    def couple(self, user_id):
+        return self._db.couple(user_id)
+
+    def match_waiting(self):
+        return self._db.match_waiting()
+
+    def uncouple(self, user_id):
+        return self._db.uncouple(user_id)
+
+    def count_users_by_status(self):
+        return self._db.count_users_by_status()
+
+    def retrieve_users_number(self):
+        return self._db.retrieve_users_number()
+
+    def reset_users_status(self):
+        self._db.reset_users_status()
+
+    def expire_searches(self, older_than, limit):
+        return self._db.expire_searches(older_than, limit)
+
+    def coupled_pairs(self):
+        return self._db.coupled_pairs()
+
+    def touch(self, seen):
+        self._db.touch(seen)
+
+    def archive_inactive(self, inactive_for, limit):
+        return self._db.archive_inactive(inactive_for, limit)
+
+
+class KeyValueStorage(StorageBackend):
+    """
+    Users stored in a key-value server speaking the Redis protocol (the stand-in kv_server or a real Redis), shared by
+    every process connected to it. Each change of status is an optimistic transaction (WATCH/MULTI/EXEC), retried if
+    another process changed the same users in the meantime.
+    Keys:
+    - user:<user_id>: hash with the status, the partner ("" if none), the epoch and the time the search or the chat
+      started (so that any process can record the duration of a chat)
+    - search: list of the users in search, oldest first
+    - counts: hash status -> number of users
+    - preferences:<user_id>: hash with the language, the region and the interests (separated by commas) of the user.
+      The search list is shared by every process, so searches ignore them and pair any two users
+    The housekeeping only expires the searches: finding the idle pairs or the inactive users would need a scan of every
+    key.
+    - epoch, clean_shutdown: as the meta table of db_connection, rows of an older epoch are idle
+    - replies:<user_id>:<partner_id>: the reply index (see reply_index.KeyValueReplyIndex)
+    The sessions read or written by this process are kept in a local SessionCache, only for cached_partner_id: another
+    process may have changed them since.
+    """
+
+    def __init__(self, host="127.0.0.1", port=6380):
+        """
+        :param host: address of the key-value server
+        :param port: port of the key-value server
+        """
+        from kv_server import KeyValueClient
+
+        self._client = KeyValueClient(host, port)
+        self._epoch = None
+        self._sessions = SessionCache()
+
+    @functools.cached_property
+    def reply_index(self):
+        # Shared by the workers of the sharded mode, where a reply and the copy it replies to have different workers
+        return KeyValueReplyIndex(self._client, settings.REPLY_INDEX_SLOTS, settings.REPLY_INDEX_TTL_SECONDS)
+
+    def _current_epoch(self):
+        if self._epoch is None:
+            self._epoch = int(self._client.execute("GET", "epoch") or 0)
+        return self._epoch
+
+    def _read(self, key):
+        # Read (status, partner_id, search started) of a user, (None, None, None) if the user does not exist
+        values = self._client.execute("HGETALL", key)
+        if not values:
+            self._sessions.invalidate(key[5:])
+            return None, None, None
+        user = dict(zip(values[::2], values[1::2]))
+        if int(user.get("epoch", 0)) != self._current_epoch():
+            # The user belongs to a previous run of the bot
+            self._sessions.put(key[5:], UserStatus.IDLE, None)
+            return UserStatus.IDLE, None, None
+        status, partner_id = user["status"], user.get("partner") or None
+        self._sessions.put(key[5:], status, partner_id)
+        return status, partner_id, float(user.get("since") or 0)
+
+    def _unwatch(self, result):
+        self._client.execute("UNWATCH")
+        return result
+
+    def create(self):
+        self._client.execute("PING")
+
+    def start(self, restore_pairs=False):
+        epoch, clean_shutdown, counts = self._client.pipeline([("GET", "epoch"), ("GET", "clean_shutdown"),
+                                                               ("HGETALL", "counts")])
+        restored = bool(restore_pairs and clean_shutdown == "1")
+        commands = [("SET", "clean_shutdown", 0)]
+        if not restored:
+            total = sum(int(value) for value in counts[1::2])
+            commands += [("INCRBY", "epoch", 1), ("DEL", "search"), ("DEL", "counts"),
+                         ("HSET", "counts", UserStatus.IDLE, total)]
+        self._client.multi_exec(commands)
+        self._epoch = int(epoch or 0) + (0 if restored else 1)
+        self._sessions.clear()
+        statistics.clear_chats()
+        return restored
+
+    def close(self):
+        self._client.execute("SET", "clean_shutdown", 1)
+
+    def insert_user(self, user_id):
+        key = "user:" + str(user_id)
+        while True:
+            self._client.execute("WATCH", key)
+            if self._client.execute("EXISTS", key):
+                return self._unwatch(None)
+            if self._client.multi_exec([("HSET", key, "status", UserStatus.IDLE, "partner", "",
+                                         "epoch", self._current_epoch()),
+                                        ("HINCRBY", "counts", UserStatus.IDLE, 1)]) is not None:
+                return None
+
+    def remove_user(self, user_id):
+        user_id = str(user_id)
+        key = "user:" + user_id
+        while True:
+            self._client.execute("WATCH", key)
+            status, partner_id, since = self._read(key)
+            if status is None:
+                return self._unwatch(Transition(False, None, None))
+            commands = [("DEL", key, "preferences:" + user_id), ("LREM", "search", 0, user_id),
+                        ("HINCRBY", "counts", status, -1)]
+            if partner_id is not None:
+                # If the user had a partner, the partner is left alone
+                partner_key = "user:" + partner_id
+                self._client.execute("WATCH", partner_key)
+                if self._read(partner_key)[0] == UserStatus.COUPLED:
+                    commands += [("HSET", partner_key, "status", UserStatus.PARTNER_LEFT, "partner", ""),
+                                 ("HINCRBY", "counts", UserStatus.COUPLED, -1),
+                                 ("HINCRBY", "counts", UserStatus.PARTNER_LEFT, 1)]
+                else:
+                    partner_id = None
+            if self._client.multi_exec(commands) is not None:
+                break
+        self._sessions.invalidate(user_id)
+        if partner_id is not None:
+            self._sessions.put(partner_id, UserStatus.PARTNER_LEFT, None)
+            statistics.record_chat_end(user_id, partner_id, started=since or None)
+        return Transition(True, None, partner_id)
+
+    def get_user_status(self, user_id):
+        return self._read("user:" + str(user_id))[0]
+
+    def set_user_status(self, user_id, new_status, expected_status=None):
+        user_id = str(user_id)
+        key = "user:" + user_id
+        while True:
+            self._client.execute("WATCH", key)
+            old_status, partner_id, _ = self._read(key)
+            if old_status is None:
+                return self._unwatch(Transition(False, None, None))
+            if expected_status is not None and old_status != expected_status:
+                return self._unwatch(Transition(False, old_status, partner_id))
+            check_transition(old_status, new_status)
+            commands = [("HSET", key, "status", new_status, "partner", partner_id or "",
+                         "epoch", self._current_epoch(), "since", time.time()),
+                        ("HINCRBY", "counts", old_status, -1), ("HINCRBY", "counts", new_status, 1)]
+            if new_status != UserStatus.IN_SEARCH:
+                # The user stopped searching, take him/her out of the search list
+                commands.append(("LREM", "search", 0, user_id))
+            if self._client.multi_exec(commands) is not None:
+                self._sessions.put(user_id, new_status, partner_id)
+                return Transition(True, new_status, partner_id)
+
+    def get_partner_id(self, user_id):
+        return self._read("user:" + str(user_id))[1]
+
+    def cached_partner_id(self, user_id):
+        session = self._sessions.peek(str(user_id))
+        return None if session is None else session[1]
+
+    def get_preferences(self, user_id):
+        values = self._client.execute("HGETALL", "preferences:" + str(user_id))
+        if not values:
+            return NO_PREFERENCES
+        preferences = dict(zip(values[::2], values[1::2]))
+        interests = preferences.get("interests")
+        return Preferences(preferences.get("language") or None, preferences.get("region") or None,
+                           tuple(interests.split(",")) if interests else ())
+
+    def set_preferences(self, user_id, preferences):
+        self._client.execute("HSET", "preferences:" + str(user_id), "language", preferences.language or "",
+                             "region", preferences.region or "", "interests", ",".join(preferences.interests))
+
+    def couple(self, user_id):
+        user_id = str(user_id)
+        key = "user:" + user_id
+        epoch = self._current_epoch()
+        while True:
+            self._client.execute("WATCH", key, "search")
+            old_status, partner_id, _ = self._read(key)
+            if old_status is None:
+                return self._unwatch(Transition(False, None, None))
+            # Users can search only if they are idle, left by their partner, or coupled with a partner that is gone
+            if old_status == UserStatus.IN_SEARCH or (old_status == UserStatus.COUPLED and partner_id is not None):
+                return self._unwatch(Transition(False, old_status, partner_id))
+            check_transition(old_status, UserStatus.IN_SEARCH)
+            head = self._client.execute("LRANGE", "search", 0, 0)
+            now = time.time()
+            if not head:
+                # Nobody is waiting, the user waits in the search list
+                if self._client.multi_exec([("RPUSH", "search", user_id),
+                                            ("HSET", key, "status", UserStatus.IN_SEARCH, "partner", "",
+                                             "epoch", epoch, "since", now),
+                                            ("HINCRBY", "counts", old_status, -1),
+                                            ("HINCRBY", "counts", UserStatus.IN_SEARCH, 1)]) is not None:
+                    self._sessions.put(user_id, UserStatus.IN_SEARCH, None)
+                    return Transition(True, UserStatus.IN_SEARCH, None)
+                continue
+            other_user_id = head[0]
+            other_key = "user:" + other_user_id
+            self._client.execute("WATCH", other_key)
+            other_status, _, other_since = self._read(other_key)
+            if other_user_id == user_id or other_status != UserStatus.IN_SEARCH:
+                # The head of the list is no longer in search, drop it and look again
+                self._client.multi_exec([("LREM", "search", 1, other_user_id)])
+                continue
+            if self._client.multi_exec([("LREM", "search", 1, other_user_id),
+                                        ("HSET", key, "status", UserStatus.COUPLED, "partner", other_user_id,
+                                         "epoch", epoch, "since", now),
+                                        ("HSET", other_key, "status", UserStatus.COUPLED, "partner", user_id,
+                                         "since", now),
+                                        ("HINCRBY", "counts", old_status, -1),
+                                        ("HINCRBY", "counts", UserStatus.IN_SEARCH, -1),
+                                        ("HINCRBY", "counts", UserStatus.COUPLED, 2)]) is not None:
+                self._sessions.put(user_id, UserStatus.COUPLED, other_user_id)
+                self._sessions.put(other_user_id, UserStatus.COUPLED, user_id)
+                statistics.record_pair(user_id, other_user_id, max(0.0, now - other_since))
+                return Transition(True, UserStatus.COUPLED, other_user_id)
+
+    def uncouple(self, user_id):
+        user_id = str(user_id)
+        key = "user:" + user_id
+        while True:
+            self._client.execute("WATCH", key)
+            old_status, partner_id, since = self._read(key)
+            if old_status is None:
+                return self._unwatch(Transition(False, None, None))
+            if old_status != UserStatus.COUPLED or partner_id is None:
+                return self._unwatch(Transition(False, old_status, partner_id))
+            partner_key = "user:" + partner_id
+            self._client.execute("WATCH", partner_key)
+            partner_status, partners_partner_id, _ = self._read(partner_key)
+            commands = [("HSET", key, "status", UserStatus.IDLE, "partner", ""),
+                        ("HINCRBY", "counts", UserStatus.COUPLED, -1), ("HINCRBY", "counts", UserStatus.IDLE, 1)]
+            # The partner is moved only if he/she is still coupled with the user
+            if partner_status == UserStatus.COUPLED and partners_partner_id == user_id:
+                commands += [("HSET", partner_key, "status", UserStatus.IDLE, "partner", ""),
+                             ("HINCRBY", "counts", UserStatus.COUPLED, -1), ("HINCRBY", "counts", UserStatus.IDLE, 1)]
+            if self._client.multi_exec(commands) is not None:
+                break
+        self._sessions.put(user_id, UserStatus.IDLE, None)
+        if partner_status == UserStatus.COUPLED and partners_partner_id == user_id:
+            self._sessions.put(partner_id, UserStatus.IDLE, None)
+        statistics.record_chat_end(user_id, partner_id, started=since or None)
+        return Transition(True, UserStatus.IDLE, partner_id)
+
+    def count_users_by_status(self):
+        values = self._client.execute("HGETALL", "counts")
+        counts = {status: 0 for status in UserStatus.possible_states}
+        counts.update((status, int(count)) for status, count in zip(values[::2], values[1::2]))
+        return counts
+
+    def reset_users_status(self):
+        self.start()
+
+    def expire_searches(self, older_than, limit):
+        # The search list is in FIFO order, the oldest searches are at its head
+        user_ids = self._client.execute("LRANGE", "search", 0, limit - 1)
+        now = time.time()
+        expired = []
+        for user_id in user_ids:
+            status, _, since = self._read("user:" + user_id)
+            if status == UserStatus.IN_SEARCH and now - since < older_than:
+                break
+            if self.set_user_status(user_id, UserStatus.IDLE, expected_status=UserStatus.IN_SEARCH).applied:
+                expired.append(user_id)
+            else:
+                # No longer in search
+                self._client.execute("LREM", "search", 0, user_id)
+        return expired
+
+
+# Backends that can be chosen with settings.STORAGE_BACKEND
+BACKENDS = {
+    "memory": MemoryStorage,
+    "sqlite": SQLiteStorage,
+    "kv": KeyValueStorage,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def create_backend(name, **options):
+    """
+    :param name: name of the backend, one of BACKENDS
+    :param options: arguments of the constructor of the backend
+    :return: a new backend
+    """
+    if name not in BACKENDS:
+        raise ValueError("Unknown storage backend " + repr(name) + ", expected one of " + ", ".join(BACKENDS))
+    return BACKENDS[name](**options)
+
+
+def get_backend():
+    """
+    Returns the process-wide storage backend, creating the one chosen in settings on first use
+    :return: the StorageBackend instance
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if settings.STORAGE_BACKEND == "sqlite":
+                    options = {"database": settings.DATABASE_PATH}
+                elif settings.STORAGE_BACKEND == "kv":
+                    options = {"host": settings.KV_HOST, "port": settings.KV_PORT}
+                else:
+                    options = {}
+                _backend = create_backend(settings.STORAGE_BACKEND, **options)
+    return _backend
+
+
+def install(backend):
+    """
+    Makes the given backend the process-wide one, e.g. a backend that is not in BACKENDS
+    :param backend: the StorageBackend instance
+    :return: None
+    """
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+def configure(name, **options):
+    """
+    Replaces the process-wide storage backend
+    :param name: name of the backend, one of BACKENDS
+    :param options: arguments of the constructor of the backend
+    :return: the new backend
+    """
+    global _backend
+    with _backend_lock:
+        _backend = create_backend(name, **options)
+    return _backend
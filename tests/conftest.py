@@ -0,0 +1,57 @@
+import multiprocessing
+import os
+import sys
+
+import pytest
+
+# The modules of the bot are at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def database(tmp_path):
+    """
+    Points db_connection to a new database at the latest schema version
+    :return: path of the database file
+    """
+    import connection_manager
+    import db_connection
+
+    path = str(tmp_path / "chatbot_database.db")
+    connection_manager.configure(database=path)
+    db_connection.create_db()
+    db_connection.start_epoch()
+    return path
+
+
+@pytest.fixture
+def backend(request, tmp_path):
+    """
+    A started storage backend, of the kind named by the parameter of the test (indirect parametrization), e.g.
+    @pytest.mark.parametrize("backend", ["memory", "sqlite", "kv", "sharded"], indirect=True)
+    "sharded" is the backend of a worker of cluster.py, with its coordinator running in another process
+    :return: the StorageBackend
+    """
+    import storage
+    from kv_server import KeyValueServer
+
+    if request.param == "sqlite":
+        backend = storage.create_backend("sqlite", database=str(tmp_path / "chatbot_database.db"))
+    elif request.param == "kv":
+        backend = storage.create_backend("kv", port=KeyValueServer(port=0).start_in_thread())
+    elif request.param == "sharded":
+        from cluster import ShardedStorage, run_coordinator
+
+        context = multiprocessing.get_context("spawn")
+        ready, ready_sender = context.Pipe(duplex=False)
+        authkey = os.urandom(32)
+        coordinator = context.Process(target=run_coordinator, args=(ready_sender, authkey), daemon=True)
+        coordinator.start()
+        request.addfinalizer(coordinator.terminate)
+        kv_host, kv_port, coordinator_address = ready.recv()
+        backend = ShardedStorage(kv_host, kv_port, coordinator_address, authkey)
+    else:
+        backend = storage.create_backend(request.param)
+    backend.create()
+    backend.start()
+    return backend
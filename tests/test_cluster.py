@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+from telegram import Update
+
+from cluster import Cluster, shard_of, worker_rates
+from load_test import TOKEN, FakeBotAPI
+
+
+class _TimedFakeBotAPI(FakeBotAPI):
+    # Also records when each message of the bot was accepted
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.sent_times = []
+
+    def _dispatch(self, method, params):
+        status, result = super()._dispatch(method, params)
+        if method == "sendMessage" and status == 200:
+            self.sent_times.append(time.monotonic())
+        return status, result
+
+
+def _message(api, user_id, text):
+    message = {"message_id": api.next_message_id(user_id), "date": int(time.time()), "text": text,
+               "chat": {"id": user_id, "type": "private"},
+               "from": {"id": user_id, "is_bot": False, "first_name": "User" + str(user_id)}}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return message
+
+
+async def _run_cluster(api, workers, rates, test):
+    # Runs test(send) against a cluster of the given number of workers, the workers send to the stand-in API
+    loop = asyncio.get_running_loop()
+    await api.start()
+    cluster = Cluster(workers, TOKEN, base_url=api.base_url, rates=rates)
+    try:
+        # Spawning the processes blocks, let the stand-in API answer in the meantime
+        await loop.run_in_executor(None, cluster.start)
+        router = cluster.build_router()
+        update_ids = iter(range(1, 1000000))
+
+        async def send(user_id, text):
+            message = _message(api, user_id, text)
+            await router.process_update(Update.de_json({"update_id": next(update_ids), "message": message},
+                                                       router.bot))
+            return message["message_id"]
+
+        async with router:
+            await test(send)
+    finally:
+        # The workers handle what has been forwarded and deliver their outbound calls before exiting
+        await loop.run_in_executor(None, cluster.stop)
+        await api.stop()
+    return cluster
+
+
+async def _wait_for(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.05)
+
+
+def test_worker_rates_add_up_to_the_rates_of_the_bot():
+    rates = {"global_rate": 30, "global_burst": 30, "chat_rate": 1, "chat_burst": 3}
+    shares = [worker_rates(rates, 4) for _ in range(4)]
+    assert sum(share["global_rate"] for share in shares) == 30
+    assert sum(share["global_burst"] for share in shares) == 30
+    assert all(share["chat_rate"] == 1 and share["chat_burst"] == 3 for share in shares)
+
+
+def test_updates_are_relayed_in_order_by_the_worker_of_their_user():
+    api = FakeBotAPI()
+    # Pairs of users owned by different workers, so that each pair is made across shards by the coordinator
+    users = range(1000000, 1000100)
+    pairs = list(zip([user for user in users if shard_of(user, 2) == 0],
+                     [user for user in users if shard_of(user, 2) == 1]))[:4]
+    sent = {}
+
+    async def test(send):
+        for first, second in pairs:
+            for user_id in (first, second):
+                await send(user_id, "/start")
+                await send(user_id, "/chat")
+            await _wait_for(lambda: api.paired_events[first].is_set() and api.paired_events[second].is_set())
+        for index in range(10):
+            for pair in pairs:
+                for user_id in pair:
+                    sent.setdefault(user_id, []).append(await send(user_id, "message " + str(index)))
+        await _wait_for(lambda: len(api.copies) == 10 * len(sent))
+
+    rates = {"global_rate": 1000, "global_burst": 1000, "chat_rate": 100, "chat_burst": 100}
+    cluster = asyncio.run(_run_cluster(api, 2, rates, test))
+
+    # Every update went to the worker owning its user: the users of each shard sent as many updates
+    assert cluster.forwarded_by_shard == [cluster.forwarded // 2] * 2
+    for first, second in pairs:
+        for user_id, partner_id in ((first, second), (second, first)):
+            # Each message is copied once, to the partner, and in the order it was sent
+            assert [api.copies[(user_id, message_id)][0] for message_id in sent[user_id]] == [partner_id] * 10
+            assert [api.originals[(partner_id, copy_id)] for copy_id in api.received[partner_id]] == \
+                [(user_id, message_id) for message_id in sent[user_id]]
+
+
+def test_workers_share_the_global_rate_of_the_bot():
+    # The stand-in API answers 429 above the global rate given to the cluster, whatever the number of workers (with a
+    # message of margin per worker, for the time the messages take to reach it)
+    api = _TimedFakeBotAPI(enforce_limits=True, chat_limit=(100, 100), global_limit=(20, 23))
+    rates = {"global_rate": 20, "global_burst": 20, "chat_rate": 100, "chat_burst": 100}
+    users = range(1000000, 1000080)
+
+    async def test(send):
+        for user_id in users:
+            await send(user_id, "/start")
+        await _wait_for(lambda: len(api.sent_times) == len(users))
+
+    asyncio.run(_run_cluster(api, 3, rates, test))
+    assert api.rate_limited == 0
+    times = api.sent_times
+    # Token bucket of the whole bot: at most the burst and then 20 messages per second, in any window
+    for first in range(len(times)):
+        for last in range(first, len(times)):
+            assert last - first + 1 <= 23 + 20 * (times[last] - times[first])
@@ -0,0 +1,138 @@
+import asyncio
+import random
+
+import pytest
+from telegram import Update
+
+import storage
+from dispatcher import OrderedUpdateProcessor
+from UserStatus import UserStatus
+
+
+def _update(update_id, user_id):
+    return Update.de_json({"update_id": update_id,
+                           "message": {"message_id": update_id, "date": 0, "text": "message " + str(update_id),
+                                       "chat": {"id": user_id, "type": "private"},
+                                       "from": {"id": user_id, "is_bot": False, "first_name": "User"}}}, None)
+
+
+def test_only_do_process_update_is_implemented():
+    # process_update is final in BaseUpdateProcessor
+    assert "process_update" not in OrderedUpdateProcessor.__dict__
+    assert "do_process_update" in OrderedUpdateProcessor.__dict__
+
+
+def test_updates_of_a_pair_are_processed_in_order():
+    backend = storage.create_backend("memory")
+    storage.install(backend)
+    pairs = [(str(1000 + 2 * i), str(1001 + 2 * i)) for i in range(20)]
+    for user_id, partner_id in pairs:
+        backend.insert_user(user_id)
+        backend.insert_user(partner_id)
+        backend.couple(user_id)
+        backend.couple(partner_id)
+    pair_of = {user_id: pair for pair in pairs for user_id in pair}
+    rng = random.Random(0)
+    # pair -> ids of the updates, in the order their processing started
+    started = {pair: [] for pair in pairs}
+    running = set()
+    concurrency = []
+
+    async def handle(update_id, pair):
+        assert pair not in running
+        running.add(pair)
+        concurrency.append(len(running))
+        started[pair].append(update_id)
+        await asyncio.sleep(rng.random() / 1000)
+        running.discard(pair)
+
+    async def test():
+        processor = OrderedUpdateProcessor(max_concurrent_updates=8)
+        tasks = []
+        for update_id in range(1000):
+            user_id = rng.choice(rng.choice(pairs))
+            tasks.append(asyncio.create_task(processor.process_update(_update(update_id, int(user_id)),
+                                                                       handle(update_id, pair_of[user_id]))))
+        await asyncio.gather(*tasks)
+        return processor
+
+    processor = asyncio.run(test())
+    for update_ids in started.values():
+        assert update_ids == sorted(update_ids)
+    assert sum(map(len, started.values())) == 1000
+    # Different pairs ran in parallel, up to max_concurrent_updates
+    assert 1 < max(concurrency) <= 8
+    assert processor.pending == 0 and processor.throttled == 0
+
+
+def test_updates_above_the_limit_of_a_user_are_refused_not_dropped():
+    storage.install(storage.create_backend("memory"))
+    handled = []
+
+    async def handle(update_id):
+        await asyncio.sleep(0.01)
+        handled.append(update_id)
+
+    async def test():
+        processor = OrderedUpdateProcessor(max_pending_per_user=2)
+        tasks = [asyncio.create_task(processor.process_update(_update(update_id, 1000), handle(update_id)))
+                 for update_id in range(3)]
+        await asyncio.sleep(0)
+        # Every update already queued is processed, the next ones are refused until the user catches up
+        accepted = [processor.accepts(_update(3, 1000)), processor.accepts(_update(3, 1001))]
+        await asyncio.gather(*tasks)
+        return processor, accepted + [processor.accepts(_update(3, 1000))]
+
+    processor, accepted = asyncio.run(test())
+    assert accepted == [False, True, True]
+    assert processor.throttled == 1 and processor.pending == 0
+    assert handled == [0, 1, 2]
+
+
+def test_updates_are_queued_on_all_their_keys_on_arrival():
+    # 1 waits for 0 on the key of 1000 while 1001 is coupled with 1000, then 2 arrives from 1001 alone once the chat
+    # has ended: it must still run after 1, which arrived first on the key of 1001
+    backend = storage.create_backend("memory")
+    storage.install(backend)
+    backend.insert_user("1000")
+    backend.insert_user("1001")
+    handled = []
+
+    async def handle(update_id):
+        await asyncio.sleep(0.01)
+        handled.append(update_id)
+
+    async def test():
+        processor = OrderedUpdateProcessor()
+
+        async def arrive(update_id, user_id):
+            task = asyncio.create_task(processor.process_update(_update(update_id, user_id), handle(update_id)))
+            await asyncio.sleep(0)
+            return task
+
+        tasks = [await arrive(0, 1000)]
+        backend.couple("1000")
+        backend.couple("1001")
+        tasks.append(await arrive(1, 1001))
+        backend.uncouple("1001")
+        tasks.append(await arrive(2, 1001))
+        await asyncio.gather(*tasks)
+
+    asyncio.run(test())
+    assert handled == [0, 1, 2]
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite", "kv", "sharded"], indirect=True)
+def test_partner_is_cached_once_read_or_changed(backend):
+    for user_id in ("1", "2"):
+        backend.insert_user(user_id)
+    backend.couple("1")
+    assert backend.couple("2") == (True, UserStatus.COUPLED, "1")
+    assert backend.cached_partner_id("2") == "1"
+    # With the kv and sharded backends the other partner is known once his/her session has been read, as bot.py
+    # does on every update
+    assert backend.get_user_status("1") == UserStatus.COUPLED
+    assert backend.cached_partner_id("1") == "2"
+    backend.uncouple("1")
+    assert backend.cached_partner_id("1") is None
+    assert backend.cached_partner_id("2") is None
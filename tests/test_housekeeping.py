@@ -0,0 +1,20 @@
+import time
+
+import housekeeping
+
+
+def test_activity_forgets_the_least_recently_seen_users():
+    activity = housekeeping.Activity()
+    activity.touch("1")
+    activity.touch("2")
+    time.sleep(0.001)
+    activity.touch("1")
+    seen = activity.last_seen("1")
+    activity.forget_before(seen)
+    assert len(activity) == 1
+    assert activity.last_seen("1") == seen
+    # Forgotten users are older than the time they were forgotten at
+    assert activity.last_seen("2") == seen
+    activity.forget_before(time.time())
+    assert len(activity) == 0
+    assert list(activity.take_unsaved()) == ["1", "2"]
@@ -0,0 +1,53 @@
+import time
+
+from kv_server import KeyValueClient, KeyValueServer
+
+
+def test_transactions_abort_when_a_watched_key_changes():
+    server = KeyValueServer(port=0)
+    port = server.start_in_thread()
+    client, other = KeyValueClient(port=port), KeyValueClient(port=port)
+    client.execute("WATCH", "a")
+    other.execute("SET", "a", "1")
+    assert client.multi_exec([("SET", "a", "2")]) is None
+    client.execute("WATCH", "a")
+    assert client.multi_exec([("SET", "a", "2")]) == ["OK"]
+    # Deleting a watched key aborts as well
+    client.execute("WATCH", "a")
+    other.execute("DEL", "a")
+    assert client.multi_exec([("SET", "a", "3")]) is None
+    assert client.execute("GET", "a") is None
+
+
+def test_only_the_watched_keys_are_tracked():
+    server = KeyValueServer(port=0)
+    port = server.start_in_thread()
+    client = KeyValueClient(port=port)
+    for index in range(100):
+        client.execute("WATCH", "user:" + str(index))
+        client.multi_exec([("HSET", "user:" + str(index), "status", "idle")])
+        client.execute("DEL", "user:" + str(index))
+    client.execute("WATCH", "user:0")
+    assert list(server._watchers) == [b"user:0"]
+    client.execute("UNWATCH")
+    assert client.execute("DBSIZE") == 0
+    assert server._watchers == {}
+
+
+def test_keys_expire_once_their_time_to_live_is_over():
+    server = KeyValueServer(port=0)
+    port = server.start_in_thread()
+    client = KeyValueClient(port=port)
+    client.execute("HSET", "a", "f", "1")
+    client.execute("HSET", "b", "f", "1")
+    assert client.execute("EXPIRE", "a", 1) == 1
+    assert client.execute("EXPIRE", "missing", 1) == 0
+    # Refreshing the time to live does not queue the key again
+    for seconds in range(1, 61):
+        client.execute("EXPIRE", "b", seconds)
+    assert len(server._expiry_order) == 2
+    assert client.execute("TTL", "a") == 1 and client.execute("TTL", "c") == -2
+    time.sleep(1.1)
+    assert client.execute("EXISTS", "a") == 0
+    assert client.execute("TTL", "b") == 59
+    assert client.execute("DBSIZE") == 1
@@ -0,0 +1,70 @@
+import random
+
+from matchmaking import NO_PREFERENCES, MatchmakingQueue, make_preferences
+
+NEVER = (float("inf"),) * 3
+
+
+def _compatible(a, b):
+    # The users share every preference, a field left to any matching every value
+    def same(x, y):
+        return x is None or y is None or x == y
+
+    return (same(a.language, b.language) and same(a.region, b.region) and
+            (not a.interests or not b.interests or bool(set(a.interests) & set(b.interests))))
+
+
+def test_users_without_preferences_are_paired_right_away():
+    queue = MatchmakingQueue(NEVER)
+    assert queue.pair_or_enqueue("1", preferences=make_preferences("en", "eu", ["music"])) is None
+    assert queue.pair_or_enqueue("2")[0] == "1"
+    assert queue.pair_or_enqueue("3") is None
+    assert queue.pair_or_enqueue("4", preferences=make_preferences("it", interests=["art"]))[0] == "3"
+    assert len(queue) == 0
+
+
+def test_any_matches_every_value():
+    queue = MatchmakingQueue(NEVER)
+    queue.pair_or_enqueue("1", preferences=make_preferences("en", "any"))
+    queue.pair_or_enqueue("2", preferences=make_preferences("it", "eu"))
+    assert queue.pair_or_enqueue("3", preferences=make_preferences("it", "asia")) is None
+    assert queue.pair_or_enqueue("4", preferences=make_preferences("en", "asia", ["music"]))[0] == "1"
+    assert queue.pair_or_enqueue("5", preferences=make_preferences("any", "eu"))[0] == "2"
+    assert queue.matches == [2, 0, 0, 0]
+
+
+def test_other_preferences_wait_until_widened():
+    queue = MatchmakingQueue((0, 0, 0))
+    assert queue.pair_or_enqueue("1", since=0, preferences=make_preferences("en", "eu", ["music"])) is None
+    # Only the language in common, paired at level 2 since the thresholds are 0
+    assert queue.pair_or_enqueue("2", preferences=make_preferences("en", "asia", ["art"]))[0] == "1"
+    assert queue.matches == [0, 0, 1, 0]
+    queue = MatchmakingQueue(NEVER)
+    queue.pair_or_enqueue("1", preferences=make_preferences("en"))
+    assert queue.pair_or_enqueue("2", preferences=make_preferences("it")) is None
+    assert queue.widen() == []
+
+
+def test_partner_is_the_oldest_compatible_user():
+    rng = random.Random(0)
+    queue = MatchmakingQueue(NEVER)
+    waiting = {}
+
+    def preferences():
+        if rng.random() < 0.2:
+            return NO_PREFERENCES
+        return make_preferences(rng.choice(["en", "it", "any"]), rng.choice(["eu", "asia", "any"]),
+                                rng.sample(["music", "art", "sport", "food"], rng.randrange(3)))
+
+    for index in range(3000):
+        user_id = str(index)
+        user_preferences = preferences()
+        expected = next((other for other, other_preferences in waiting.items()
+                         if _compatible(user_preferences, other_preferences)), None)
+        match = queue.pair_or_enqueue(user_id, preferences=user_preferences)
+        assert (match and match[0]) == expected
+        if expected is None:
+            waiting[user_id] = user_preferences
+        else:
+            del waiting[expected]
+    assert len(queue) == len(waiting)
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+from telegram import Bot
+from telegram.error import RetryAfter
+
+from load_test import TOKEN, FakeBotAPI
+from outbound import OutboundScheduler
+
+
+async def _with_fake_api(test, **limits):
+    api = FakeBotAPI(enforce_limits=True, **limits)
+    await api.start()
+    try:
+        async with Bot(TOKEN, base_url=api.base_url) as bot:
+            return await test(api, bot)
+    finally:
+        await api.stop()
+
+
+def test_rate_limited_calls_are_retried_in_order():
+    # The scheduler allows more than the API, which answers 429 with retry_after
+    scheduler = OutboundScheduler(global_rate=100, global_burst=100, chat_rate=50, chat_burst=50, max_retries=5)
+    chats = [1001, 1002, 1003]
+
+    async def test(api, bot):
+        futures = {chat_id: [scheduler.notify(bot, chat_id, text="message " + str(index), disable_notification=True)
+                             for index in range(5)]
+                   for chat_id in chats}
+        results = {chat_id: await asyncio.gather(*chat_futures) for chat_id, chat_futures in futures.items()}
+        await scheduler.stop()
+        return api, results
+
+    api, results = asyncio.run(_with_fake_api(test, chat_limit=(5, 2)))
+    assert api.rate_limited > 0
+    assert scheduler.rate_limited == api.rate_limited
+    assert scheduler.errors == 0
+    assert scheduler.sent == 5 * len(chats)
+    for messages in results.values():
+        # Sent in order: the message ids of a chat grow with every accepted call
+        assert [message.text for message in messages] == ["message " + str(index) for index in range(5)]
+        assert [message.message_id for message in messages] == sorted(message.message_id for message in messages)
+
+
+def test_call_fails_once_retries_are_exhausted():
+    scheduler = OutboundScheduler(global_rate=100, global_burst=100, chat_rate=50, chat_burst=50, max_retries=0)
+
+    async def test(api, bot):
+        futures = [scheduler.notify(bot, 1001, text="message " + str(index), disable_notification=True)
+                   for index in range(3)]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        await scheduler.stop()
+        return results
+
+    results = asyncio.run(_with_fake_api(test, chat_limit=(1, 1)))
+    assert results[0].text == "message 0"
+    assert all(isinstance(result, RetryAfter) for result in results[1:])
+    assert scheduler.errors == 2
+
+
+def test_blocked_chats_do_not_hold_back_the_others():
+    # A single send per chat every 100 seconds: the second call to each chat stays queued
+    scheduler = OutboundScheduler(global_rate=100000, global_burst=100000, chat_rate=0.01, chat_burst=1)
+
+    async def call():
+        return None
+
+    async def test():
+        for chat_id in range(1000):
+            scheduler.submit(chat_id, call)
+            scheduler.submit(chat_id, call)
+        await asyncio.sleep(0.2)
+        free = scheduler.submit("free", call)
+        await asyncio.wait_for(free, timeout=1)
+        queued = len(scheduler)
+        await scheduler.stop(timeout=0)
+        return queued
+
+    assert asyncio.run(test()) == 1000
+
+
+def test_merged_notices_fit_in_a_message():
+    scheduler = OutboundScheduler(global_rate=1000, global_burst=1000, chat_rate=1, chat_burst=1)
+
+    async def test(api, bot):
+        # The first notice is sent at once, the others wait for the rate limit of the chat and are merged
+        futures = [scheduler.notify(bot, 1001, text=str(index) * 1000) for index in range(10)]
+        messages = await asyncio.gather(*futures)
+        await scheduler.stop()
+        return messages
+
+    messages = asyncio.run(_with_fake_api(test))
+    texts = list({message.message_id: message.text for message in messages}.values())
+    assert all(len(text) <= 4096 for text in texts)
+    assert "\n".join(texts) == "\n".join(str(index) * 1000 for index in range(10))
+
+
+@pytest.mark.parametrize("max_in_flight", [1, 4])
+def test_relays_go_before_notices_and_chats_keep_their_order(max_in_flight):
+    scheduler = OutboundScheduler(global_rate=1000, global_burst=1000, chat_rate=1000, chat_burst=1000,
+                                  max_in_flight=max_in_flight)
+    sent = []
+
+    def call(name):
+        async def send():
+            sent.append(name)
+        return send
+
+    async def test():
+        futures = [scheduler.submit(1, call("notice 1")), scheduler.relay(2, call("relay 2")),
+                   scheduler.relay(1, call("relay 1a")), scheduler.relay(1, call("relay 1b"))]
+        await asyncio.gather(*futures)
+        await scheduler.stop()
+
+    asyncio.run(test())
+    assert sent.index("relay 1a") < sent.index("relay 1b")
+    if max_in_flight == 1:
+        assert sent == ["relay 2", "relay 1a", "relay 1b", "notice 1"]
@@ -0,0 +1,75 @@
+import sqlite3
+
+import pytest
+
+import db_connection
+from UserStatus import UserStatus
+
+# The queries run by db_connection on the hot paths, and the index SQLite must use for each one
+QUERIES = [
+    # _get_row, _get_session: every read and write of a user
+    ("SELECT status, partner_id, epoch FROM users WHERE user_id=?", ("1",), "sqlite_autoindex_users_1"),
+    # compare_and_set: every change of status
+    ("UPDATE users SET status=?, partner_id=? WHERE user_id=? AND epoch=? AND status IN (?)",
+     (UserStatus.COUPLED, "2", "1", 1, UserStatus.IN_SEARCH), "sqlite_autoindex_users_1"),
+    # _get_preferences: every search
+    ("SELECT language, region, interests FROM preferences WHERE user_id=?", ("1",),
+     "sqlite_autoindex_preferences_1"),
+    # load_search_queue: startup after a clean shutdown
+    ("SELECT u.user_id, p.language, p.region, p.interests FROM users u LEFT JOIN preferences p ON p.user_id=u.user_id "
+     "WHERE u.status=? AND u.epoch=? ORDER BY u.rowid", (UserStatus.IN_SEARCH, 1), "idx_users_status_epoch"),
+    # coupled_pairs: housekeeping of the idle chats
+    ("SELECT user_id, partner_id FROM users WHERE status=? AND epoch=? AND user_id<partner_id",
+     (UserStatus.COUPLED, 1), "idx_users_status_epoch"),
+    # archive_inactive: housekeeping of the inactive users
+    ("SELECT user_id, CASE WHEN epoch=? THEN status ELSE ? END FROM users "
+     "WHERE last_seen<? AND (epoch<>? OR status IN (?, ?)) LIMIT ?",
+     (1, UserStatus.IDLE, 0, 1, UserStatus.IDLE, UserStatus.PARTNER_LEFT, 500), "idx_users_last_seen"),
+    # insert_user: users coming back from the archive
+    ("DELETE FROM archived_users WHERE user_id=?", ("1",), "sqlite_autoindex_archived_users_1"),
+]
+
+
+@pytest.mark.parametrize("query, parameters, index", QUERIES)
+def test_hot_queries_use_an_index(database, query, parameters, index):
+    conn = sqlite3.connect(database)
+    plan = " ".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + query, parameters))
+    conn.close()
+    assert "SCAN users" not in plan
+    assert index in plan
+
+
+def test_migrations_reach_the_latest_version(database):
+    conn = sqlite3.connect(database)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+    conn.close()
+    assert version == len(db_connection.MIGRATIONS)
+    # Unused since get_partner_id reads the user's own row
+    assert "idx_users_partner_id" not in indexes
+    assert {"idx_users_status_epoch", "idx_users_last_seen"} <= indexes
+
+
+def test_existing_database_is_upgraded_in_place(tmp_path):
+    import connection_manager
+
+    path = str(tmp_path / "chatbot_database.db")
+    conn = sqlite3.connect(path)
+    for statement in db_connection.MIGRATIONS[0] + db_connection.MIGRATIONS[1]:
+        conn.execute(statement)
+    conn.execute("INSERT INTO users VALUES ('1', ?, '2'), ('2', ?, '1')", (UserStatus.COUPLED, UserStatus.COUPLED))
+    conn.execute("PRAGMA user_version=2")
+    conn.commit()
+    conn.close()
+
+    connection_manager.configure(database=path)
+    db_connection.create_db()
+    db_connection.start_epoch()
+    conn = sqlite3.connect(path)
+    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index'")}
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == len(db_connection.MIGRATIONS)
+    conn.close()
+    assert "idx_users_partner_id" not in indexes
+    # The users of the previous run are kept, idle
+    assert db_connection.retrieve_users_number() == (2, 0)
+    assert db_connection.get_user_status("1") == UserStatus.IDLE
@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+import storage
+
+# Backends keeping the index in this process, and in the key-value store shared by the workers of the sharded mode
+BACKENDS = ["memory", "kv"]
+
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+def test_copies_are_mapped_both_ways(backend):
+    index = backend.reply_index
+    index.open("1", "2")
+    # Message 5 of user 1 copied as message 8 in the chat of user 2, and the other way round
+    index.record("1", "2", [(5, 8), (6, 9)])
+    index.record("2", "1", [(10, 7)])
+    assert index.lookup("1", 5, "2") == 8
+    assert index.lookup("2", 9, "1") == 6
+    assert index.lookup("1", 7, "2") == 10
+    assert index.lookup("2", 10, "1") == 7
+    # A message of the bot, and a message copied to another partner
+    assert index.lookup("1", 4, "2") is None
+    assert index.lookup("1", 5, "3") is None
+
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+def test_old_messages_are_forgotten(backend):
+    index = backend.reply_index
+    index.open("1", "2")
+    index.record("1", "2", [(1, 1)])
+    index.record("1", "2", [(1 + index.slots, 2)])
+    assert index.lookup("1", 1, "2") is None
+    assert index.lookup("1", 1 + index.slots, "2") == 2
+
+
+@pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+def test_dropping_a_pair_leaves_the_next_one(backend):
+    index = backend.reply_index
+    index.open("1", "2")
+    index.record("1", "2", [(5, 8)])
+    index.open("1", "3")
+    index.record("1", "3", [(6, 4)])
+    index.drop("1", "2")
+    assert index.lookup("1", 6, "3") == 4
+    index.drop("1", "3")
+    assert index.lookup("1", 6, "3") is None
+
+
+@pytest.mark.parametrize("backend", ["kv"], indirect=True)
+def test_replies_are_resolved_by_another_process(backend):
+    # A worker records the copies of the messages of its user, the worker of the partner resolves the replies to them
+    other = storage.create_backend("kv", port=backend._client.port)
+    backend.reply_index.record("1", "2", [(5, 8)])
+    assert other.reply_index.lookup("2", 8, "1") == 5
+    other.reply_index.drop("2", "1")
+    assert backend.reply_index.lookup("1", 5, "2") is None
+
+
+@pytest.mark.parametrize("backend", ["kv"], indirect=True)
+def test_pairs_left_behind_expire(backend):
+    # A pair never dropped, e.g. its worker crashed before the end of the chat
+    index = backend.reply_index
+    index.ttl = 1
+    index.record("1", "2", [(5, 8)])
+    assert backend._client.execute("TTL", "replies:1:2") == 1
+    time.sleep(1.1)
+    assert index.lookup("2", 8, "1") is None
+    assert backend._client.execute("EXISTS", "replies:1:2") == 0
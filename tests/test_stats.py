@@ -0,0 +1,41 @@
+import pytest
+
+from stats import RollingSeries, statistics
+
+
+def test_series_are_merged_by_period():
+    series = RollingSeries(slots=3, slot_seconds=60)
+    series.record(1.0, now=0)
+    series.record(2.0, now=60)
+    other = RollingSeries(slots=3, slot_seconds=60)
+    other.record(3.0, now=60)
+    other.record(4.0, now=120)
+    series.merge(other.take())
+    assert other.snapshot() == []
+    assert series.window(now=120) == (4, 10.0)
+    assert series.window(2, now=120) == (3, 9.0)
+    # Newer periods replace the ones kept in their slot, older ones are ignored
+    series.merge([(3, 1, 7.0)])
+    series.merge([(0, 5, 5.0)])
+    assert series.window(now=180) == (4, 16.0)
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite", "kv", "sharded"], indirect=True)
+def test_pairs_chats_and_relays_are_collected(backend):
+    def counts():
+        collected = backend.collect_statistics()
+        return [collected.pairs.window()[0], collected.queue_waits.window()[0], collected.chat_durations.window()[0],
+                collected.relayed_messages.window()[0]]
+
+    before = counts()
+    for user_id in ("1", "2", "3", "4"):
+        backend.insert_user(user_id)
+    backend.couple("1")
+    backend.couple("2")
+    backend.couple("3")
+    backend.couple("4")
+    statistics.record_relay()
+    backend.uncouple("1")
+    backend.remove_user("4")
+    after = counts()
+    assert [value - previous for value, previous in zip(after, before)] == [2, 2, 2, 1]
@@ -0,0 +1,208 @@
+import time
+
+import pytest
+
+import connection_manager
+import matchmaking
+from UserStatus import UserStatus
+from matchmaking import make_preferences
+
+BACKENDS = ["memory", "sqlite", "kv", "sharded"]
+# Backends keeping the users across restarts, and restoring the pairs after a clean shutdown
+PERSISTENT = {"sqlite", "kv"}
+# Backends pairing by preferences, the others pair any two users
+PREFERENCES = {"memory", "sqlite"}
+# Backends finding the idle pairs and the inactive users for the housekeeping, the others do nothing
+HOUSEKEEPING = {"memory", "sqlite"}
+
+pytestmark = pytest.mark.parametrize("backend", BACKENDS, indirect=True)
+
+
+def _counts(**counts):
+    expected = {status: 0 for status in UserStatus.possible_states}
+    expected.update(counts)
+    return expected
+
+
+def _insert(backend, *user_ids):
+    for user_id in user_ids:
+        backend.insert_user(user_id)
+
+
+def test_insert_and_remove(backend):
+    _insert(backend, "1", "2")
+    backend.insert_user("1")
+    assert backend.retrieve_users_number() == (2, 0)
+    assert backend.count_users_by_status() == _counts(idle=2)
+    assert backend.get_user_status("1") == UserStatus.IDLE
+    assert backend.get_partner_id("1") is None
+    assert backend.get_user_status("3") is None
+    assert backend.remove_user("1") == (True, None, None)
+    assert backend.remove_user("1").applied is False
+    assert backend.get_user_status("1") is None
+    assert backend.retrieve_users_number() == (1, 0)
+
+
+def test_couple_and_uncouple(backend):
+    _insert(backend, "1", "2", "3")
+    assert backend.couple("1") == (True, UserStatus.IN_SEARCH, None)
+    assert backend.couple("1").applied is False
+    assert backend.couple("2") == (True, UserStatus.COUPLED, "1")
+    assert backend.get_partner_id("1") == "2" and backend.get_partner_id("2") == "1"
+    assert backend.couple("2") == (False, UserStatus.COUPLED, "1")
+    assert backend.couple("missing").applied is False
+    assert backend.retrieve_users_number() == (3, 2)
+    assert backend.count_users_by_status() == _counts(idle=1, coupled=2)
+
+    assert backend.uncouple("1") == (True, UserStatus.IDLE, "2")
+    assert backend.get_user_status("2") == UserStatus.IDLE
+    assert backend.get_partner_id("2") is None
+    assert backend.uncouple("2") == (False, UserStatus.IDLE, None)
+    assert backend.count_users_by_status() == _counts(idle=3)
+
+
+def test_removed_user_leaves_the_partner_alone(backend):
+    _insert(backend, "1", "2")
+    backend.couple("1")
+    backend.couple("2")
+    assert backend.remove_user("2") == (True, None, "1")
+    assert backend.get_user_status("1") == UserStatus.PARTNER_LEFT
+    assert backend.get_partner_id("1") is None
+    assert backend.count_users_by_status() == _counts(partner_left=1)
+    # Left alone, the user can search again
+    assert backend.couple("1") == (True, UserStatus.IN_SEARCH, None)
+
+
+def test_removed_user_is_no_longer_in_search(backend):
+    _insert(backend, "1", "2")
+    backend.couple("1")
+    backend.remove_user("1")
+    assert backend.couple("2") == (True, UserStatus.IN_SEARCH, None)
+
+
+def test_set_user_status(backend):
+    _insert(backend, "1", "2")
+    backend.couple("1")
+    assert backend.set_user_status("1", UserStatus.IDLE, expected_status=UserStatus.COUPLED) == \
+        (False, UserStatus.IN_SEARCH, None)
+    assert backend.set_user_status("1", UserStatus.IDLE, expected_status=UserStatus.IN_SEARCH) == \
+        (True, UserStatus.IDLE, None)
+    assert backend.set_user_status("missing", UserStatus.IDLE).applied is False
+    # No longer in search, so not paired
+    assert backend.couple("2") == (True, UserStatus.IN_SEARCH, None)
+    assert backend.count_users_by_status() == _counts(idle=1, in_search=1)
+
+
+def test_preferences(backend, request):
+    _insert(backend, "1", "2", "3")
+    assert backend.get_preferences("1") == matchmaking.NO_PREFERENCES
+    backend.set_preferences("1", make_preferences("en", "eu", ["music"]))
+    backend.set_preferences("2", make_preferences("it"))
+    assert backend.get_preferences("1") == make_preferences("en", "eu", ["music"])
+    assert backend.couple("1").status == UserStatus.IN_SEARCH
+    name = request.node.callspec.params["backend"]
+    if name not in PREFERENCES:
+        assert backend.couple("2") == (True, UserStatus.COUPLED, "1")
+        assert backend.match_waiting() == []
+        return
+    # Nobody shares the bucket of the other, they are paired only once they waited long enough
+    assert backend.couple("2").status == UserStatus.IN_SEARCH
+    assert backend.match_waiting() == []
+    queue = getattr(backend, "_queue", matchmaking.queue)
+    queue.widen_after = (0, 0, 0, 0)
+    assert backend.match_waiting() == [("1", "2")]
+    assert backend.get_partner_id("2") == "1"
+    assert backend.count_users_by_status() == _counts(idle=1, coupled=2)
+
+
+def test_expire_searches(backend):
+    _insert(backend, "1", "2")
+    backend.couple("1")
+    assert backend.expire_searches(3600, 10) == []
+    assert backend.expire_searches(0, 10) == ["1"]
+    assert backend.get_user_status("1") == UserStatus.IDLE
+    assert backend.count_users_by_status() == _counts(idle=2)
+    # No longer in search
+    assert backend.couple("2") == (True, UserStatus.IN_SEARCH, None)
+
+
+def test_housekeeping(backend, request):
+    _insert(backend, "1", "2", "3", "4")
+    backend.couple("1")
+    backend.couple("2")
+    backend.touch({"3": time.time() - 1000, "missing": time.time() - 1000})
+    if request.node.callspec.params["backend"] not in HOUSEKEEPING:
+        assert backend.coupled_pairs() == []
+        assert backend.archive_inactive(500, 10) == 0
+        return
+    assert backend.coupled_pairs() == [("1", "2")]
+    if request.node.callspec.params["backend"] == "sqlite":
+        # A new database archives nobody until it has recorded the activity for inactive_for seconds
+        with connection_manager.get_pool().transaction() as c:
+            c.execute("UPDATE meta SET value=0 WHERE key='activity_since'")
+    # Only the idle users not seen for long, coupled ones are kept whatever their activity
+    backend.touch({"1": time.time() - 1000})
+    assert backend.archive_inactive(500, 10) == 1
+    assert backend.get_user_status("3") is None
+    assert backend.retrieve_users_number() == (3, 2)
+    # Back from the archive
+    backend.insert_user("3")
+    assert backend.get_user_status("3") == UserStatus.IDLE
+    assert backend.count_users_by_status() == _counts(idle=2, coupled=2)
+
+
+def test_housekeeping_follows_the_changes(backend, request):
+    if request.node.callspec.params["backend"] not in HOUSEKEEPING:
+        return
+    _insert(backend, "1", "2", "3", "4", "5")
+    if request.node.callspec.params["backend"] == "sqlite":
+        with connection_manager.get_pool().transaction() as c:
+            c.execute("UPDATE meta SET value=0 WHERE key='activity_since'")
+    backend.couple("1")
+    backend.couple("2")
+    backend.couple("3")
+    backend.couple("4")
+    assert sorted(backend.coupled_pairs()) == [("1", "2"), ("3", "4")]
+    backend.uncouple("1")
+    backend.remove_user("3")
+    assert backend.coupled_pairs() == []
+    # Seen again after being inactive, then inactive in another order: the limit archives the least recently seen
+    now = time.time()
+    backend.touch({"1": now - 9 * 3600, "2": now - 9 * 3600, "4": now - 9 * 3600, "5": now - 9 * 3600})
+    backend.touch({"5": now - 3 * 3600, "4": now - 6 * 3600, "2": now})
+    assert backend.archive_inactive(3600, 1) == 1
+    assert backend.get_user_status("1") is None
+    assert backend.archive_inactive(3600, 10) == 2
+    assert [backend.get_user_status(user_id) for user_id in ("2", "4", "5")] == [UserStatus.IDLE, None, None]
+
+
+def test_reset_users_status(backend):
+    _insert(backend, "1", "2", "3")
+    backend.couple("1")
+    backend.couple("2")
+    backend.couple("3")
+    backend.reset_users_status()
+    assert [backend.get_user_status(user_id) for user_id in ("1", "2", "3")] == [UserStatus.IDLE] * 3
+    assert backend.get_partner_id("1") is None
+    assert backend.count_users_by_status() == _counts(idle=3)
+    assert backend.couple("3") == (True, UserStatus.IN_SEARCH, None)
+
+
+def test_restart(backend, request):
+    _insert(backend, "1", "2", "3")
+    backend.couple("1")
+    backend.couple("2")
+    backend.couple("3")
+    backend.close()
+    if request.node.callspec.params["backend"] not in PERSISTENT:
+        assert backend.start(restore_pairs=True) is False
+        return
+    assert backend.start(restore_pairs=True) is True
+    assert backend.get_partner_id("1") == "2"
+    assert backend.count_users_by_status() == _counts(coupled=2, in_search=1)
+    assert backend.couple("missing").applied is False
+    # Not a clean shutdown: the restored run did not call close()
+    assert backend.start(restore_pairs=True) is False
+    assert backend.get_user_status("1") == UserStatus.IDLE
+    assert backend.count_users_by_status() == _counts(idle=3)
+    assert backend.couple("3") == (True, UserStatus.IN_SEARCH, None)
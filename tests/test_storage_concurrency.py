@@ -0,0 +1,86 @@
+import random
+import threading
+
+import pytest
+
+import matchmaking
+from UserStatus import UserStatus
+from matchmaking import make_preferences
+
+USERS = [str(1000 + i) for i in range(40)]
+THREADS = 8
+OPERATIONS = 300
+
+
+def _queue(backend):
+    # The matchmaking queue of the backend, as a list of user ids
+    if hasattr(backend, "_queue"):
+        return list(backend._queue._waiting)
+    if hasattr(backend, "_client"):
+        return backend._client.execute("LRANGE", "search", 0, -1)
+    return list(matchmaking.queue._waiting)
+
+
+def _widen_quickly(backend):
+    # Let match_waiting pair the users with other preferences after a few microseconds instead of seconds
+    queue = getattr(backend, "_queue", matchmaking.queue)
+    queue.widen_after = (0, 0.00001, 0.00002, 0.00005)
+
+
+def _hammer(backend, seed):
+    rng = random.Random(seed)
+    for _ in range(OPERATIONS):
+        user_id = rng.choice(USERS)
+        operation = rng.random()
+        if operation < 0.4:
+            backend.couple(user_id)
+        elif operation < 0.55:
+            backend.uncouple(user_id)
+        elif operation < 0.65:
+            backend.match_waiting()
+        elif operation < 0.75:
+            backend.remove_user(user_id)
+        elif operation < 0.85:
+            backend.insert_user(user_id)
+        elif operation < 0.95:
+            backend.set_preferences(user_id, make_preferences(rng.choice(["en", "it"]), rng.choice(["eu", None])))
+        else:
+            backend.expire_searches(rng.choice([0, 3600]), 5)
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite", "kv"], indirect=True)
+@pytest.mark.parametrize("seed", range(3))
+def test_concurrent_changes_keep_the_backend_consistent(backend, seed):
+    _widen_quickly(backend)
+    for user_id in USERS:
+        backend.insert_user(user_id)
+    threads = [threading.Thread(target=_hammer, args=(backend, seed * THREADS + index)) for index in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    statuses = {user_id: backend.get_user_status(user_id) for user_id in USERS}
+    partners = {user_id: backend.get_partner_id(user_id) for user_id in USERS}
+    for user_id, status in statuses.items():
+        if status == UserStatus.COUPLED:
+            # Pairs are symmetric
+            partner_id = partners[user_id]
+            assert partner_id is not None
+            assert statuses[partner_id] == UserStatus.COUPLED
+            assert partners[partner_id] == user_id
+        else:
+            assert partners[user_id] is None
+
+    # The counters match the stored users
+    expected = {status: 0 for status in UserStatus.possible_states}
+    for status in statuses.values():
+        if status is not None:
+            expected[status] += 1
+    counts = backend.count_users_by_status()
+    assert {status: counts.get(status, 0) for status in expected} == expected
+
+    # The queue holds the users in search, each one once
+    queue = _queue(backend)
+    assert len(queue) == len(set(queue))
+    assert set(queue) == {user_id for user_id, status in statuses.items() if status == UserStatus.IN_SEARCH}
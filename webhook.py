@@ -0,0 +1,186 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from urllib.parse import urlsplit
+
+from telegram import Update
+
+SECRET_TOKEN_HEADER = "x-telegram-bot-api-secret-token"
+# Maximum size of the headers and of the body of a request
+MAX_HEADERS_SIZE = 16 * 1024
+MAX_BODY_SIZE = 1024 * 1024
+
+_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+            413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+class WebhookServer:
+    """
+    Minimal HTTP/1.1 server receiving the updates posted by Telegram.
+    Connections are kept alive between requests. Valid updates are put in the update queue of the application, so
+    they are processed by the same handlers as with long polling. The queue is bounded: when it is full the request is
+    answered with 503 and Telegram retries it later.
+    """
+
+    def __init__(self, application, path="/", listen="0.0.0.0", port=8443, secret_token=None, max_queue_size=1000,
+                 idle_timeout=60.0):
+        """
+        :param application: the bot application, whose update_queue receives the updates
+        :param path: path the updates are posted to
+        :param listen: address to listen on
+        :param port: port to listen on
+        :param secret_token: expected value of the X-Telegram-Bot-Api-Secret-Token header, not checked if None
+        :param max_queue_size: maximum number of updates waiting to be processed
+        :param idle_timeout: seconds after which an idle keep-alive connection is closed
+        """
+        self.application = application
+        self.path = path
+        self.listen = listen
+        self.port = port
+        self.secret_token = secret_token
+        self.max_queue_size = max_queue_size
+        self.idle_timeout = idle_timeout
+        self.accepted = 0
+        self.rejected = 0
+        self._server = None
+        self._connections = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        # The port chosen by the system if 0
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # Close the idle keep-alive connections too, the server only stops accepting new ones
+            for writer in list(self._connections):
+                writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            keep_alive = True
+            while keep_alive:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=self.idle_timeout)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self._respond(writer, 413, keep_alive=False)
+                    return
+                if len(head) > MAX_HEADERS_SIZE:
+                    await self._respond(writer, 413, keep_alive=False)
+                    return
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = request_line.split(" ", 2)
+                except ValueError:
+                    await self._respond(writer, 400, keep_alive=False)
+                    return
+                headers = {}
+                for line in header_lines:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                connection = headers.get("connection", "").lower()
+                keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+
+                try:
+                    length = int(headers.get("content-length", "0"))
+                except ValueError:
+                    await self._respond(writer, 400, keep_alive=False)
+                    return
+                if length > MAX_BODY_SIZE:
+                    await self._respond(writer, 413, keep_alive=False)
+                    return
+                body = await reader.readexactly(length) if length else b""
+
+                status = self._handle_request(method, target, headers, body)
+                await self._respond(writer, status, keep_alive)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    def _handle_request(self, method, target, headers, body):
+        # Validate the request and queue the update, returning the HTTP status of the response
+        if urlsplit(target).path != self.path:
+            return 404
+        if method != "POST":
+            return 405
+        if self.secret_token is not None and not hmac.compare_digest(headers.get(SECRET_TOKEN_HEADER, ""),
+                                                                     self.secret_token):
+            logging.warning("Webhook request with an invalid secret token")
+            return 403
+        # Updates already taken from the queue but still waiting for their turn count as well
+        pending = getattr(self.application.update_processor, "pending", 0)
+        if self.application.update_queue.qsize() + pending >= self.max_queue_size:
+            # Backpressure: Telegram retries the delivery of the update later
+            self.rejected += 1
+            return 503
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError):
+            return 400
+        if update is None:
+            return 400
+        accepts = getattr(self.application.update_processor, "accepts", None)
+        if accepts is not None and not accepts(update):
+            # The user has too many updates waiting: Telegram delivers this one again later
+            self.rejected += 1
+            return 503
+        self.application.update_queue.put_nowait(update)
+        self.accepted += 1
+        return 200
+
+    @staticmethod
+    async def _respond(writer, status, keep_alive):
+        headers = ("HTTP/1.1 " + str(status) + " " + _REASONS[status] + "\r\n"
+                   "Content-Length: 0\r\n"
+                   "Connection: " + ("keep-alive" if keep_alive else "close") + "\r\n")
+        if status == 503:
+            headers += "Retry-After: 1\r\n"
+        writer.write((headers + "\r\n").encode("latin-1"))
+        await writer.drain()
+
+
+async def run_webhook(application, url, listen="0.0.0.0", port=8443, secret_token=None, max_queue_size=1000):
+    """
+    Runs the bot in webhook mode until SIGINT or SIGTERM, the counterpart of application.run_polling()
+    :param application: the bot application
+    :param url: public URL Telegram posts the updates to, its path is the one served by the embedded server
+    :param listen: address the embedded server listens on
+    :param port: port the embedded server listens on
+    :param secret_token: secret token registered with Telegram and checked on every request
+    :param max_queue_size: maximum number of updates waiting to be processed
+    :return: None
+    """
+    server = WebhookServer(application, path=urlsplit(url).path or "/", listen=listen, port=port,
+                           secret_token=secret_token, max_queue_size=max_queue_size)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async with application:
+        # start()/stop() do not run the post_* callbacks (only run_polling and run_webhook do), so run them here
+        if application.post_init:
+            await application.post_init(application)
+        await application.bot.set_webhook(url=url, secret_token=secret_token)
+        await application.start()
+        await server.start()
+        try:
+            await stop_event.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)